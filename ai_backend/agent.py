@@ -1,6 +1,16 @@
-from util.gemini import GeminiHandler, GeminiResponse, GeminiTextRequest, GeminiImage, GeminiMultimodalRequest
-from typing import Tuple
+from util.gemini import GeminiHandler, GeminiResponse, GeminiTextRequest, GeminiImage, GeminiMultimodalRequest, CachedPrefix, estimate_tokens, IMAGE_TOKENS
+from util.image_store import image_store
+from util.local_sentiment import LocalSentimentClassifier, local_sentiment, tiered_sentiment_stats, LOCAL_SENTIMENT_THRESHOLD
+from typing import Callable, Optional, Tuple
+from collections import OrderedDict
+import asyncio
+import bisect
+import hashlib
+import json
+import os
 import re
+import threading
+import time
 
 SYSTEM_PROMPT_AGENT = """
 You are a conversation emulator. 
@@ -30,11 +40,68 @@ You are encouraged to try to send images.
 
 
 
+# context budget per agent (estimated tokens of the message history), older messages beyond it are
+# folded into a rolling summary so prompts stop growing with the conversation. 0 sends the full history
+AGENT_CONTEXT_TOKENS = int(os.getenv("AGENT_CONTEXT_TOKENS", "4000"))
+# only the images of the last AGENT_CONTEXT_IMAGES messages with images are reattached
+AGENT_CONTEXT_IMAGES = int(os.getenv("AGENT_CONTEXT_IMAGES", "4"))
+# the latest messages are always kept verbatim
+AGENT_RECENT_MESSAGES = int(os.getenv("AGENT_RECENT_MESSAGES", "6"))
+AGENT_SUMMARY_WORDS = 150
+
+
+class StreamingResponseParser:
+    """
+    Parses a response while it streams in, using the same rules as Agent.parse_response.
+    The last (possibly incomplete) word is held back until more text arrives so that partial
+    "TEXT:" / "IMAGE: image_1" tokens never leak into the visible text.
+    """
+    _DANGLING_TOKEN = re.compile(r'(?i)\b(?:IMAGE|TEXT)\s*:\s*$')
+
+    def __init__(self, parse_response: Callable[[str], dict]):
+        self.parse_response = parse_response
+        self.raw = ""
+        self.text = ""
+
+    def feed(self, chunk: str) -> str:
+        """
+        Adds a chunk and returns the newly visible text (may be empty).
+        """
+        self.raw += chunk
+        # only parse up to the last whitespace, the word after it may still be incomplete
+        cut = max(self.raw.rfind(" "), self.raw.rfind("\n"))
+        # a trailing "IMAGE:" / "TEXT:" is only removed together with what follows it
+        dangling = self._DANGLING_TOKEN.search(self.raw, 0, max(cut, 0))
+        if dangling:
+            cut = dangling.start()
+        if cut <= 0:
+            return ""
+        return self._advance(self.parse_response(self.raw[:cut])["text"])
+
+    def finish(self) -> dict:
+        """
+        Parses the whole response, returns the same dict as Agent.parse_response.
+        """
+        parsed = self.parse_response(self.raw)
+        self._advance(parsed["text"])
+        return parsed
+
+    def _advance(self, text: str) -> str:
+        if not text.startswith(self.text):
+            # cleaning changed text we already showed (rare), wait for the final parse
+            return ""
+        delta = text[len(self.text):]
+        self.text = text
+        return delta
+
+
 class Agent:
-    def __init__(self, agent_id, survey, gemini_handler: GeminiHandler):
+    def __init__(self, agent_id, survey, gemini_handler: GeminiHandler, context_tokens: int = AGENT_CONTEXT_TOKENS,
+                 context_images: int = AGENT_CONTEXT_IMAGES):
         """
         Initialize the Agent with an id, a profile, 
         and a GeminiHandler for generating responses.
+        context_tokens / context_images bound the history sent every turn (context_tokens=0 sends all of it).
         """
         self.id = agent_id
         self.name = f"Agent_{agent_id}"
@@ -43,9 +110,33 @@ class Agent:
         self.gemini = gemini_handler
         
         # We'll store each message as a dict:
-        # {"from": <sender_name>, "to": <recipient_name>, "message": <text>}
+        # {"from": <sender_name>, "to": <recipient_name>, "message": <text>, "image_ref": <image store ref>, "image_str": <image description>}
         self.message_log = []
 
+        # The prompt is assembled incrementally: the static part is built once and
+        # registered with the model's context cache, history lines/images are appended as messages come in.
+        self._static_prompt = self._build_static_prompt()
+        self._cached_prefix: Optional[CachedPrefix] = None
+        # each entry: {"from", "message", "image_ref", "image_str", "line", "attached_line", "tokens", "attached_tokens"},
+        # rendered once when the message comes in (line once its image is no longer attached)
+        self._history: list[dict] = []
+        # running totals: _token_totals[i] is the text tokens of _history[:i], _image_positions the
+        # indices of the entries with an image
+        self._token_totals: list[int] = [0]
+        self._image_positions: list[int] = []
+        # context management: _history[:_summarized] is only sent as _summary
+        self.context_tokens = context_tokens
+        self.context_images = context_images
+        self._summary = ""
+        self._summary_tokens = 0
+        self._summarized = 0
+        self._static_tokens = estimate_tokens(self._static_prompt)
+        self._prompt_stats: dict = {}
+
+        # per turn generation stats: prompt size and build time, and for streamed turns
+        # {"ttft": <seconds to first token>, "total": <seconds>}
+        self.turn_metrics: list[dict] = []
+
     def parse_response(self, response_text: str) -> dict:
         """
         Parses response_text to extract combined text and detect one image reference
@@ -133,75 +224,266 @@ class Agent:
         }
 
 
-    def _build_prompt_for_gemini(self) -> str:
+    def _build_static_prompt(self) -> str:
         """
-        Builds the text prompt to send to Gemini, including:
+        Builds the part of the prompt that never changes during a conversation:
           - The system prompt
           - This agent's profile
-          - The entire conversation history
+          - The available images
+          - The message format instructions
         """
-        # Start with the system prompt
         lines = "[SYSTEM_PROMPT]\n"
         lines += SYSTEM_PROMPT_AGENT.strip() + "\n\n"
-        images = []
         # Add the agent's profile
         lines += "[PROFILE]\n"
         lines += self.profile.strip() + "\n\n"
         # add available images
         lines += "[AVAILABLE IMAGES]"
         lines += self.survey.get_images_as_str()
-        # Add the message history in a readable format
-        lines += "[MESSAGE HISTORY]\n"
+        lines += MESSAGE_TYPES + "\n"
+        return lines
+
+    def _append_history(self, entry: dict):
+        """
+        Adds one message log entry to the prompt history, rendered in both its variants.
+        """
+        item = {
+            "from": entry["from"],
+            "message": entry["message"],
+            "image_ref": entry["image_ref"] if entry["image_str"] != "" else "",
+            "image_str": entry["image_str"],
+        }
+        item["line"] = self._render(item, attached=False)
+        item["attached_line"] = self._render(item, attached=True)
+        # text only, attached images are counted in _history_tokens
+        item["tokens"] = estimate_tokens(item["line"])
+        item["attached_tokens"] = estimate_tokens(item["attached_line"])
+        if item["image_ref"]:
+            self._image_positions.append(len(self._history))
+        self._history.append(item)
+        self._token_totals.append(self._token_totals[-1] + item["tokens"])
+
+    def _visible_images(self, start: int) -> list[int]:
+        """
+        Indices of the entries from start on whose image is attached to the prompt.
+        """
+        with_images = self._image_positions[bisect.bisect_left(self._image_positions, start):]
+        if self.context_tokens:
+            with_images = with_images[-self.context_images:] if self.context_images else []
+        return with_images
+
+    def _history_tokens(self, start: Optional[int] = None) -> int:
+        start = self._summarized if start is None else start
+        images = len(self._image_positions) - bisect.bisect_left(self._image_positions, start)
+        if self.context_tokens:
+            images = min(images, self.context_images)
+        return self._summary_tokens + self._token_totals[-1] - self._token_totals[start] + IMAGE_TOKENS * images
+
+    def _fold_end(self) -> Optional[int]:
+        """
+        Over the context budget: how far the history has to be folded into the summary to get back
+        under half the budget (keeping the last AGENT_RECENT_MESSAGES), None if it fits.
+        """
+        if not self.context_tokens or self._history_tokens() <= self.context_tokens:
+            return None
+        keep_from = len(self._history) - AGENT_RECENT_MESSAGES
+        end = self._summarized
+        while end < keep_from and self._history_tokens(end) > self.context_tokens // 2:
+            end += 1
+        return end if end > self._summarized else None
+
+    def _set_summary(self, summary: str, end: int):
+        self._summary = summary
+        self._summary_tokens = estimate_tokens(summary)
+        self._summarized = end
+
+    def _build_summary_prompt(self, end: int) -> str:
+        messages = "".join(entry["line"] for entry in self._history[self._summarized:end])
+        return (
+            f"[SYSTEM]\nYou keep the memory of a conversation for {self.name}. Merge the previous summary and the messages below "
+            f"into one summary of at most {AGENT_SUMMARY_WORDS} words, written for {self.name}: what was talked about, what each side "
+            f"shared about themselves, the images that were sent, the tone and the way each side texts. Output only the summary.\n"
+            f"[PREVIOUS SUMMARY]\n{self._summary or '(none)'}\n[MESSAGES]\n{messages}"
+        )
+
+    def _fold_history(self):
+        """
+        Folds the oldest messages into the rolling summary when the history is over the context budget.
+        If the summary call fails the history is kept and folding is retried next turn.
+        """
+        end = self._fold_end()
+        if end is None:
+            return
+        try:
+            summary = self.gemini.send_text_prompt(GeminiTextRequest(prompt=self._build_summary_prompt(end))).text.strip()
+        except Exception as e:
+            print(f"Could not summarize the history of {self.name}, sending it in full: {e}")
+            return
+        self._set_summary(summary, end)
+
+    async def _fold_history_async(self):
+        """
+        Async version of _fold_history.
+        """
+        end = self._fold_end()
+        if end is None:
+            return
+        try:
+            summary = (await self.gemini.send_text_prompt_async(GeminiTextRequest(prompt=self._build_summary_prompt(end)))).text.strip()
+        except Exception as e:
+            print(f"Could not summarize the history of {self.name}, sending it in full: {e}")
+            return
+        self._set_summary(summary, end)
+
+    @staticmethod
+    def _render(entry: dict, attached: bool) -> str:
+        frm = entry["from"]
+        msg = entry["message"]
+        if entry["image_str"] == "":
+            return f"[{frm}]\n{msg}\n"
+        if attached:
+            return f"[{frm}]\n{msg}\n(image in message)\n{entry['image_str']}\n"
+        return f"[{frm}]\n{msg}\n(image in message, no longer attached)\n{entry['image_str']}\n"
+
+    def _build_prompt_for_gemini(self) -> (str, list):
+        """
+        Builds the per turn text prompt to send to Gemini (the message history) and the images to attach.
+        The static part of the prompt is sent through the cached prefix (see _get_cached_prefix).
+        With a context budget, folded messages are replaced by their summary and only the last
+        context_images images are attached. Entries are rendered once (_append_history) and token counts
+        come from the running totals, so this only joins the visible lines.
+        Size and build time are kept for turn_metrics.
+        """
+        start = time.perf_counter()
+        with_images = self._visible_images(self._summarized)
+        attached = set(with_images)
+        prompt = ""
+        if self._summary:
+            prompt += f"[SUMMARY OF EARLIER MESSAGES]\n{self._summary}\n\n"
+        prompt += "[MESSAGE HISTORY]\n" + "".join(
+            entry["attached_line"] if i in attached else entry["line"]
+            for i, entry in enumerate(self._history[self._summarized:], start=self._summarized)
+        )
+        images = [image_store.get(self._history[i]["image_ref"]) for i in with_images]
+        history_tokens = (
+            self._history_tokens()
+            + sum(self._history[i]["attached_tokens"] - self._history[i]["tokens"] for i in with_images)
+        )
+        self._prompt_stats = {
+            "history_tokens": history_tokens,
+            "prompt_tokens": history_tokens + self._static_tokens,
+            "images": len(images),
+            "summarized_messages": self._summarized,
+            "build_time": time.perf_counter() - start,
+        }
+        return prompt, images
+
+    def _get_cached_prefix(self) -> CachedPrefix:
+        if self._cached_prefix is None:
+            self._cached_prefix = self.gemini.register_prefix(self._static_prompt)
+        return self._cached_prefix
+
+    async def _get_cached_prefix_async(self) -> CachedPrefix:
+        if self._cached_prefix is None:
+            self._cached_prefix = await self.gemini.register_prefix_async(self._static_prompt)
+        return self._cached_prefix
+
+    def close(self):
+        """
+        Releases the cached prompt prefix and the images referenced by the message log,
+        call once the conversation is over.
+        """
         for entry in self.message_log:
-            frm = entry["from"]
-            msg = entry["message"]
-            if entry["image_str"] != "":
-                # an image was sent so parse it
-                image_str = entry["image_str"]
-                lines += f"[{frm}]\n{msg}\n(image in message)\n{image_str}\n"
-                images.append(entry["image_b64"])
-            else:
-                lines += f"[{frm}]\n{msg}\n"
-        lines += MESSAGE_TYPES
-        return lines, images
+            image_store.release(entry["image_ref"])
+        self._history = []
+        self._token_totals = [0]
+        self._image_positions = []
+        if self._cached_prefix is not None:
+            self.gemini.release_prefix(self._cached_prefix)
+            self._cached_prefix = None
 
     def generate_response(self) -> str:
         """
         Fetches the next response from Gemini (single-shot, no streaming).
         """
+        self._fold_history()
         prompt, images = self._build_prompt_for_gemini()
-        response = self.gemini.send_multimodal_prompt_b64(prompt, images).text
+        start = time.perf_counter()
+        response = self.gemini.send_multimodal_prompt_b64(prompt, images, cached_prefix=self._get_cached_prefix()).text
+        self.turn_metrics.append({**self._prompt_stats, "total": time.perf_counter() - start})
         # print(response)
         parsed_response = self.parse_response(response)
         return parsed_response
 
-    def talk_to(self, other_agent, message: str, image_b64: str="", image_str: str=""):
+    async def generate_response_async(self) -> dict:
+        """
+        Async version of generate_response, does not block the event loop while Gemini responds.
+        """
+        cached_prefix = await self._get_cached_prefix_async()
+        await self._fold_history_async()
+        prompt, images = self._build_prompt_for_gemini()
+        start = time.perf_counter()
+        response = (await self.gemini.send_multimodal_prompt_b64_async(prompt, images, cached_prefix=cached_prefix)).text
+        self.turn_metrics.append({**self._prompt_stats, "total": time.perf_counter() - start})
+        return self.parse_response(response)
+
+    async def generate_response_stream_async(self, on_partial: Optional[Callable[[str, str], None]] = None) -> dict:
+        """
+        Streaming version of generate_response_async. As chunks arrive the visible text is parsed
+        incrementally and on_partial(text_so_far, delta) is called for every new piece of text.
+        Returns the final parsed response and records time-to-first-token in turn_metrics.
+        """
+        cached_prefix = await self._get_cached_prefix_async()
+        await self._fold_history_async()
+        prompt, images = self._build_prompt_for_gemini()
+        parser = StreamingResponseParser(self.parse_response)
+        start = time.perf_counter()
+        ttft = None
+        async for chunk in self.gemini.stream_multimodal_prompt_b64_async(prompt, images, cached_prefix=cached_prefix):
+            if ttft is None:
+                ttft = time.perf_counter() - start
+            delta = parser.feed(chunk)
+            if delta and on_partial:
+                on_partial(parser.text, delta)
+        parsed_response = parser.finish()
+        total = time.perf_counter() - start
+        self.turn_metrics.append({**self._prompt_stats, "ttft": ttft if ttft is not None else total, "total": total})
+        return parsed_response
+
+    def talk_to(self, other_agent, message: str, image_ref: str="", image_str: str=""):
         """
         Sends a message to another Agent.
+        image_ref is an image store reference, each log holding it takes its own reference.
         """
         # Log the message in this agent's history
-        self.message_log.append({
+        entry = {
             "from": self.name,
             "to": other_agent.name,
             "message": message,
-            "image_b64": image_b64,
+            "image_ref": image_ref,
             "image_str": image_str,
-        })
+        }
+        image_store.acquire(image_ref)
+        self.message_log.append(entry)
+        self._append_history(entry)
 
         # Deliver the message to the other agent
-        other_agent.receive_message(message, self, image_b64, image_str)
+        other_agent.receive_message(message, self, image_ref, image_str)
 
-    def receive_message(self, message: str, from_agent, image_b64: str, image_str: str):
+    def receive_message(self, message: str, from_agent, image_ref: str, image_str: str):
         """
         Handles receiving a message from another Agent.
         """
-        self.message_log.append({
+        entry = {
             "from": from_agent.name,
             "to": self.name,
             "message": message,
-            "image_b64": image_b64,
+            "image_ref": image_ref,
             "image_str": image_str,
-        })
+        }
+        image_store.acquire(image_ref)
+        self.message_log.append(entry)
+        self._append_history(entry)
 
     def show_message_log(self):
         """
@@ -259,6 +541,20 @@ class SafetyAgent:
         return "yes" in response.lower()
 
 
+# evaluation modes: one structured call for both speakers, or one free text call per speaker run concurrently
+STRUCTURED = "structured"
+PARALLEL = "parallel"
+EVALUATION_MODE = os.getenv("EVALUATION_MODE", STRUCTURED)
+# extra attempts when the evaluation answer is malformed
+EVALUATION_RETRIES = int(os.getenv("EVALUATION_RETRIES", "2"))
+# rough length of the running conversation summary kept by the incremental evaluation
+EVALUATION_SUMMARY_WORDS = int(os.getenv("EVALUATION_SUMMARY_WORDS", "200"))
+
+
+class EvaluationError(Exception):
+    pass
+
+
 class EvaluatorAgent:
     SYSTEM_PROMPT = """
     You are a conversation evaluator, given two profiles from two speakers and their conversation log, you will evaluate their overall coversation and compatability.
@@ -270,15 +566,75 @@ class EvaluatorAgent:
     Score: (score of compatability reflective of the current evaluation's target's profile, from 0 to a 10 - 10 being best compatability if the conversation reflects their profile)
     Analysis: (put an analysis of the speaker's conversation from what they said, what they should work on, etc...)
     """
+    STRUCTURED_OUTPUT_FORMAT = """
+    For each speaker output:
+    score: compatability reflective of that speaker's profile, an integer from 0 to 10 - 10 being best compatability if the conversation reflects their profile
+    analysis: an analysis of the speaker's conversation from what they said, what they should work on, etc...
+    Output only JSON: {"first_speaker": {"score": ..., "analysis": "..."}, "second_speaker": {"score": ..., "analysis": "..."}}
+    """
+    _SPEAKER_SCHEMA = {
+        "type": "object",
+        "properties": {"score": {"type": "integer"}, "analysis": {"type": "string"}},
+        "required": ["score", "analysis"],
+    }
+    STRUCTURED_SCHEMA = {
+        "type": "object",
+        "properties": {"first_speaker": _SPEAKER_SCHEMA, "second_speaker": _SPEAKER_SCHEMA},
+        "required": ["first_speaker", "second_speaker"],
+    }
+    UPDATE_OUTPUT_FORMAT = f"""
+    Update the summary so it covers the whole conversation so far (the previous summary plus the new messages) in at most {EVALUATION_SUMMARY_WORDS} words,
+    keep what matters for compatability: topics, what each speaker shared, how they reacted to each other, their sentiments.
+    Also give each speaker a provisional compatability score so far, an integer from 0 to 10.
+    Output only JSON: {{"summary": "...", "first_speaker_score": ..., "second_speaker_score": ...}}
+    """
+    UPDATE_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "summary": {"type": "string"},
+            "first_speaker_score": {"type": "integer"},
+            "second_speaker_score": {"type": "integer"},
+        },
+        "required": ["summary", "first_speaker_score", "second_speaker_score"],
+    }
 
-    def __init__(self, speaker1: Agent, speaker2: Agent, gemini_handler: GeminiHandler):
+    def __init__(self, speaker1: Agent, speaker2: Agent, gemini_handler: GeminiHandler, mode: str = EVALUATION_MODE):
         self.speaker1 = speaker1
         self.speaker2 = speaker2
         self.gemini_handler = gemini_handler
-        self.logs = []
+        if mode not in (STRUCTURED, PARALLEL):
+            raise ValueError(f"Unknown evaluation mode {mode}")
+        self.mode = mode
+        # calls, estimated input tokens and latency of the last evaluation
+        self._reset_stats()
+        # calls and estimated input tokens of the incremental updates
+        self.update_stats = {"calls": 0, "input_tokens": 0}
+        # each entry: {"speaker_id", "message", "sentiment", "image_str"}
+        self.logs: list[dict] = []
+        # incremental evaluation: summary of logs[:summarized] and the provisional scores after each update
+        self.summary = ""
+        self.summarized = 0
+        self.trajectory: list[dict] = []
     
-    def add_log(self, speaker: Agent, message: str, sentiment: str="neutral", image_str: str=""):
-        self.logs.append(f"[speaker: {speaker.id} | sentiment: {sentiment}]\n[message]\n{message}\n[image]\n{image_str}")
+    def add_log(self, speaker: Agent, message: str, sentiment: str="neutral", image_str: str="") -> int:
+        """
+        Appends a message to the evaluation log and returns its index.
+        The sentiment may be filled in later with set_log_sentiment (it is scored off the turn path).
+        """
+        self.logs.append({
+            "speaker_id": speaker.id,
+            "message": message,
+            "sentiment": sentiment,
+            "image_str": image_str,
+        })
+        return len(self.logs) - 1
+
+    def set_log_sentiment(self, index: int, sentiment: str):
+        self.logs[index]["sentiment"] = sentiment
+
+    @staticmethod
+    def _format_log(entry: dict) -> str:
+        return f"[speaker: {entry['speaker_id']} | sentiment: {entry['sentiment']}]\n[message]\n{entry['message']}\n[image]\n{entry['image_str']}"
 
     def parse_response(self, response: str) -> (int, str):
         """
@@ -303,20 +659,262 @@ class EvaluatorAgent:
         return score, notes
 
 
-    def get_evaluation(self) -> (int, str, int, str):
-        convo = "\n".join([data for data in self.logs])
-        print(convo)
-        prompt = f"[SYSTEM]{self.SYSTEM_PROMPT}\n[Speaker: {self.speaker1.id}'s Profile]\n{self.speaker1.profile}\n[Speaker: {self.speaker2.id}'s Profile]\n{self.speaker2.profile}\n[FULL CONVERSATION]\n{convo}\n" 
-        # first do evaluation on first speaker
+    def _build_profiles_prompt(self) -> str:
+        return f"[SYSTEM]{self.SYSTEM_PROMPT}\n[Speaker: {self.speaker1.id}'s Profile]\n{self.speaker1.profile}\n[Speaker: {self.speaker2.id}'s Profile]\n{self.speaker2.profile}\n"
+
+    def _build_shared_prompt(self) -> str:
+        """
+        Profiles and conversation, once parts of it were summarized (update_summary) only the summary
+        and the messages after it are sent instead of the full log.
+        """
+        if not self.summary:
+            convo = "\n".join([self._format_log(entry) for entry in self.logs])
+            return f"{self._build_profiles_prompt()}[FULL CONVERSATION]\n{convo}\n"
+        recent = "\n".join([self._format_log(entry) for entry in self.logs[self.summarized:]])
+        return f"{self._build_profiles_prompt()}[SUMMARY OF THE CONVERSATION SO FAR]\n{self.summary}\n[REST OF THE CONVERSATION]\n{recent}\n"
+
+    def _build_evaluation_prompts(self) -> (str, str):
+        """
+        Builds the evaluation prompt for each speaker (shared context + per speaker target).
+        """
+        prompt = self._build_shared_prompt()
         first_speaker_prompt = f"{prompt}\nOnly do evaluation on {self.speaker1.id}\n{self.OUTPUT_FORMAT}"
-        first_request = GeminiTextRequest(prompt=first_speaker_prompt)
-        first_speaker_response = self.gemini_handler.send_text_prompt(first_request).text
-        first_speaker_score, first_speaker_notes = self.parse_response(first_speaker_response)
         second_speaker_prompt = f"{prompt}\nOnly do evaluation on {self.speaker2.id}\n{self.OUTPUT_FORMAT}"
-        second_request = GeminiTextRequest(prompt=second_speaker_prompt)
-        second_speaker_response = self.gemini_handler.send_text_prompt(second_request).text
-        second_speaker_score, second_speaker_notes = self.parse_response(second_speaker_response)
-        return first_speaker_score, first_speaker_notes, second_speaker_score, second_speaker_notes
+        return first_speaker_prompt, second_speaker_prompt
+
+    def _build_structured_request(self) -> GeminiTextRequest:
+        """
+        One prompt evaluating both speakers, answered as JSON matching STRUCTURED_SCHEMA.
+        """
+        prompt = (
+            f"{self._build_shared_prompt()}\nEvaluate both speakers separately: first_speaker is {self.speaker1.id}, "
+            f"second_speaker is {self.speaker2.id}.\n{self.STRUCTURED_OUTPUT_FORMAT}"
+        )
+        return GeminiTextRequest(prompt=prompt, response_mime_type="application/json", response_schema=self.STRUCTURED_SCHEMA)
+
+    @staticmethod
+    def _valid_evaluation(score, analysis) -> bool:
+        return (isinstance(score, int) and not isinstance(score, bool) and 0 <= score <= 10
+                and isinstance(analysis, str) and bool(analysis.strip()))
+
+    @staticmethod
+    def _json_object(response: str) -> Optional[dict]:
+        match = re.search(r"\{.*\}", response, re.DOTALL)
+        if match is None:
+            return None
+        try:
+            answer = json.loads(match.group(0))
+        except ValueError:
+            return None
+        return answer if isinstance(answer, dict) else None
+
+    @staticmethod
+    def _as_int(score):
+        if isinstance(score, float) and score.is_integer():
+            return int(score)
+        return score
+
+    def _parse_structured(self, response: str) -> Optional[tuple]:
+        """
+        Validates a structured answer against STRUCTURED_SCHEMA, returns None if it is malformed.
+        """
+        answer = self._json_object(response)
+        if answer is None:
+            return None
+        result = []
+        for speaker in ("first_speaker", "second_speaker"):
+            evaluation = answer.get(speaker)
+            if not isinstance(evaluation, dict):
+                return None
+            score, analysis = self._as_int(evaluation.get("score")), evaluation.get("analysis")
+            if not self._valid_evaluation(score, analysis):
+                return None
+            result += [score, analysis.strip()]
+        return tuple(result)
+
+    def _parse_update(self, response: str) -> Optional[tuple]:
+        """
+        Validates an update answer against UPDATE_SCHEMA, returns (summary, first score, second score) or None.
+        """
+        answer = self._json_object(response)
+        if answer is None:
+            return None
+        summary = answer.get("summary")
+        first_score, second_score = self._as_int(answer.get("first_speaker_score")), self._as_int(answer.get("second_speaker_score"))
+        if not (self._valid_evaluation(first_score, summary) and self._valid_evaluation(second_score, summary)):
+            return None
+        return summary.strip(), first_score, second_score
+
+    def _parse_strict(self, response: str) -> Optional[tuple]:
+        """
+        Like parse_response, but returns None instead of defaulting when the score or analysis is missing.
+        """
+        score, notes = self.parse_response(response)
+        if not re.search(r"^Score:\s*\d+\s*$", response, re.MULTILINE) or not self._valid_evaluation(score, notes):
+            return None
+        return score, notes
+
+    def _record_call(self, request: GeminiTextRequest, stats: dict):
+        stats["calls"] += 1
+        stats["input_tokens"] += estimate_tokens(request.prompt)
+
+    def _reset_stats(self):
+        self.stats = {"mode": self.mode, "calls": 0, "input_tokens": 0, "latency": 0.0}
+
+    def _evaluate_with_retries(self, request: GeminiTextRequest, parse: Callable, stats: Optional[dict] = None) -> tuple:
+        for _ in range(1 + EVALUATION_RETRIES):
+            self._record_call(request, self.stats if stats is None else stats)
+            result = parse(self.gemini_handler.send_text_prompt(request).text)
+            if result is not None:
+                return result
+            print(f"Malformed evaluation for convo between {self.speaker1.id} and {self.speaker2.id}, retrying")
+        raise EvaluationError(f"No valid evaluation after {1 + EVALUATION_RETRIES} attempts")
+
+    async def _evaluate_with_retries_async(self, request: GeminiTextRequest, parse: Callable, stats: Optional[dict] = None) -> tuple:
+        for _ in range(1 + EVALUATION_RETRIES):
+            self._record_call(request, self.stats if stats is None else stats)
+            result = parse((await self.gemini_handler.send_text_prompt_async(request)).text)
+            if result is not None:
+                return result
+            print(f"Malformed evaluation for convo between {self.speaker1.id} and {self.speaker2.id}, retrying")
+        raise EvaluationError(f"No valid evaluation after {1 + EVALUATION_RETRIES} attempts")
+
+    def _build_update_request(self, end: Optional[int]) -> tuple[GeminiTextRequest, int]:
+        """
+        Prompt folding logs[summarized:end] into the summary, and the log length it covers.
+        """
+        end = len(self.logs) if end is None else min(end, len(self.logs))
+        new_messages = "\n".join([self._format_log(entry) for entry in self.logs[self.summarized:end]])
+        prompt = (
+            f"{self._build_profiles_prompt()}[PREVIOUS SUMMARY]\n{self.summary or '(conversation just started)'}\n"
+            f"[NEW MESSAGES]\n{new_messages}\n"
+            f"first_speaker is {self.speaker1.id}, second_speaker is {self.speaker2.id}.\n{self.UPDATE_OUTPUT_FORMAT}"
+        )
+        return GeminiTextRequest(prompt=prompt, response_mime_type="application/json", response_schema=self.UPDATE_SCHEMA), end
+
+    def _apply_update(self, result: tuple, end: int) -> dict:
+        self.summary, first_score, second_score = result
+        self.summarized = end
+        point = {"turn": end, "speaker_1_score": first_score, "speaker_2_score": second_score}
+        self.trajectory.append(point)
+        return point
+
+    def update_summary(self, end: Optional[int] = None) -> Optional[dict]:
+        """
+        Folds the messages logged since the last update (up to end, default all) into the running summary and
+        records provisional scores, the final evaluation then only gets the summary and the messages after it.
+        Returns the new trajectory point ({"turn", "speaker_1_score", "speaker_2_score"}), None if there was nothing new.
+        Raises EvaluationError if the answer stays malformed, the summary is then left as it was.
+        """
+        if self.summarized >= min(len(self.logs), len(self.logs) if end is None else end):
+            return None
+        request, end = self._build_update_request(end)
+        return self._apply_update(self._evaluate_with_retries(request, self._parse_update, self.update_stats), end)
+
+    async def update_summary_async(self, end: Optional[int] = None) -> Optional[dict]:
+        """
+        Async version of update_summary.
+        """
+        if self.summarized >= min(len(self.logs), len(self.logs) if end is None else end):
+            return None
+        request, end = self._build_update_request(end)
+        return self._apply_update(await self._evaluate_with_retries_async(request, self._parse_update, self.update_stats), end)
+
+    def get_evaluation(self) -> (int, str, int, str):
+        """
+        Returns (speaker 1 score, speaker 1 analysis, speaker 2 score, speaker 2 analysis).
+        Malformed answers are retried EVALUATION_RETRIES times, then EvaluationError is raised.
+        """
+        self._reset_stats()
+        start = time.perf_counter()
+        if self.mode == STRUCTURED:
+            result = self._evaluate_with_retries(self._build_structured_request(), self._parse_structured)
+        else:
+            # the sync api has no concurrency, so parallel runs the two calls one after the other here
+            first_speaker_prompt, second_speaker_prompt = self._build_evaluation_prompts()
+            first = self._evaluate_with_retries(GeminiTextRequest(prompt=first_speaker_prompt), self._parse_strict)
+            second = self._evaluate_with_retries(GeminiTextRequest(prompt=second_speaker_prompt), self._parse_strict)
+            result = (*first, *second)
+        self.stats["latency"] = time.perf_counter() - start
+        return result
+
+    async def get_evaluation_async(self) -> (int, str, int, str):
+        """
+        Async version of get_evaluation, in parallel mode both speakers are evaluated at the same time.
+        """
+        self._reset_stats()
+        start = time.perf_counter()
+        if self.mode == STRUCTURED:
+            result = await self._evaluate_with_retries_async(self._build_structured_request(), self._parse_structured)
+        else:
+            first_speaker_prompt, second_speaker_prompt = self._build_evaluation_prompts()
+            first, second = await asyncio.gather(
+                self._evaluate_with_retries_async(GeminiTextRequest(prompt=first_speaker_prompt), self._parse_strict),
+                self._evaluate_with_retries_async(GeminiTextRequest(prompt=second_speaker_prompt), self._parse_strict),
+            )
+            result = (*first, *second)
+        self.stats["latency"] = time.perf_counter() - start
+        return result
+
+# sentiments remembered per (profile, message)
+SENTIMENT_CACHE_SIZE = int(os.getenv("SENTIMENT_CACHE_SIZE", "10000"))
+SENTIMENT_CACHE_TTL = float(os.getenv("SENTIMENT_CACHE_TTL", "3600"))
+# messages classified by one batched call
+SENTIMENT_BATCH_SIZE = int(os.getenv("SENTIMENT_BATCH_SIZE", "40"))
+
+
+class SentimentCache:
+    """
+    Thread-safe LRU cache of classified sentiments with a TTL, keyed on (profile hash, normalized message).
+    Shared by every SentimentAgent, so repeated messages ("[STOP]", "haha", ...) are only classified once per profile.
+    """
+    def __init__(self, max_entries: int = SENTIMENT_CACHE_SIZE, ttl: float = SENTIMENT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # LLM calls made by sentiment agents (batched calls count once)
+        self.llm_calls = 0
+        self._entries: OrderedDict[tuple, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, sentiment: str):
+        with self._lock:
+            self._entries[key] = (sentiment, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record_call(self):
+        with self._lock:
+            self.llm_calls += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "llm_calls": self.llm_calls,
+            }
+
+
+sentiment_cache = SentimentCache()
+
 
 class SentimentAgent:
     EMOTIONS = ['neutral', 'mildly positive', 'engaged', 'very engaged', 'excited', 'confused', 'frustrated', 'angry', 'bored']
@@ -327,22 +925,212 @@ class SentimentAgent:
     This emotion should reflect that individual's profile, so more accepting people may not get as bored as quickly while people with ADHD might be bored more early. 
     Use your judgement and make sure it reflects the profile. 
     """
-    def __init__(self, profile, gemini_handler: GeminiHandler):
+    def __init__(self, profile, gemini_handler: GeminiHandler, cache: Optional[SentimentCache] = None,
+                 local_classifier: Optional[LocalSentimentClassifier] = None, local_threshold: float = LOCAL_SENTIMENT_THRESHOLD):
         """
-        Initialize the Agent with an id, profile, and GeminiHandler for determining sentiment of message
+        Initialize the Agent with an id, profile, and GeminiHandler for determining sentiment of message.
+        Messages the local classifier scores at or above local_threshold skip the LLM (> 1 disables it).
         """
         self.profile = profile
         self.gemini_handler = gemini_handler
+        self.cache = sentiment_cache if cache is None else cache
+        self.local_classifier = local_sentiment if local_classifier is None else local_classifier
+        self.local_threshold = local_threshold
+        self._profile_hash = hashlib.sha1(str(profile).encode()).hexdigest()
+        # LLM calls made by this agent
+        self.calls = 0
 
 
     def _get_sentiment_str(self):
         return f"You may only return one of the following sentiments: {self.EMOTIONS}\. Do not send any other sentiment"
     
+    def _build_sentiment_prompt(self, message: str) -> str:
+        return f"[SYSTEM PROMPT]\n{self.SYSTEM_PROMPT}\n[Message]\n{message}\n{self._get_sentiment_str()}"
+
+    def _build_batch_sentiment_prompt(self, messages: list) -> str:
+        numbered = "\n".join(f"[Message {i}]\n{message}" for i, message in enumerate(messages))
+        return (
+            f"[SYSTEM PROMPT]\n{self.SYSTEM_PROMPT}\n{numbered}\n{self._get_sentiment_str()}\n"
+            f"Classify each message separately. Return only a JSON array of {len(messages)} strings, one sentiment per message in order."
+        )
+
+    @staticmethod
+    def _normalize_message(message: str) -> str:
+        return " ".join(message.lower().split())
+
+    def _cache_key(self, message: str) -> tuple:
+        return (self._profile_hash, self._normalize_message(message))
+
+    @classmethod
+    def to_emotion(cls, response: str) -> str:
+        """
+        Maps a model answer onto one of the EMOTIONS (neutral if none is recognized).
+        """
+        text = response.strip().strip("\"'.` \n").lower()
+        if text in cls.EMOTIONS:
+            return text
+        # longest first so "very engaged" wins over "engaged"
+        for emotion in sorted(cls.EMOTIONS, key=len, reverse=True):
+            if emotion in text:
+                return emotion
+        return 'neutral'
+
+    def _parse_batch(self, response: str, count: int) -> Optional[list]:
+        match = re.search(r"\[.*\]", response, re.DOTALL)
+        if match is None:
+            return None
+        try:
+            labels = json.loads(match.group(0))
+        except ValueError:
+            return None
+        if not isinstance(labels, list) or len(labels) != count:
+            return None
+        return [self.to_emotion(str(label)) for label in labels]
+
+    def _local_guess(self, message: str) -> tuple:
+        """
+        Returns (emotion, confidence, use_local). use_local is False below the threshold and for the
+        audited sample of confident guesses, which are checked against the LLM instead.
+        """
+        emotion, confidence = self.local_classifier.classify(message)
+        use_local = confidence >= self.local_threshold and not tiered_sentiment_stats.should_audit()
+        return emotion, confidence, use_local
+
+    def _record_llm_answer(self, guess: tuple, sentiment: str):
+        emotion, confidence, _ = guess
+        tiered_sentiment_stats.record_llm(emotion, confidence, sentiment, audit=confidence >= self.local_threshold)
+
+    def _llm_sentiment(self, message: str) -> str:
+        req = GeminiTextRequest(prompt=self._build_sentiment_prompt(message))
+        self._record_call()
+        return self.to_emotion(self.gemini_handler.send_text_prompt(req).text)
+
+    async def _llm_sentiment_async(self, message: str) -> str:
+        req = GeminiTextRequest(prompt=self._build_sentiment_prompt(message))
+        self._record_call()
+        return self.to_emotion((await self.gemini_handler.send_text_prompt_async(req)).text)
+
     def get_sentiment_for_message(self, message: str):
         """
         Get the sentiment of current message from profile.
+        The local classifier answers when it is confident enough, otherwise the LLM is asked.
         """
-        prompt = f"[SYSTEM PROMPT]\n{self.SYSTEM_PROMPT}\n[Message]\n{message}\n{self._get_sentiment_str()}"
-        req = GeminiTextRequest(prompt=prompt)
-        response = self.gemini_handler.send_text_prompt(req).text
-        return response.lower()
+        key = self._cache_key(message)
+        sentiment = self.cache.get(key)
+        if sentiment is None:
+            guess = self._local_guess(message)
+            if guess[2]:
+                tiered_sentiment_stats.record_local()
+                sentiment = guess[0]
+            else:
+                sentiment = self._llm_sentiment(message)
+                self._record_llm_answer(guess, sentiment)
+            self.cache.put(key, sentiment)
+        return sentiment
+
+    async def get_sentiment_for_message_async(self, message: str):
+        """
+        Async version of get_sentiment_for_message.
+        """
+        key = self._cache_key(message)
+        sentiment = self.cache.get(key)
+        if sentiment is None:
+            guess = self._local_guess(message)
+            if guess[2]:
+                tiered_sentiment_stats.record_local()
+                sentiment = guess[0]
+            else:
+                sentiment = await self._llm_sentiment_async(message)
+                self._record_llm_answer(guess, sentiment)
+            self.cache.put(key, sentiment)
+        return sentiment
+
+    def _record_call(self):
+        self.calls += 1
+        self.cache.record_call()
+
+    def _uncached(self, messages: list, sentiments: list) -> list:
+        """
+        Fills sentiments from the cache, returns the distinct (normalized) messages still to classify.
+        """
+        todo = {}
+        for i, message in enumerate(messages):
+            key = self._cache_key(message)
+            if key[1] in todo:
+                continue
+            sentiments[i] = self.cache.get(key)
+            if sentiments[i] is None:
+                todo[key[1]] = message
+        return list(todo.values())
+
+    def _split_local(self, todo: list, classified: dict) -> tuple[list, list]:
+        """
+        Classifies the confident messages locally (into classified and the cache),
+        returns the messages left for the LLM and their local guesses.
+        """
+        remaining, guesses = [], []
+        for message in todo:
+            guess = self._local_guess(message)
+            if guess[2]:
+                tiered_sentiment_stats.record_local()
+                classified[self._normalize_message(message)] = guess[0]
+                self.cache.put(self._cache_key(message), guess[0])
+            else:
+                remaining.append(message)
+                guesses.append(guess)
+        return remaining, guesses
+
+    def _fill(self, messages: list, sentiments: list, classified: dict):
+        for i, message in enumerate(messages):
+            if sentiments[i] is None:
+                sentiments[i] = classified[self._normalize_message(message)]
+
+    def get_sentiments_for_messages(self, messages: list) -> list:
+        """
+        Classifies many messages, the ones the local classifier isn't sure about with one model call
+        per SENTIMENT_BATCH_SIZE distinct uncached messages.
+        A malformed batch answer falls back to one call per message.
+        """
+        sentiments = [None] * len(messages)
+        classified = {}
+        todo, guesses = self._split_local(self._uncached(messages, sentiments), classified)
+        for start in range(0, len(todo), SENTIMENT_BATCH_SIZE):
+            chunk = todo[start:start + SENTIMENT_BATCH_SIZE]
+            self._record_call()
+            response = self.gemini_handler.send_text_prompt(GeminiTextRequest(prompt=self._build_batch_sentiment_prompt(chunk))).text
+            labels = self._parse_batch(response, len(chunk))
+            if labels is None:
+                labels = [self._llm_sentiment(message) for message in chunk]
+            for message, guess, label in zip(chunk, guesses[start:start + SENTIMENT_BATCH_SIZE], labels):
+                self._record_llm_answer(guess, label)
+                classified[self._normalize_message(message)] = label
+                self.cache.put(self._cache_key(message), label)
+        self._fill(messages, sentiments, classified)
+        return sentiments
+
+    async def get_sentiments_for_messages_async(self, messages: list) -> list:
+        """
+        Async version of get_sentiments_for_messages, the batches run concurrently.
+        """
+        sentiments = [None] * len(messages)
+        classified = {}
+        todo, guesses = self._split_local(self._uncached(messages, sentiments), classified)
+        chunks = [todo[start:start + SENTIMENT_BATCH_SIZE] for start in range(0, len(todo), SENTIMENT_BATCH_SIZE)]
+        guess_chunks = [guesses[start:start + SENTIMENT_BATCH_SIZE] for start in range(0, len(todo), SENTIMENT_BATCH_SIZE)]
+
+        async def classify(chunk: list) -> list:
+            self._record_call()
+            response = (await self.gemini_handler.send_text_prompt_async(GeminiTextRequest(prompt=self._build_batch_sentiment_prompt(chunk)))).text
+            labels = self._parse_batch(response, len(chunk))
+            if labels is None:
+                labels = await asyncio.gather(*[self._llm_sentiment_async(message) for message in chunk])
+            return labels
+
+        results = await asyncio.gather(*[classify(chunk) for chunk in chunks])
+        for chunk, chunk_guesses, labels in zip(chunks, guess_chunks, results):
+            for message, guess, label in zip(chunk, chunk_guesses, labels):
+                self._record_llm_answer(guess, label)
+                classified[self._normalize_message(message)] = label
+                self.cache.put(self._cache_key(message), label)
+        self._fill(messages, sentiments, classified)
+        return sentiments
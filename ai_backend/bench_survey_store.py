@@ -0,0 +1,100 @@
+import argparse
+import base64
+import os
+import pickle
+import random
+import tempfile
+import time
+
+from survey import Survey
+from survey_store import SurveyStore
+from util.image_store import image_store
+
+CHUNK = 5000
+
+
+def make_survey(survey_id: str, images_per_user: int, image_kb: int) -> tuple:
+    refs = [image_store.put(base64.b64encode(os.urandom(image_kb * 768)).decode()) for _ in range(images_per_user)]
+    results = str({"Name": f"user {survey_id}", "Additional Notes": "x" * 2000})
+    images = [{"ref": ref, "automated_caption": "a photo", "user_description": "me"} for ref in refs]
+    return Survey.from_record(survey_id, results, "p" * 3000, images), refs
+
+
+def populate(directory: str, store: SurveyStore, users: int, images_per_user: int, image_kb: int, write_pickles: bool):
+    for start in range(0, users, CHUNK):
+        items, refs = [], []
+        for i in range(start, min(users, start + CHUNK)):
+            survey_obj, survey_refs = make_survey(str(i), images_per_user, image_kb)
+            items.append((str(i), survey_obj))
+            refs += survey_refs
+        store.save_many(items)
+        if write_pickles:
+            for survey_id, survey_obj in items:
+                with open(os.path.join(directory, f"{survey_id}.pkl"), "wb") as f:
+                    pickle.dump(survey_obj, f)
+        for ref in refs:
+            image_store.release(ref)
+
+
+def time_pickles(directory: str) -> float:
+    start = time.perf_counter()
+    loaded = {}
+    for filename in os.listdir(directory):
+        if filename.endswith(".pkl"):
+            with open(os.path.join(directory, filename), "rb") as f:
+                loaded[filename.removesuffix(".pkl")] = pickle.load(f)
+    elapsed = time.perf_counter() - start
+    for survey_obj in loaded.values():
+        survey_obj.release_images()
+    return elapsed
+
+
+def bench(users: int, images_per_user: int, image_kb: int, write_pickles: bool) -> dict:
+    """
+    Cold start of the survey store against the old one-pickle-per-user layout: fills a temporary
+    directory with synthetic surveys and times what startup has to do.
+      pickle      unpickle every {id}.pkl (images included) like the old startup did
+      store ids   open the store and list every survey id
+      store all   open the store and load every survey without its images
+      store load  average time to load one random survey by id
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "surveys.db")
+        populate(directory, SurveyStore(db_path), users, images_per_user, image_kb, write_pickles)
+        result = {"users": users}
+        if write_pickles:
+            result["pickle"] = time_pickles(directory)
+
+        start = time.perf_counter()
+        ids = SurveyStore(db_path).list_ids()
+        result["store ids"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        loaded = dict(SurveyStore(db_path).iter_surveys())
+        result["store all"] = time.perf_counter() - start
+        assert len(ids) == len(loaded) == users
+
+        store = SurveyStore(db_path)
+        sample = random.sample(ids, min(1000, users))
+        start = time.perf_counter()
+        for survey_id in sample:
+            store.load(survey_id)
+        result["store load"] = (time.perf_counter() - start) / len(sample)
+        return result
+
+
+# python bench_survey_store.py [--users 10000 100000] [--images-per-user 1] [--image-kb 1] [--no-pickle]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Survey store cold start benchmark")
+    parser.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--images-per-user", type=int, default=1)
+    parser.add_argument("--image-kb", type=int, default=1, help="size of each synthetic image (base64)")
+    parser.add_argument("--no-pickle", action="store_true", help="skip the pickle baseline")
+    args = parser.parse_args()
+
+    for users in args.users:
+        result = bench(users, args.images_per_user, args.image_kb, not args.no_pickle)
+        print(f"{users} users:")
+        for name, seconds in result.items():
+            if name != "users":
+                print(f"  {name:<11} {seconds * 1000:10.2f} ms")
@@ -0,0 +1,182 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional
+
+import httpx
+
+# where live conversation events are pushed (the viewer's /chat endpoint), delivery is off when unset
+FRONT_END_URL = os.getenv("FRONT_END_URL") or None
+# events per POST, 1 keeps the original one-message payload, >1 posts {"events": [...]}
+FRONT_END_BATCH_SIZE = int(os.getenv("FRONT_END_BATCH_SIZE", "1"))
+# pending events kept per conversation before old ones are dropped (a hard cap, required events included)
+FRONT_END_QUEUE_SIZE = int(os.getenv("FRONT_END_QUEUE_SIZE", "64"))
+
+
+@dataclass
+class DeliveryEvent:
+    payload: dict
+    # events only dropped once every pending event is required (e.g. the messages of a conversation)
+    required: bool = False
+    # a newer pending event with the same key replaces this one
+    coalesce_key: Optional[str] = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class FrontEndDelivery:
+    """
+    Pushes conversation events to the front end without blocking the conversation.
+    Every conversation has its own bounded queue drained in order by a background task that
+    posts through one pooled async HTTP client, with optional batching and retries with backoff.
+    When a queue is full the oldest droppable event is dropped, or the oldest required one if
+    every pending event is required, so a front end that is down can't grow the queues forever.
+    Without a url nothing is queued.
+    """
+    def __init__(self, url: Optional[str] = FRONT_END_URL, batch_size: int = FRONT_END_BATCH_SIZE, queue_size: int = FRONT_END_QUEUE_SIZE,
+                 max_retries: int = 3, timeout: float = 10.0):
+        self.url = url
+        self.batch_size = max(1, batch_size)
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+        self._queues: dict[str, deque] = {}
+        self._wakeups: dict[str, asyncio.Event] = {}
+        self._workers: dict[str, asyncio.Task] = {}
+        self._closing: set[str] = set()
+        # metrics
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.dropped_required = 0
+        self.coalesced = 0
+        self.posts = 0
+        self._lags: deque = deque(maxlen=1000)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+            )
+        return self._client
+
+    def enqueue(self, convo_id: str, payload: dict, required: bool = False, coalesce_key: Optional[str] = None):
+        """
+        Queues an event for the convo and returns right away, must be called from the event loop.
+        """
+        if not self.url:
+            return
+        queue = self._queues.get(convo_id)
+        if queue is None:
+            queue = self._queues[convo_id] = deque()
+            self._wakeups[convo_id] = asyncio.Event()
+            self._closing.discard(convo_id)
+            self._workers[convo_id] = asyncio.create_task(self._run(convo_id))
+        event = DeliveryEvent(payload=payload, required=required, coalesce_key=coalesce_key)
+        if coalesce_key is not None:
+            for i, pending in enumerate(queue):
+                if pending.coalesce_key == coalesce_key:
+                    # keep the original enqueue time so the lag stays honest
+                    event.enqueued_at = pending.enqueued_at
+                    queue[i] = event
+                    self.coalesced += 1
+                    return
+        if len(queue) >= self.queue_size:
+            self._drop_oldest(queue)
+        queue.append(event)
+        self._wakeups[convo_id].set()
+
+    def _drop_oldest(self, queue: deque):
+        for i, pending in enumerate(queue):
+            if not pending.required:
+                del queue[i]
+                self.dropped += 1
+                return
+        queue.popleft()
+        self.dropped += 1
+        self.dropped_required += 1
+
+    def close_convo(self, convo_id: str):
+        """
+        No more events for the convo, its worker stops once the queue is drained.
+        """
+        if convo_id in self._queues:
+            self._closing.add(convo_id)
+            self._wakeups[convo_id].set()
+
+    async def _run(self, convo_id: str):
+        queue = self._queues[convo_id]
+        wakeup = self._wakeups[convo_id]
+        try:
+            while True:
+                if not queue:
+                    if convo_id in self._closing:
+                        return
+                    wakeup.clear()
+                    await wakeup.wait()
+                    continue
+                batch = [queue.popleft() for _ in range(min(self.batch_size, len(queue)))]
+                await self._post(batch)
+        finally:
+            self._queues.pop(convo_id, None)
+            self._wakeups.pop(convo_id, None)
+            self._workers.pop(convo_id, None)
+            self._closing.discard(convo_id)
+
+    async def _post(self, batch: list):
+        body = batch[0].payload if len(batch) == 1 else {"events": [event.payload for event in batch]}
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self._get_client().post(self.url, json=body)
+                if response.status_code < 400:
+                    break
+                error = f"status {response.status_code}"
+                if response.status_code < 500 and response.status_code != 429:
+                    # the front end rejected it, resending won't help
+                    print(f"Front end rejected delivery: {error}")
+                    self.failed += len(batch)
+                    return
+            except httpx.HTTPError as e:
+                error = str(e) or type(e).__name__
+            if attempt == self.max_retries:
+                print(f"Front end delivery failed after {attempt + 1} attempts: {error}")
+                self.failed += len(batch)
+                return
+            await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+        self.posts += 1
+        self.delivered += len(batch)
+        now = time.monotonic()
+        self._lags.extend(now - event.enqueued_at for event in batch)
+
+    async def aclose(self):
+        for task in list(self._workers.values()):
+            task.cancel()
+        await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def metrics(self) -> dict:
+        lags = sorted(self._lags)
+        return {
+            "url": self.url,
+            "enabled": bool(self.url),
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "dropped_required": self.dropped_required,
+            "coalesced": self.coalesced,
+            "posts": self.posts,
+            "pending": sum(len(queue) for queue in self._queues.values()),
+            "active_convos": len(self._queues),
+            "lag_avg": sum(lags) / len(lags) if lags else 0.0,
+            "lag_p95": lags[min(len(lags) - 1, int(len(lags) * 0.95))] if lags else 0.0,
+            "lag_max": lags[-1] if lags else 0.0,
+        }
+
+
+front_end_delivery = FrontEndDelivery()
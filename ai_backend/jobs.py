@@ -0,0 +1,236 @@
+import asyncio
+import os
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional
+
+# job statuses
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# seconds a finished job (and a batch whose jobs all finished) stays pollable before it is evicted
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "3600"))
+
+
+@dataclass
+class Job:
+    job_id: str
+    # what the job works on (e.g. the convo id)
+    key: str
+    status: str = QUEUED
+    # last turn reported by the running conversation
+    turn: int = 0
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    def is_active(self) -> bool:
+        return self.status in (QUEUED, RUNNING)
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "key": self.key,
+            "status": self.status,
+            "turn": self.turn,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+@dataclass
+class JobBatch:
+    batch_id: str
+    job_ids: list
+    created_at: float = field(default_factory=time.time)
+
+
+class JobManager:
+    """
+    Runs submitted coroutines in the background on a fixed pool of asyncio workers.
+    Jobs are processed in submission order; each one can be polled by id and cancelled
+    while it is queued or running.
+    Finished jobs are evicted retention seconds after they end, jobs of a batch only together with
+    the whole batch once all of its jobs are done. on_evict(job) is called when the last job of a key goes.
+    on_cancel(job) is called for a job cancelled before it started, its run never gets to clean up after itself.
+    """
+    def __init__(self, num_workers: int = 4, retention: float = JOB_RETENTION, on_evict: Optional[Callable[[Job], None]] = None,
+                 on_cancel: Optional[Callable[[Job], None]] = None):
+        self.num_workers = num_workers
+        self.retention = retention
+        self.on_evict = on_evict
+        self.on_cancel = on_cancel
+        self.jobs: Dict[str, Job] = {}
+        self.batches: Dict[str, JobBatch] = {}
+        # latest job id per key, find_active is a lookup instead of a scan
+        self._latest: Dict[str, str] = {}
+        # (finished_at, job_id) in the order jobs ended
+        self._ended: deque = deque()
+        # batch id per batched job, and how many of a batch's jobs are past the retention
+        self._job_batches: Dict[str, str] = {}
+        self._expired: Dict[str, int] = {}
+        self._runners: Dict[str, Callable[[Job], Awaitable]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: list[asyncio.Task] = []
+
+    def start(self):
+        """
+        Starts the worker pool, must be called from inside the running event loop (e.g. startup hook).
+        """
+        if self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.num_workers)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, key: str, run: Callable[[Job], Awaitable]) -> Job:
+        """
+        Queues run(job) and returns the job handle right away.
+        """
+        if not self._workers:
+            self.start()
+        self._evict()
+        job = Job(job_id=uuid.uuid4().hex, key=key)
+        self.jobs[job.job_id] = job
+        self._latest[key] = job.job_id
+        self._runners[job.job_id] = run
+        self._queue.put_nowait(job.job_id)
+        return job
+
+    def create_batch(self, job_ids: list) -> JobBatch:
+        """
+        Groups already submitted jobs so their progress can be polled together.
+        """
+        batch = JobBatch(batch_id=uuid.uuid4().hex, job_ids=list(job_ids))
+        self.batches[batch.batch_id] = batch
+        self._expired[batch.batch_id] = 0
+        for job_id in batch.job_ids:
+            self._job_batches[job_id] = batch.batch_id
+        return batch
+
+    def get_batch_progress(self, batch_id: str) -> Optional[dict]:
+        batch = self.batches.get(batch_id)
+        if batch is None:
+            return None
+        jobs = [self.jobs[job_id] for job_id in batch.job_ids]
+        counts = {status: 0 for status in (QUEUED, RUNNING, FINISHED, FAILED, CANCELLED)}
+        for job in jobs:
+            counts[job.status] += 1
+        done = counts[FINISHED] + counts[FAILED] + counts[CANCELLED]
+        return {
+            "batch_id": batch.batch_id,
+            "total": len(jobs),
+            "done": done,
+            "counts": counts,
+            "turns_completed": sum(job.turn for job in jobs),
+            "elapsed": time.time() - batch.created_at,
+            "jobs": [job.to_dict() for job in jobs],
+        }
+
+    def cancel_batch(self, batch_id: str) -> int:
+        batch = self.batches.get(batch_id)
+        if batch is None:
+            return 0
+        return sum(self.cancel(job_id) for job_id in batch.job_ids)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def find_active(self, key: str) -> Optional[Job]:
+        job = self.jobs.get(self._latest.get(key))
+        return job if job is not None and job.is_active() else None
+
+    def active_keys(self) -> set:
+        return {key for key in self._latest if self.find_active(key) is not None}
+
+    def _ended_now(self, job: Job):
+        if job.finished_at is None:
+            job.finished_at = time.time()
+        self._ended.append((job.finished_at, job.job_id))
+
+    def _evict(self):
+        """
+        Drops the jobs (and batches) that ended more than retention seconds ago.
+        """
+        cutoff = time.time() - self.retention
+        while self._ended and self._ended[0][0] < cutoff:
+            _, job_id = self._ended.popleft()
+            batch_id = self._job_batches.get(job_id)
+            if batch_id is None:
+                self._drop_job(job_id)
+                continue
+            self._expired[batch_id] += 1
+            batch = self.batches[batch_id]
+            if self._expired[batch_id] == len(batch.job_ids):
+                del self.batches[batch_id]
+                del self._expired[batch_id]
+                for batch_job_id in batch.job_ids:
+                    self._job_batches.pop(batch_job_id, None)
+                    self._drop_job(batch_job_id)
+
+    def _drop_job(self, job_id: str):
+        job = self.jobs.pop(job_id, None)
+        if job is not None and self._latest.get(job.key) == job_id:
+            del self._latest[job.key]
+            if self.on_evict is not None:
+                self.on_evict(job)
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancels a queued or running job, returns False if the job already ended.
+        """
+        job = self.jobs.get(job_id)
+        if job is None or not job.is_active():
+            return False
+        job.status = CANCELLED
+        self._ended_now(job)
+        # queued jobs are skipped by the worker, running ones get interrupted
+        task = self._tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+        elif self.on_cancel is not None:
+            self.on_cancel(job)
+        return True
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            run = self._runners.pop(job_id)
+            job = self.jobs.get(job_id)
+            if job is None or job.status == CANCELLED:
+                # cancelled while queued (and maybe already evicted)
+                continue
+            job.status = RUNNING
+            job.started_at = time.time()
+            task = asyncio.create_task(run(job))
+            self._tasks[job_id] = task
+            try:
+                await task
+                job.status = FINISHED
+            except asyncio.CancelledError:
+                if job.status != CANCELLED:
+                    # the worker itself is shutting down
+                    raise
+            except Exception as e:
+                print(f"Job {job_id} ({job.key}) failed: {e}")
+                job.status = FAILED
+                job.error = str(e)
+            finally:
+                self._tasks.pop(job_id, None)
+                if job.finished_at is None:
+                    self._ended_now(job)
+                self._evict()
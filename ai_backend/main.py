@@ -1,22 +1,45 @@
 import os
-import pickle
 import json
 import time
-import requests
-from fastapi import FastAPI
+import uuid
+from fastapi import FastAPI, Header
 from fastapi.responses import StreamingResponse
 from fastapi.exceptions import HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from agent import Agent, SafetyAgent, EvaluatorAgent, SentimentAgent
-from util.gemini import GeminiHandler
+from agent import Agent, SafetyAgent, EvaluatorAgent, SentimentAgent, EvaluationError, sentiment_cache
+from util.gemini import GeminiHandler, get_in_flight_calls, image_cache
+from util.image_store import image_store
+from util.images import normalization_stats
+from util.local_sentiment import tiered_sentiment_stats
+from util.rate_limit import rate_limiter
 import asyncio
 from pydantic import BaseModel
-from survey import Survey
-from typing import Dict, Any
-
-
-
-FORMS_DIR = "./database/forms"
+from survey import Survey, set_original_store
+from survey_store import SurveyStore, SurveyCache, SURVEY_DB_PATH, FORMS_DIR, PROCESSING, READY, FAILED
+from jobs import JobManager
+from tournament import prescreen, total_pairs
+from delivery import front_end_delivery
+from streaming import convo_events, format_sse
+from typing import Callable, Dict, Any, Literal, Optional
+from collections import deque
+
+
+
+# number of conversations simulated at the same time
+CONVO_WORKERS = int(os.getenv("CONVO_WORKERS", "32"))
+# number of forms processed (captioned / profiled) at the same time
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "8"))
+# forms accepted by one /save_forms request
+MAX_FORMS_PER_BATCH = int(os.getenv("MAX_FORMS_PER_BATCH", "500"))
+# also push streamed partial replies to the front end url (they always go to /stream subscribers)
+FRONT_END_PARTIALS = os.getenv("FRONT_END_PARTIALS", "0") == "1"
+# sentiment modes: realtime classifies every message as it is sent, deferred classifies the
+# whole conversation in batched calls once it is over (for runs nobody watches live)
+REALTIME = "realtime"
+DEFERRED = "deferred"
+# the evaluator folds the conversation into a running summary (and publishes provisional scores)
+# every this many turns, so the final evaluation doesn't send the full transcript. 0 disables it
+EVAL_UPDATE_EVERY = int(os.getenv("EVAL_UPDATE_EVERY", "6"))
 
 app = FastAPI()
 
@@ -28,21 +51,50 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
-surveys: dict[str, Survey] = {}
+survey_store = SurveyStore(SURVEY_DB_PATH)
+# images of stored surveys are only read from disk when a conversation needs them
+image_store.set_loader(survey_store.get_image)
+# uploaded originals are written straight to the store's cold storage while a form is processed
+set_original_store(survey_store)
+
+# surveys are loaded from the store on first use, every stored id is indexed at startup
+surveys = SurveyCache(survey_store)
 
 convo_evaluations: dict[str, EvaluatorAgent] = {}
+# evaluations in flight by convo id, concurrent requests for the same convo share one
+evaluation_tasks: dict[str, asyncio.Task] = {}
+
+def _end_cancelled_convo(job):
+    """
+    A convo cancelled while queued never runs start_convo, so its stream is ended here.
+    """
+    convo_events.publish(job.key, {"type": "cancelled"})
+    convo_events.close(job.key)
+
 
-async def event_generator():
-    # Simulate a stream of events (e.g. log lines, live updates, etc.)
-    for i in range(1, 11):
-        yield f"data: Message {i}\n\n"
-        await asyncio.sleep(1)  # Simulate delay (e.g. real-time source)
+# a convo's log (its evaluator) is kept as long as its job, stored results outlive both
+convo_jobs = JobManager(num_workers=CONVO_WORKERS, on_evict=lambda job: convo_evaluations.pop(job.key, None), on_cancel=_end_cancelled_convo)
 
+ingest_jobs = JobManager(num_workers=INGEST_WORKERS)
+
+# time to first token of recent streamed turns (seconds)
+ttft_samples: deque = deque(maxlen=1000)
+# estimated prompt tokens / prompt build time (seconds) of recent turns
+prompt_token_samples: deque = deque(maxlen=1000)
+prompt_build_samples: deque = deque(maxlen=1000)
+# latency / estimated input tokens of recent evaluations
+evaluation_latency_samples: deque = deque(maxlen=1000)
+evaluation_token_samples: deque = deque(maxlen=1000)
 
 class SaveFormRequest(BaseModel):
     id: str
     form: Dict[str, Any]  
 
+class SaveFormsRequest(BaseModel):
+    forms: list[SaveFormRequest]
+    # resend a batch's forms with its batch_id to resume it, forms already ingested are skipped
+    batch_id: Optional[str] = None
+
 class GetConvoResultsRequest(BaseModel):
     convo_id: str
 
@@ -59,58 +111,175 @@ class StartConvoRequest(BaseModel):
     speaker_1_id: str
     speaker_2_id: str
 
+class StartConvoBatchRequest(BaseModel):
+    pairs: list[StartConvoRequest]
+    # no viewers for batch simulations so turns don't need to be paced
+    delay: float = 0.0
+    max_turns: int = 20
+    # nobody watches batch runs live, so score sentiments in batches at the end
+    sentiment_mode: Literal["realtime", "deferred"] = DEFERRED
+
+class TournamentRunRequest(BaseModel):
+    # how the candidate conversations are run, like StartConvoBatchRequest
+    delay: float = 0.0
+    max_turns: int = 20
+    sentiment_mode: Literal["realtime", "deferred"] = DEFERRED
+
+class StartTournamentRequest(TournamentRunRequest):
+    # defaults to every ready survey
+    user_ids: Optional[list[str]] = None
+    # partners per user (best pre-screen scores) that get a full conversation
+    top_k: int = 5
+
+def _submit_form(form_id: str, form: dict):
+    """
+    Queues the processing of a claimed form (captioning, profile, writing it to the survey store)
+    on the ingestion worker pool.
+    """
+    async def run(job):
+        try:
+            # Create your Survey object
+            survey_obj = await Survey.create_async(form_id, form)
+            try:
+                # Write it (and its images) to the survey store
+                await asyncio.to_thread(survey_store.save, form_id, survey_obj)
+            except BaseException:
+                await asyncio.to_thread(survey_obj.discard_originals)
+                raise
+            finally:
+                # It is loaded back from the store on first use, its images stay on disk until a conversation uses them
+                survey_obj.release_images()
+        except BaseException as e:
+            await asyncio.to_thread(survey_store.mark_failed, form_id, f"Could not save form: {str(e) or type(e).__name__}")
+            raise
+        surveys.add(form_id)
+
+    return ingest_jobs.submit(form_id, run)
+
+
+def _claim_forms(batch_id: str, form_ids: list) -> dict:
+    """
+    Claims the forms and records them in the batch, runs in a thread (sqlite writes).
+    Returns {form id: None if claimed, else its current status}.
+    """
+    statuses = {}
+    for form_id in form_ids:
+        statuses[form_id] = None if survey_store.claim(form_id) else survey_store.get_status(form_id)["status"]
+    survey_store.add_to_batch(batch_id, form_ids)
+    return statuses
+
+
 @app.post("/save_form")
 async def save_form_for_user(data: SaveFormRequest):
+    """
+    Claims the form id and processes the form in the background, poll /forms/{id} for its status.
+    """
     # Basic validation
     if not data.form:
         return {"status": "failed", "reason": "Form is empty"}
 
-    # Construct file path, e.g. "forms/{id}.pkl"
-    file_path = os.path.join(FORMS_DIR, f"{data.id}.pkl")
-
-    # Check if a file with the same ID already exists
-    if os.path.exists(file_path):
+    # Check if a form with the same ID already exists (or is being processed)
+    if not await asyncio.to_thread(survey_store.claim, data.id):
         return {"status": "failed", "reason": "Form with this ID already exists"}
 
-    try:
-        # Create your Survey object
-        survey_obj = Survey(data.id, data.form)
+    job = _submit_form(data.id, data.form)
+    return {"status": PROCESSING, "id": data.id, "job_id": job.job_id}
+
+
+@app.post("/save_forms")
+async def save_forms(data: SaveFormsRequest):
+    """
+    Bulk version of /save_form. Every valid form is queued on the ingestion worker pool and the
+    per form status is returned right away: queued, skipped (already ingested), processing
+    (already being processed) or invalid. Poll /form_batches/{batch_id} for progress; failed
+    forms can be resubmitted with the same batch_id.
+    """
+    if len(data.forms) > MAX_FORMS_PER_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_FORMS_PER_BATCH} forms per request.")
+    batch_id = data.batch_id or uuid.uuid4().hex
+    results = []
+    # position in results of every accepted form, filled in once the forms are claimed
+    accepted = {}
+    for form_data in data.forms:
+        if not form_data.form:
+            results.append({"id": form_data.id, "status": "invalid", "reason": "Form is empty"})
+            continue
+        if form_data.id in accepted:
+            results.append({"id": form_data.id, "status": "invalid", "reason": "Duplicate ID in this request"})
+            continue
+        accepted[form_data.id] = (len(results), form_data)
+        results.append(None)
+    statuses = await asyncio.to_thread(_claim_forms, batch_id, list(accepted))
+    for form_id, (i, form_data) in accepted.items():
+        status = statuses[form_id]
+        if status is None:
+            job = _submit_form(form_id, form_data.form)
+            results[i] = {"id": form_id, "status": "queued", "job_id": job.job_id}
+        else:
+            results[i] = {"id": form_id, "status": "skipped" if status == READY else status}
+    return {"batch_id": batch_id, "forms": results}
+
+
+@app.get("/form_batches/{batch_id}")
+async def get_form_batch(batch_id: str):
+    forms = await asyncio.to_thread(survey_store.get_batch, batch_id)
+    if not forms:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} does not exist.")
+    counts = {}
+    for form in forms:
+        counts[form["status"]] = counts.get(form["status"], 0) + 1
+    return {
+        "batch_id": batch_id,
+        "total": len(forms),
+        "counts": counts,
+        # resend these with the batch_id to resume the batch
+        "failed": [form["id"] for form in forms if form["status"] == FAILED],
+        "forms": forms,
+    }
 
-        # Pickle the object to disk
-        with open(file_path, "wb") as f:
-            pickle.dump(survey_obj, f)
 
-        # You may also keep a reference in a dictionary
-        surveys[data.id] = survey_obj
+@app.get("/forms/{form_id}")
+async def get_form_status(form_id: str):
+    status = await asyncio.to_thread(survey_store.get_status, form_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Form {form_id} does not exist.")
+    return status
 
-    except Exception as e:
-        return {"status": "failed", "reason": f"Could not save form: {str(e)}"}
 
-    # Return success
-    return {"status": "success", "id": data.id}
 # def start_convo_simulation(agent1, agent2, )
 
 
 def get_response_detailed(agent, response):
     message = response["text"]
-    image_b64 = ""
-    image_str = ""
-    if response["image"] != "":
+    if response["image"] in agent.survey.avail_images:
         # there's an image in the response
         # fetch details about the image
         image_details = agent.survey.avail_images[response["image"]]
-        image_b64 = image_details["b64"]
+        image_ref = image_details["ref"]
         user_description = image_details["user_description"]
         image_caption = image_details["automated_caption"]
-        return message, image_b64, f"(user description: {user_description}, image caption: {image_caption})"
+        return message, image_ref, f"(user description: {user_description}, image caption: {image_caption})"
     return message, "", ""
 
 
-def send_to_front_end(speaker: str, speaking_to: str, text: str, b_64_image: str = "", sentiment = "neutral", is_last: bool=False):
-    url = "https://42c3-138-51-69-250.ngrok-free.app/chat"
-    
+def get_thumbnail_ref(agent, image_ref: str) -> str:
+    """
+    Viewers get the thumbnail of an image the agent sent, not the version sent to the model.
+    """
+    for image_details in agent.survey.avail_images.values():
+        if image_details["ref"] == image_ref:
+            return image_details.get("thumbnail_ref") or image_ref
+    return image_ref
+
+
+def send_to_front_end(convo_id: str, speaker: str, speaking_to: str, text: str, b_64_image: str = "", sentiment = "neutral", is_last: bool=False):
+    """
+    Queues a message for the front end, it is posted in the background by front_end_delivery
+    (see delivery.py for the url, batching and retries).
+    """
     # make the JSON payload
     payload = {
+        "convo_id": convo_id,
         "speaker": speaker,
         "speaking_to": speaking_to,
         "text": text,
@@ -118,144 +287,635 @@ def send_to_front_end(speaker: str, speaking_to: str, text: str, b_64_image: str
         "sentiment": sentiment,
         "is_last": is_last
     }
-    
-    # Send the POST request
-    response = requests.post(url, json=payload)
-    
-    # # Optionally, handle or print out the response
-    # if response.ok:
-    #     print("Success:", response.json())
-    # else:
-    #     print("Error:", response.status_code, response.text)
-    
-    # return response
+    # chat messages must not be dropped under backpressure
+    front_end_delivery.enqueue(convo_id, payload, required=True)
 
 
+def publish_partial(convo_id: str, speaker: Agent, listener: Agent, text: str, delta: str):
+    """
+    Publishes the text of a reply that is still being generated.
+    """
+    event = {
+        "type": "partial",
+        "speaker": speaker.name,
+        "speaking_to": listener.name,
+        "text": text,
+        "delta": delta,
+    }
+    convo_events.publish(convo_id, event)
+    if FRONT_END_PARTIALS:
+        # only the latest partial of a reply matters, older pending ones get replaced
+        front_end_delivery.enqueue(convo_id, {"convo_id": convo_id, **event}, coalesce_key=f"partial:{speaker.name}")
 
-def start_convo(agent1: Agent, agent2: Agent, safety_agent: SafetyAgent, eval_agent: EvaluatorAgent, sentiment_agent_1: SentimentAgent, sentiment_agent_2: SentimentAgent, max_turns: int = 20, delay: float = 4.0):
+
+async def score_and_deliver(convo_id: str, previous: Optional[asyncio.Task], eval_agent: EvaluatorAgent, log_index: int, sentiment_agent: Optional[SentimentAgent], speaker: Agent, listener: Agent, text: str, image_ref: str, is_last: bool, turn_stats: Optional[dict] = None):
+    """
+    Off-turn work for one message: classifies its sentiment, attaches it to the message's
+    evaluation log entry, publishes it to the convo's stream and pushes it to the front end.
+    Deliveries are chained on the previous message's task so they stay in conversation order.
+    Without a sentiment_agent (deferred mode) the message goes out unscored.
+    """
+    sentiment = None
+    if sentiment_agent is not None:
+        try:
+            sentiment = await sentiment_agent.get_sentiment_for_message_async(text)
+        except Exception as e:
+            print(f"Sentiment failed for {speaker.name}: {e}")
+            sentiment = "neutral"
+        eval_agent.set_log_sentiment(log_index, sentiment)
+    thumbnail_ref = get_thumbnail_ref(speaker, image_ref)
+    if previous is not None:
+        await asyncio.wait([previous])
+    convo_events.publish(convo_id, {
+        "type": "message",
+        "speaker": speaker.name,
+        "speaking_to": listener.name,
+        "text": text,
+        "image_ref": thumbnail_ref,
+        "sentiment": sentiment,
+        "is_last": is_last,
+        **(turn_stats or {}),
+    })
+    try:
+        image_b64 = await image_store.get_async(thumbnail_ref) or ""
+        send_to_front_end(convo_id, speaker.name, listener.name, text, image_b64, sentiment or "neutral", is_last)
+    except Exception as e:
+        print(f"Front end delivery failed for {speaker.name}: {e}")
+
+
+async def score_deferred(convo_id: str, eval_agent: EvaluatorAgent, unscored: dict):
+    """
+    Scores the messages of a deferred mode convo, one batched call per speaker, and publishes the results.
+    """
+    agents = [sentiment_agent for sentiment_agent, entries in unscored.items() if entries]
+    results = await asyncio.gather(
+        *[sentiment_agent.get_sentiments_for_messages_async([text for _, text in unscored[sentiment_agent]]) for sentiment_agent in agents],
+        return_exceptions=True,
+    )
+    scored = []
+    for sentiment_agent, sentiments in zip(agents, results):
+        if isinstance(sentiments, BaseException):
+            print(f"Deferred sentiment failed: {sentiments}")
+            sentiments = ["neutral"] * len(unscored[sentiment_agent])
+        for (log_index, _), sentiment in zip(unscored[sentiment_agent], sentiments):
+            eval_agent.set_log_sentiment(log_index, sentiment)
+            scored.append({"log_index": log_index, "sentiment": sentiment})
+    convo_events.publish(convo_id, {"type": "sentiments", "sentiments": sorted(scored, key=lambda entry: entry["log_index"])})
+
+
+async def update_evaluation(convo_id: str, eval_agent: EvaluatorAgent, previous: Optional[asyncio.Task], scoring: list, end: int):
+    """
+    Incremental evaluation: once the previous update and the sentiments of the messages so far are done,
+    folds logs[:end] into the evaluator's summary and publishes the provisional scores.
+    A failed update is skipped, the next one (or the final evaluation) covers its messages.
+    """
+    await asyncio.gather(*([previous] if previous else []), *scoring, return_exceptions=True)
+    try:
+        point = await eval_agent.update_summary_async(end)
+    except Exception as e:
+        # a provisional update must never fail the convo, the final evaluation covers unsummarized messages
+        print(f"Incremental evaluation of convo {convo_id} failed, skipping the update: {e}")
+        return
+    if point is not None:
+        convo_events.publish(convo_id, {"type": "provisional_scores", **point})
+
+
+async def start_convo(agent1: Agent, agent2: Agent, safety_agent: SafetyAgent, eval_agent: EvaluatorAgent, sentiment_agent_1: SentimentAgent, sentiment_agent_2: SentimentAgent, max_turns: int = 20, delay: float = 4.0, on_turn: Optional[Callable[[int], None]] = None, convo_id: Optional[str] = None, streaming: bool = False, sentiment_mode: str = REALTIME, eval_every: int = EVAL_UPDATE_EVERY):
     """
     Lets agent1 and agent2 talk to each other in a loop, 
     streaming each response in real-time, until one outputs "[STOP]" 
     or we hit max_turns of back-and-forth.
     A small delay can be introduced between messages using the 'delay' parameter.
+    All model calls are awaited so other conversations and requests keep running meanwhile.
+    on_turn is called with the turn number at the start of every turn (used for job progress).
+
+    convo_id identifies the conversation for the front end (defaults to both agent ids).
+    With streaming, replies are generated token by token and partial text is published while it arrives.
+    sentiment_mode is REALTIME (every message is scored before delivery) or DEFERRED (messages are
+    delivered unscored and each speaker's messages are scored in batched calls at the end).
+
+    Turns are pipelined: as soon as a message is generated it is handed to the other agent,
+    while its sentiment scoring and front end delivery run in the background (score_and_deliver).
+    Every eval_every turns the evaluator updates its running summary in the background (update_evaluation),
+    viewers get the provisional scores as "provisional_scores" events and the final ones as "final_scores" before the stream closes.
+    A cancelled convo ends its stream with a "cancelled" event instead.
     """
     # Start with agent1 greeting agent2
     agent1.talk_to(agent2, "[SYSTEM]\n THE GOAL IS TO GETTING TO KNOW EACH OTHER AND TO INTRODUCE EACH OTHER. DO NOT TALK ABOUT FUTURE PLANS, DO NOT MAKE THINGS UP, ONLY BASE CONVERSATION BASED ON PROFILE. DON'T MAKE IT SURFACE LEVEL. FIRST INTRODUCE YOURSELF.")
 
-    turn_count = 0
-    while turn_count < max_turns:
-        turn_count += 1
-        print(f"\n--- Turn {turn_count} ({agent2.name} responding) ---")
-
-        # Agent2 streams its response
-        response2 = agent2.generate_response()
-        text_2, image_b64_2, image_str_2 = get_response_detailed(agent2, response2)
-        sentiment_2 = sentiment_agent_2.get_sentiment_for_message(text_2)
-        eval_agent.add_log(agent2, text_2, sentiment_2, image_str_2)
-        if "[STOP]" in text_2:
-            send_to_front_end(agent2.name, agent1.name, text_2, image_b64_2, sentiment_2, True)
-            eval_agent.add_log(agent2, "<STOPPED THE CONVERSATION>")
-            print("\nAgent2 indicated stop.\n")
-            break
-        send_to_front_end(agent2.name, agent1.name, text_2, image_b64_2, sentiment_2, turn_count == max_turns)
-        agent2.talk_to(agent1, text_2, image_b64_2, image_str_2)
-        # Introduce a small delay
-        time.sleep(delay)
-
-        turn_count += 1
-        if turn_count > max_turns:
-            break
-
-        print(f"\n--- Turn {turn_count} ({agent1.name} responding) ---")
-
-        # Agent1 streams its response
-        response1 = agent1.generate_response()
-        text_1, image_b64_1, image_str_1 = get_response_detailed(agent1, response1)
-        sentiment_1 = sentiment_agent_2.get_sentiment_for_message(text_1)
-        eval_agent.add_log(agent1, text_1, sentiment_1, image_str_1)
-        if "[STOP]" in text_1:
-            send_to_front_end(agent1.name, agent2.name, text_1, image_b64_1, sentiment_1, True)
-            eval_agent.add_log(agent1, "<STOPPED THE CONVERSATION>")
-            print("\nAgent1 indicated stop.\n")
-            break
-        send_to_front_end(agent1.name, agent2.name, text_1, image_b64_1, sentiment_1, turn_count == max_turns)
-        agent1.talk_to(agent2, text_1, image_b64_1, image_str_1)
-
-        # Introduce a small delay
-        time.sleep(delay)
-
-    # evaluate from evaluator
-    print(eval_agent.get_evaluation())
+    if convo_id is None:
+        convo_id = f"{agent1.id}_{agent2.id}"
+    # agent2 responds first, then they alternate
+    turn_order = [
+        (agent2, agent1, sentiment_agent_2),
+        (agent1, agent2, sentiment_agent_1),
+    ]
+    pending: list[asyncio.Task] = []
+    summary_task: Optional[asyncio.Task] = None
+    # the stream stays open for the final scores unless the convo failed
+    finished = False
+    # deferred mode: (log index, text) of every message per sentiment agent
+    unscored: dict[SentimentAgent, list] = {sentiment_agent_1: [], sentiment_agent_2: []}
+    try:
+        turn_count = 0
+        while turn_count < max_turns:
+            speaker, listener, sentiment_agent = turn_order[turn_count % 2]
+            turn_count += 1
+            if on_turn:
+                on_turn(turn_count)
+            print(f"\n--- Turn {turn_count} ({speaker.name} responding) ---")
+
+            if streaming:
+                def on_partial(text_so_far: str, delta: str, speaker=speaker, listener=listener):
+                    publish_partial(convo_id, speaker, listener, text_so_far, delta)
+                response = await speaker.generate_response_stream_async(on_partial)
+            else:
+                response = await speaker.generate_response_async()
+            turn_stats = speaker.turn_metrics[-1]
+            if streaming:
+                ttft_samples.append(turn_stats["ttft"])
+            prompt_token_samples.append(turn_stats["prompt_tokens"])
+            prompt_build_samples.append(turn_stats["build_time"])
+            text, image_ref, image_str = get_response_detailed(speaker, response)
+            is_stop = "[STOP]" in text
+            # reserve the log entry now so the order is kept, sentiment gets filled in later
+            log_index = eval_agent.add_log(speaker, text, "unscored" if sentiment_mode == DEFERRED else "neutral", image_str)
+            previous = pending[-1] if pending else None
+            if sentiment_mode == DEFERRED:
+                unscored[sentiment_agent].append((log_index, text))
+            pending.append(asyncio.create_task(score_and_deliver(
+                convo_id, previous, eval_agent, log_index, None if sentiment_mode == DEFERRED else sentiment_agent, speaker, listener,
+                text, image_ref, is_stop or turn_count == max_turns, turn_stats
+            )))
+            if is_stop:
+                eval_agent.add_log(speaker, "<STOPPED THE CONVERSATION>")
+                print(f"\n{speaker.name} indicated stop.\n")
+                break
+            if eval_every and turn_count % eval_every == 0 and turn_count < max_turns:
+                summary_task = asyncio.create_task(update_evaluation(convo_id, eval_agent, summary_task, list(pending), log_index + 1))
+            speaker.talk_to(listener, text, image_ref, image_str)
+            # Introduce a small delay
+            await asyncio.sleep(delay)
+
+        # all sentiments (and the summary) must be in before evaluating
+        await asyncio.gather(*pending)
+        if summary_task is not None:
+            await summary_task
+        if sentiment_mode == DEFERRED:
+            await score_deferred(convo_id, eval_agent, unscored)
+        finished = True
+    except asyncio.CancelledError:
+        convo_events.publish(convo_id, {"type": "cancelled"})
+        raise
+    finally:
+        for task in pending:
+            task.cancel()
+        if summary_task is not None:
+            summary_task.cancel()
+        agent1.close()
+        agent2.close()
+        front_end_delivery.close_convo(convo_id)
+        if not finished:
+            convo_events.close(convo_id)
+
+    # evaluate from evaluator once, the results are stored and served from the store afterwards
+    try:
+        evaluation = await evaluate_convo(convo_id, eval_agent, force=True)
+        convo_events.publish(convo_id, {"type": "final_scores", **evaluation})
+    except asyncio.CancelledError:
+        convo_events.publish(convo_id, {"type": "cancelled"})
+        raise
+    finally:
+        convo_events.close(convo_id)
+    print(evaluation)
     # agent1.show_message_log()
     # agent2.show_message_log()
+    return evaluation
 
-@app.post("/start_convo")
-async def start_conversation(data: StartConvoRequest):
-    speaker_1_id = data.speaker_1_id
-    speaker_2_id = data.speaker_2_id
-    if speaker_1_id not in surveys:
-        raise HTTPException(status_code=400, detail=f"Speaker 1 (ID: {speaker_1_id}) has not saved the survey yet.")
+
+async def evaluate(eval_agent: EvaluatorAgent) -> tuple:
+    """
+    Runs the evaluation and records its latency and input tokens for /metrics.
+    """
+    evaluation = await eval_agent.get_evaluation_async()
+    evaluation_latency_samples.append(eval_agent.stats["latency"])
+    evaluation_token_samples.append(eval_agent.stats["input_tokens"])
+    return evaluation
+
+
+async def _evaluate_and_store(convo_id: str, eval_agent: EvaluatorAgent) -> dict:
+    speaker_1_score, speaker_1_analysis, speaker_2_score, speaker_2_analysis = await evaluate(eval_agent)
+    results = ConvoResults(
+        speaker_1_compatability_with_speaker_2=speaker_1_score,
+        speaker_1_analysis=speaker_1_analysis,
+        speaker_2_compatability_with_speaker_1=speaker_2_score,
+        speaker_2_analysis=speaker_2_analysis,
+        speaker_1_id=eval_agent.speaker1.id,
+        speaker_2_id=eval_agent.speaker2.id,
+    ).model_dump()
+    await asyncio.to_thread(survey_store.save_results, convo_id, results)
+    return results
+
+
+async def evaluate_convo(convo_id: str, eval_agent: EvaluatorAgent, force: bool = False) -> dict:
+    """
+    Returns the convo's stored results, evaluating (and storing) them if there are none yet or force is set.
+    Single flight: a call while an evaluation of the convo is running waits for that one instead.
+    """
+    task = evaluation_tasks.get(convo_id)
+    if task is None and not force:
+        results = await asyncio.to_thread(survey_store.load_results, convo_id)
+        if results is not None:
+            return results
+        # another request may have started an evaluation while the store was read
+        task = evaluation_tasks.get(convo_id)
+    if task is None:
+        # no await between the lookup and registering the task, so only one evaluation starts
+        task = asyncio.create_task(_evaluate_and_store(convo_id, eval_agent))
+        evaluation_tasks[convo_id] = task
+        task.add_done_callback(lambda _: evaluation_tasks.pop(convo_id, None))
+    # shielded, a client disconnecting doesn't cancel the evaluation others are waiting on
+    return await asyncio.shield(task)
+
+
+def _validate_convo_request(data: StartConvoRequest, loaded: Optional[dict[str, Survey]] = None):
+    """
+    Raises an HTTPException if the convo can't be started.
+    With loaded (see _load_surveys) the speakers must be among the loaded surveys instead of the index.
+    """
+    known = surveys if loaded is None else loaded
+    if data.speaker_1_id not in known:
+        raise HTTPException(status_code=400, detail=f"Speaker 1 (ID: {data.speaker_1_id}) has not saved the survey yet.")
     
-    if speaker_2_id not in surveys:
-        raise HTTPException(status_code=400, detail=f"Speaker 2 (ID: {speaker_2_id}) has not saved the survey yet.")
+    if data.speaker_2_id not in known:
+        raise HTTPException(status_code=400, detail=f"Speaker 2 (ID: {data.speaker_2_id}) has not saved the survey yet.")
 
-    # both have their profiles saved so now start conversation
+    if convo_jobs.find_active(data.convo_id):
+        raise HTTPException(status_code=400, detail=f"Convo {data.convo_id} is already queued or running.")
+
+
+def _load_surveys(pairs: list[StartConvoRequest]) -> dict[str, Survey]:
+    """
+    Loads the surveys of every speaker of the pairs, by id. A cache miss reads (and unpickles) the survey
+    from the store, so this runs in a thread once per request instead of once per speaker on the event loop.
+    Speakers without a stored survey are left out.
+    """
+    loaded = {}
+    for speaker_id in dict.fromkeys(speaker_id for pair in pairs for speaker_id in (pair.speaker_1_id, pair.speaker_2_id)):
+        survey_obj = surveys.get(speaker_id)
+        if survey_obj is not None:
+            loaded[speaker_id] = survey_obj
+    return loaded
+
+
+def _submit_convo(data: StartConvoRequest, loaded: dict[str, Survey], **convo_kwargs):
+    """
+    Builds the agents for a convo from the speakers' loaded surveys, registers its evaluator and queues it on the worker pool.
+    """
+    speaker_1_id = data.speaker_1_id
+    speaker_2_id = data.speaker_2_id
     # create gemini handlers
     agent_gemini_handler = GeminiHandler(model_name="gemini-2.0-flash")
     reasoning_gemini_handler = GeminiHandler(model_name="gemini-1.5-pro")
     quick_gemini_handler = GeminiHandler(model_name="gemini-1.5-flash-8b")
     # build agents
-    agent_1 = Agent(speaker_1_id, surveys[speaker_1_id], agent_gemini_handler)
-    agent_2 = Agent(speaker_2_id, surveys[speaker_2_id], agent_gemini_handler)
+    agent_1 = Agent(speaker_1_id, loaded[speaker_1_id], agent_gemini_handler)
+    agent_2 = Agent(speaker_2_id, loaded[speaker_2_id], agent_gemini_handler)
     # build safety agent
     safety_agent = SafetyAgent(f"safety_{speaker_1_id}_{speaker_2_id}", agent_1, agent_2, reasoning_gemini_handler)
     # build sentiment
-    sentiment_agent_1 = SentimentAgent(surveys[speaker_1_id].get_profile_matrix(), quick_gemini_handler)
-    sentiment_agent_2 = SentimentAgent(surveys[speaker_2_id].get_profile_matrix(), quick_gemini_handler)
+    sentiment_agent_1 = SentimentAgent(loaded[speaker_1_id].get_profile_matrix(), quick_gemini_handler)
+    sentiment_agent_2 = SentimentAgent(loaded[speaker_2_id].get_profile_matrix(), quick_gemini_handler)
     # build evaluator
     evaluator_agent = EvaluatorAgent(agent_1, agent_2, reasoning_gemini_handler)
     convo_evaluations[data.convo_id] = evaluator_agent
-    # start the convo
-    start_convo(agent_1, agent_2, safety_agent, evaluator_agent, sentiment_agent_1, sentiment_agent_2)
+    # viewers can subscribe to /stream as soon as the convo is queued
+    convo_events.open(data.convo_id)
+
+    async def run(job):
+        def on_turn(turn: int):
+            job.turn = turn
+        await start_convo(agent_1, agent_2, safety_agent, evaluator_agent, sentiment_agent_1, sentiment_agent_2, on_turn=on_turn, convo_id=data.convo_id, **convo_kwargs)
+
+    # queue the convo, the worker pool runs it in the background
+    return convo_jobs.submit(data.convo_id, run)
+
 
-@app.get("/stream")
-async def stream():
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+@app.post("/start_convo")
+async def start_conversation(data: StartConvoRequest):
+    _validate_convo_request(data)
+    loaded = await asyncio.to_thread(_load_surveys, [data])
+    # checked again, the convo may have been started while the surveys were loading
+    _validate_convo_request(data, loaded)
+    # both have their profiles saved so now start conversation
+    # a single convo is usually watched live, so stream the replies
+    job = _submit_convo(data, loaded, streaming=True)
+    return {"status": job.status, "job_id": job.job_id, "convo_id": data.convo_id}
+
+
+@app.post("/start_convo_batch")
+async def start_conversation_batch(data: StartConvoBatchRequest):
+    """
+    Queues many speaker pairs at once, they run concurrently on the convo worker pool.
+    Pairs that can't start are reported back instead of failing the whole batch.
+    """
+    job_ids = []
+    rejected = []
+    valid = []
+    for pair in data.pairs:
+        try:
+            _validate_convo_request(pair)
+        except HTTPException as e:
+            rejected.append({"convo_id": pair.convo_id, "reason": e.detail})
+            continue
+        valid.append(pair)
+    # every survey of the batch is loaded in one go, the pairs are then submitted without awaiting in between
+    loaded = await asyncio.to_thread(_load_surveys, valid)
+    for pair in valid:
+        try:
+            _validate_convo_request(pair, loaded)
+        except HTTPException as e:
+            rejected.append({"convo_id": pair.convo_id, "reason": e.detail})
+            continue
+        job = _submit_convo(pair, loaded, max_turns=data.max_turns, delay=data.delay, sentiment_mode=data.sentiment_mode)
+        job_ids.append(job.job_id)
+    batch = convo_jobs.create_batch(job_ids)
+    return {"batch_id": batch.batch_id, "queued": len(job_ids), "rejected": rejected}
+
+
+def _load_tournament_profiles(user_ids: Optional[list[str]]) -> list[tuple[str, str]]:
+    """
+    (user id, profile text) of the tournament's users, every ready survey by default.
+    """
+    if user_ids is None:
+        return [(survey_id, f"{survey_obj.profile or ''}\n{survey_obj.results}") for survey_id, survey_obj in survey_store.iter_surveys()]
+    profiles = []
+    for user_id in dict.fromkeys(user_ids):
+        survey_obj = survey_store.load(user_id)
+        if survey_obj is None:
+            raise HTTPException(status_code=400, detail=f"User {user_id} has not saved the survey yet.")
+        profiles.append((user_id, f"{survey_obj.profile or ''}\n{survey_obj.results}"))
+    return profiles
+
+
+async def _run_tournament_pairs(tournament: dict, settings: TournamentRunRequest) -> dict:
+    """
+    Queues the candidate pairs that have no stored results and aren't running yet, as one convo batch.
+    """
+    active = convo_jobs.active_keys()
+    requests, done, running = [], 0, 0
+    for pair in tournament["pairs"]:
+        if pair["speaker_1_score"] is not None:
+            done += 1
+            continue
+        if pair["convo_id"] in active:
+            running += 1
+            continue
+        requests.append(StartConvoRequest(convo_id=pair["convo_id"], speaker_1_id=pair["speaker_1_id"], speaker_2_id=pair["speaker_2_id"]))
+    loaded = await asyncio.to_thread(_load_surveys, requests)
+    job_ids, rejected = [], []
+    for request in requests:
+        if convo_jobs.find_active(request.convo_id):
+            # queued by a concurrent resume while the surveys were loading
+            running += 1
+            continue
+        if request.speaker_1_id not in loaded or request.speaker_2_id not in loaded:
+            rejected.append(request.convo_id)
+            continue
+        job = _submit_convo(request, loaded, max_turns=settings.max_turns, delay=settings.delay, sentiment_mode=settings.sentiment_mode)
+        job_ids.append(job.job_id)
+    batch = convo_jobs.create_batch(job_ids)
+    return {"batch_id": batch.batch_id, "queued": len(job_ids), "already_done": done, "running": running, "rejected": rejected}
+
+
+def _tournament_summary(tournament: dict) -> dict:
+    pairs = tournament["pairs"]
+    return {
+        "tournament_id": tournament["tournament_id"],
+        "users": tournament["users"],
+        "top_k": tournament["top_k"],
+        "total_pairs": tournament["total_pairs"],
+        "candidates": len(pairs),
+        # simulations skipped by the pre-screen
+        "pruned": tournament["total_pairs"] - len(pairs),
+    }
+
+
+@app.post("/tournaments")
+async def start_tournament(data: StartTournamentRequest):
+    """
+    Compatibility for a cohort without simulating every pair: all pairs are pre-screened by profile
+    similarity, only each user's top_k candidates get a full conversation (on the convo worker pool).
+    Results go to the store as each conversation is evaluated, poll /tournaments/{id}.
+    """
+    profiles = await asyncio.to_thread(_load_tournament_profiles, data.user_ids)
+    if len(profiles) < 2:
+        raise HTTPException(status_code=400, detail="A tournament needs at least 2 users.")
+    if data.top_k < 1:
+        raise HTTPException(status_code=400, detail="top_k must be at least 1.")
+    user_ids = [user_id for user_id, _ in profiles]
+    candidates = await asyncio.to_thread(prescreen, user_ids, [text for _, text in profiles], data.top_k)
+    tournament_id = uuid.uuid4().hex
+    pairs = [(f"{tournament_id}_{a}_{b}", a, b, score) for a, b, score in candidates]
+    await asyncio.to_thread(survey_store.create_tournament, tournament_id, data.top_k, len(user_ids), total_pairs(len(user_ids)), pairs)
+    tournament = await asyncio.to_thread(survey_store.get_tournament, tournament_id)
+    summary = _tournament_summary(tournament)
+    print(f"Tournament {tournament_id}: {summary['candidates']} of {summary['total_pairs']} pairs simulated, {summary['pruned']} pruned")
+    return {**summary, **(await _run_tournament_pairs(tournament, data))}
+
+
+@app.post("/tournaments/{tournament_id}/resume")
+async def resume_tournament(tournament_id: str, data: TournamentRunRequest):
+    """
+    Queues the candidate pairs that haven't finished (e.g. after a restart), finished ones are not run again.
+    """
+    tournament = await asyncio.to_thread(survey_store.get_tournament, tournament_id)
+    if tournament is None:
+        raise HTTPException(status_code=404, detail=f"Tournament {tournament_id} does not exist.")
+    return {**_tournament_summary(tournament), **(await _run_tournament_pairs(tournament, data))}
+
+
+@app.get("/tournaments/{tournament_id}")
+async def get_tournament(tournament_id: str):
+    """
+    Progress and the compatibilities found so far: {user: {partner: score}} from both sides of each evaluated pair.
+    """
+    tournament = await asyncio.to_thread(survey_store.get_tournament, tournament_id)
+    if tournament is None:
+        raise HTTPException(status_code=404, detail=f"Tournament {tournament_id} does not exist.")
+    compatibilities: dict[str, dict] = {}
+    done = 0
+    for pair in tournament["pairs"]:
+        if pair["speaker_1_score"] is None:
+            continue
+        done += 1
+        compatibilities.setdefault(pair["speaker_1_id"], {})[pair["speaker_2_id"]] = pair["speaker_1_score"]
+        compatibilities.setdefault(pair["speaker_2_id"], {})[pair["speaker_1_id"]] = pair["speaker_2_score"]
+    summary = _tournament_summary(tournament)
+    return {**summary, "done": done, "remaining": summary["candidates"] - done, "compatibilities": compatibilities}
+
+
+@app.get("/convo_batches/{batch_id}")
+async def get_convo_batch(batch_id: str):
+    progress = convo_jobs.get_batch_progress(batch_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} does not exist.")
+    progress["in_flight_llm_calls"] = get_in_flight_calls()
+    return progress
+
+
+@app.post("/convo_batches/{batch_id}/cancel")
+async def cancel_convo_batch(batch_id: str):
+    if convo_jobs.get_batch_progress(batch_id) is None:
+        raise HTTPException(status_code=404, detail=f"Batch {batch_id} does not exist.")
+    return {"batch_id": batch_id, "cancelled": convo_jobs.cancel_batch(batch_id)}
+
+
+@app.get("/convo_jobs/{job_id}")
+async def get_convo_job(job_id: str):
+    job = convo_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} does not exist.")
+    return job.to_dict()
+
+
+@app.post("/convo_jobs/{job_id}/cancel")
+async def cancel_convo_job(job_id: str):
+    job = convo_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} does not exist.")
+    if not convo_jobs.cancel(job_id):
+        raise HTTPException(status_code=400, detail=f"Job {job_id} already {job.status}.")
+    return job.to_dict()
+
+def _summarize(samples) -> dict:
+    values = sorted(samples)
+    if not values:
+        return {"count": 0, "avg": 0.0, "p95": 0.0, "max": 0.0}
+    return {
+        "count": len(values),
+        "avg": sum(values) / len(values),
+        "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        "max": values[-1],
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return {
+        "image_store": image_store.stats(),
+        "survey_store": survey_store.stats(),
+        "survey_cache": surveys.stats(),
+        "decoded_image_cache": image_cache.stats(),
+        "image_normalization": normalization_stats.to_dict(),
+        "in_flight_llm_calls": get_in_flight_calls(),
+        "rate_limits": rate_limiter.budget(),
+        "front_end_delivery": front_end_delivery.metrics(),
+        "streams": convo_events.stats(),
+        "ttft": _summarize(ttft_samples),
+        "agent_prompts": {
+            "tokens": _summarize(prompt_token_samples),
+            "build_time": _summarize(prompt_build_samples),
+        },
+        "evaluation": {
+            "latency": _summarize(evaluation_latency_samples),
+            "input_tokens": _summarize(evaluation_token_samples),
+        },
+        "sentiment_cache": sentiment_cache.stats(),
+        "local_sentiment": tiered_sentiment_stats.stats(),
+    }
+
+
+@app.get("/stream/{convo_id}")
+async def stream(convo_id: str, offset: int = 0, last_event_id: Optional[str] = Header(default=None)):
+    """
+    Server-sent events for a convo, one event per message as the conversation produces it.
+    Late joiners get the history from offset first (or after Last-Event-ID when reconnecting).
+    The stream ends with a "final_scores" event once the convo has been evaluated, or a "cancelled" event if its job was cancelled.
+    """
+    if not convo_events.has_stream(convo_id):
+        raise HTTPException(status_code=404, detail=f"Convo {convo_id} does not exist.")
+    if last_event_id is not None and last_event_id.isdigit():
+        offset = int(last_event_id) + 1
+
+    async def event_stream():
+        async for event in convo_events.subscribe(convo_id, offset):
+            yield format_sse(event)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@app.get("/images/{image_ref}")
+async def get_image(image_ref: str):
+    """
+    Returns the base64 data of an image referenced by a stream event.
+    """
+    b64_image = await image_store.get_async(image_ref)
+    if b64_image is None:
+        raise HTTPException(status_code=404, detail=f"Image {image_ref} does not exist.")
+    return {"image_ref": image_ref, "b64": b64_image}
 
 
 
 @app.get("/get_compatability_for_convo", response_model=ConvoResults)
 async def get_compatability_results(convo_id: str):
+    """
+    Served from the store, a convo is evaluated once when it finishes (or on the first request if that failed).
+    Use /reevaluate_convo to evaluate it again.
+    """
+    results = await asyncio.to_thread(survey_store.load_results, convo_id)
+    if results is not None:
+        return results
     if convo_id not in convo_evaluations:
         raise HTTPException(status_code=400, detail=f"convo id has no results.")
-    
-    # get convo results
-    speaker_1_id = convo_evaluations[convo_id].speaker1.id
-    speaker_2_id = convo_evaluations[convo_id].speaker2.id
-    speaker_1_score, speaker_1_analysis, speaker_2_score, speaker_2_analysis = convo_evaluations[convo_id].get_evaluation()
-    return ConvoResults(
-        speaker_1_compatability_with_speaker_2=speaker_1_score,
-        speaker_1_analysis=speaker_1_analysis,
-        speaker_2_compatability_with_speaker_1=speaker_2_score,
-        speaker_2_analysis=speaker_2_analysis,
-        speaker_1_id=speaker_1_id,
-        speaker_2_id=speaker_2_id,
-    )
+    if convo_jobs.find_active(convo_id):
+        raise HTTPException(status_code=409, detail=f"Convo {convo_id} is still running.")
+    try:
+        return await evaluate_convo(convo_id, convo_evaluations[convo_id])
+    except EvaluationError as e:
+        raise HTTPException(status_code=502, detail=f"Evaluation failed: {e}")
+
+
+@app.post("/reevaluate_convo", response_model=ConvoResults)
+async def reevaluate_convo(data: GetConvoResultsRequest):
+    """
+    Evaluates a finished convo again and replaces its stored results.
+    Only convos run by this process (within the job retention) can be re-evaluated, the conversation log isn't stored.
+    """
+    if data.convo_id not in convo_evaluations:
+        raise HTTPException(status_code=404, detail=f"No conversation log for convo {data.convo_id}.")
+    if convo_jobs.find_active(data.convo_id):
+        raise HTTPException(status_code=409, detail=f"Convo {data.convo_id} is still running.")
+    try:
+        return await evaluate_convo(data.convo_id, convo_evaluations[data.convo_id], force=True)
+    except EvaluationError as e:
+        raise HTTPException(status_code=502, detail=f"Evaluation failed: {e}")
 
 
 
+@app.on_event("startup")
+async def start_convo_workers():
+    convo_jobs.start()
+    ingest_jobs.start()
+
+
+@app.on_event("shutdown")
+async def stop_convo_workers():
+    await convo_jobs.stop()
+    await ingest_jobs.stop()
+    await front_end_delivery.aclose()
+
+
 @app.on_event("startup")
 def load_surveys_from_disk():
-    print("Loading surveys from disk...")
-    for filename in os.listdir(FORMS_DIR):
-        if filename.endswith(".pkl"):
-            path = os.path.join(FORMS_DIR, filename)
-            try:
-                with open(path, "rb") as f:
-                    survey_obj = pickle.load(f)  # Unpickle the Survey object
-                form_id = filename.removesuffix(".pkl")  # Derive ID from filename
-                surveys[form_id] = survey_obj
-                print(f"Loaded survey: {form_id}")
-            except Exception as e:
-                print(f"Error loading {filename}: {e}")
-    print(f"Loaded {len(surveys)} surveys total.")
\ No newline at end of file
+    print("Indexing surveys in the survey store...")
+    start = time.perf_counter()
+    interrupted = survey_store.fail_interrupted()
+    if interrupted:
+        print(f"{interrupted} surveys were still processing when the server stopped, they were marked failed.")
+    surveys.build_index()
+    print(f"Indexed {len(surveys)} surveys total in {time.perf_counter() - start:.2f}s, they are loaded on first use.")
+    if os.path.isdir(FORMS_DIR):
+        pickled = [filename for filename in os.listdir(FORMS_DIR) if filename.endswith(".pkl") and filename.removesuffix(".pkl") not in surveys]
+        if pickled:
+            print(f"{len(pickled)} pickled surveys in {FORMS_DIR} are not in the store yet, run migrate_forms.py to copy them.")
\ No newline at end of file
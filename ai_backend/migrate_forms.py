@@ -0,0 +1,45 @@
+import argparse
+import os
+import pickle
+
+from survey_store import SurveyStore, SURVEY_DB_PATH, FORMS_DIR
+
+
+def migrate_forms(forms_dir: str, store: SurveyStore, overwrite: bool = False) -> dict:
+    """
+    Copies the surveys pickled in forms_dir/{id}.pkl into the survey store, the pickles are left in place.
+    Surveys already in the store are skipped unless overwrite is set, so it can be re-run.
+    """
+    migrated, skipped, failed = 0, 0, 0
+    for filename in sorted(os.listdir(forms_dir)):
+        if not filename.endswith(".pkl"):
+            continue
+        form_id = filename.removesuffix(".pkl")
+        if not overwrite and store.exists(form_id):
+            skipped += 1
+            continue
+        try:
+            with open(os.path.join(forms_dir, filename), "rb") as f:
+                survey_obj = pickle.load(f)
+            version = store.save(form_id, survey_obj)
+            # the images are in the store now, drop the in-memory copies
+            survey_obj.release_images()
+            print(f"Migrated survey {form_id} (version {version})")
+            migrated += 1
+        except Exception as e:
+            print(f"Error migrating {filename}: {e}")
+            failed += 1
+    return {"migrated": migrated, "skipped": skipped, "failed": failed}
+
+
+# run from ai_backend/ (the pickles reference the survey module):
+#   python migrate_forms.py [--forms-dir ./database/forms] [--db ./database/surveys.db] [--overwrite]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy pickled surveys into the survey store")
+    parser.add_argument("--forms-dir", default=FORMS_DIR)
+    parser.add_argument("--db", default=SURVEY_DB_PATH)
+    parser.add_argument("--overwrite", action="store_true", help="rewrite surveys that are already in the store")
+    args = parser.parse_args()
+
+    result = migrate_forms(args.forms_dir, SurveyStore(args.db), overwrite=args.overwrite)
+    print(f"Migrated {result['migrated']}, skipped {result['skipped']} already stored, {result['failed']} failed.")
@@ -0,0 +1,167 @@
+import asyncio
+import json
+from collections import OrderedDict
+from typing import AsyncIterator, Optional
+
+# events buffered per subscriber before it has to catch up from the history
+SUBSCRIBER_BUFFER = 64
+# events kept per convo for replay
+MAX_HISTORY = 2000
+# finished convos kept for replay
+MAX_FINISHED_STREAMS = 256
+# seconds between keep-alive comments on an idle stream
+KEEP_ALIVE = 15.0
+
+
+class _Subscriber:
+    def __init__(self, buffer: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=buffer)
+        # set when the subscriber fell behind and missed live events
+        self.overflowed = False
+
+
+class _ConvoStream:
+    def __init__(self):
+        self.events: list[dict] = []
+        # absolute offset of events[0] (older events were trimmed)
+        self.first_offset = 0
+        self.subscribers: set[_Subscriber] = set()
+        self.closed = False
+
+    @property
+    def next_offset(self) -> int:
+        return self.first_offset + len(self.events)
+
+    def replay(self, offset: int) -> list[dict]:
+        return self.events[max(0, offset - self.first_offset):]
+
+
+class ConvoEventBroker:
+    """
+    In-process pub/sub of conversation events.
+    Each convo keeps a bounded history (so late joiners can replay from an offset) and every
+    subscriber gets its own bounded buffer. A subscriber that falls behind is not allowed to
+    slow down the conversation: it is unsubscribed and catches up from the history instead.
+    """
+    def __init__(self, subscriber_buffer: int = SUBSCRIBER_BUFFER, max_history: int = MAX_HISTORY, max_finished: int = MAX_FINISHED_STREAMS):
+        self.subscriber_buffer = subscriber_buffer
+        self.max_history = max_history
+        self.max_finished = max_finished
+        self._streams: dict[str, _ConvoStream] = {}
+        self._finished: OrderedDict[str, None] = OrderedDict()
+
+    def _get_stream(self, convo_id: str) -> _ConvoStream:
+        if convo_id not in self._streams:
+            self._streams[convo_id] = _ConvoStream()
+        return self._streams[convo_id]
+
+    def open(self, convo_id: str):
+        """
+        Creates the convo's stream when the convo is scheduled, so viewers can subscribe before its first event.
+        Only convos that were opened (or published to) have a stream, subscribing to anything else is refused.
+        """
+        stream = self._streams.get(convo_id)
+        if stream is None or stream.closed:
+            # the convo id is being reused, start a new stream
+            self._finished.pop(convo_id, None)
+            self._streams[convo_id] = _ConvoStream()
+
+    def has_stream(self, convo_id: str) -> bool:
+        return convo_id in self._streams
+
+    def publish(self, convo_id: str, event: dict) -> int:
+        """
+        Appends the event to the convo's stream and fans it out, returns its offset.
+        """
+        stream = self._get_stream(convo_id)
+        if stream.closed:
+            # the convo id is being reused, start a new stream
+            self._finished.pop(convo_id, None)
+            stream = self._streams[convo_id] = _ConvoStream()
+        event = {"offset": stream.next_offset, **event}
+        stream.events.append(event)
+        if len(stream.events) > self.max_history:
+            trim = len(stream.events) - self.max_history
+            del stream.events[:trim]
+            stream.first_offset += trim
+        for subscriber in list(stream.subscribers):
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                subscriber.overflowed = True
+                stream.subscribers.discard(subscriber)
+        return event["offset"]
+
+    def close(self, convo_id: str):
+        """
+        Marks the end of the convo's stream, subscribers finish once they've read everything.
+        """
+        stream = self._get_stream(convo_id)
+        stream.closed = True
+        for subscriber in list(stream.subscribers):
+            try:
+                subscriber.queue.put_nowait(None)
+            except asyncio.QueueFull:
+                subscriber.overflowed = True
+        stream.subscribers.clear()
+        self._finished[convo_id] = None
+        self._finished.move_to_end(convo_id)
+        while len(self._finished) > self.max_finished:
+            old_convo_id, _ = self._finished.popitem(last=False)
+            self._streams.pop(old_convo_id, None)
+
+    async def subscribe(self, convo_id: str, offset: int = 0, keep_alive: Optional[float] = KEEP_ALIVE) -> AsyncIterator[Optional[dict]]:
+        """
+        Yields the convo's events starting at offset (history first, then live) until the stream closes.
+        Yields None when nothing happened for keep_alive seconds. Yields nothing for a convo without a stream.
+        """
+        stream = self._streams.get(convo_id)
+        if stream is None:
+            return
+        next_offset = offset
+        while True:
+            # snapshot the history and register in one step (no await) so no event is missed or repeated
+            backlog = stream.replay(next_offset)
+            subscriber = None
+            if not stream.closed:
+                subscriber = _Subscriber(self.subscriber_buffer)
+                stream.subscribers.add(subscriber)
+            try:
+                for event in backlog:
+                    next_offset = event["offset"] + 1
+                    yield event
+                if subscriber is None:
+                    return
+                while not subscriber.overflowed or not subscriber.queue.empty():
+                    try:
+                        event = await asyncio.wait_for(subscriber.queue.get(), timeout=keep_alive)
+                    except asyncio.TimeoutError:
+                        yield None
+                        continue
+                    if event is None:
+                        return
+                    if event["offset"] < next_offset:
+                        continue
+                    next_offset = event["offset"] + 1
+                    yield event
+            finally:
+                if subscriber is not None:
+                    stream.subscribers.discard(subscriber)
+            # fell behind, catch up from the history
+            stream = self._streams.get(convo_id, stream)
+
+    def stats(self) -> dict:
+        return {
+            "streams": len(self._streams),
+            "live_streams": sum(not stream.closed for stream in self._streams.values()),
+            "subscribers": sum(len(stream.subscribers) for stream in self._streams.values()),
+        }
+
+
+def format_sse(event: Optional[dict]) -> str:
+    if event is None:
+        return ": keep-alive\n\n"
+    return f"id: {event['offset']}\nevent: {event.get('type', 'message')}\ndata: {json.dumps(event)}\n\n"
+
+
+convo_events = ConvoEventBroker()
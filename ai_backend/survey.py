@@ -1,5 +1,10 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
 from util.gpt import LLM, ModelType
 from util.gemini import GeminiHandler
+from util.image_store import image_store
+from util.images import normalize_image
 
 
 SYSTEM_PROMPT = """
@@ -39,39 +44,222 @@ You are a image captioner. Given an image, you must caption it concisely. Do not
 
 image_captioner = GeminiHandler("gemini-2.0-flash")
 
+# seconds a survey gets for captioning its images and generating its profile
+SURVEY_DEADLINE = float(os.getenv("SURVEY_DEADLINE", "600"))
+
+
+class SurveyDeadlineExceeded(Exception):
+    pass
+
+
+# cold storage for the uploaded originals (see set_original_store), they are never held in memory
+_original_store = None
+
+def set_original_store(store):
+    """
+    store.put_original(ref, b64) writes an uploaded original, store.drop_originals(refs) deletes the
+    ones no saved survey uses. Without a store the originals are not kept.
+    """
+    global _original_store
+    _original_store = store
+
 
 class Survey:
-    def __init__(self, agent_id, results: dict):
+    def __init__(self, agent_id, results: dict, deadline: float = SURVEY_DEADLINE):
+        """
+        Captions every image and generates the profile at the same time (one thread per call),
+        raises SurveyDeadlineExceeded if they aren't all done within deadline seconds.
+        """
+        self._prepare(agent_id, results)
+        executor = ThreadPoolExecutor(max_workers=len(self.images) + 1)
+        try:
+            profile_future = executor.submit(LLM.message, SYSTEM_PROMPT, self.results, ModelType.GPT_O1)
+            caption_futures = [executor.submit(self._caption, image_ref) for image_ref in self.images]
+            _, not_done = wait([profile_future] + caption_futures, timeout=deadline)
+            if not_done:
+                raise SurveyDeadlineExceeded(f"Survey {agent_id} was not processed within {deadline}s")
+            self.image_captions = [future.result() for future in caption_futures]
+            self.profile = profile_future.result()
+        except BaseException:
+            self.discard_originals()
+            self.release_images()
+            raise
+        finally:
+            # don't wait for calls still running past the deadline
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._build_avail_images()
+
+    @classmethod
+    async def create_async(cls, agent_id, results: dict, deadline: float = SURVEY_DEADLINE) -> "Survey":
+        """
+        Async constructor, captions all images through the async Gemini API while the
+        (blocking) o1 profile call runs in a worker thread, so a survey takes about as long
+        as its slowest call. Raises SurveyDeadlineExceeded after deadline seconds.
+        """
+        survey = cls.__new__(cls)
+        try:
+            # decoding / resizing the images is cpu bound, keep it off the event loop
+            await asyncio.to_thread(survey._prepare, agent_id, results)
+            captions, survey.profile = await asyncio.wait_for(
+                asyncio.gather(
+                    asyncio.gather(*[survey._caption_async(image_ref) for image_ref in survey.images]),
+                    asyncio.to_thread(LLM.message, SYSTEM_PROMPT, survey.results, ModelType.GPT_O1),
+                ),
+                timeout=deadline,
+            )
+        except asyncio.TimeoutError:
+            survey.discard_originals()
+            survey.release_images()
+            # the o1 call can't be interrupted, its thread finishes in the background
+            raise SurveyDeadlineExceeded(f"Survey {agent_id} was not processed within {deadline}s")
+        except BaseException:
+            survey.discard_originals()
+            survey.release_images()
+            raise
+        survey.image_captions = list(captions)
+        survey._build_avail_images()
+        return survey
+
+    @staticmethod
+    def _caption(image_ref: str) -> str:
+        image_caption = image_captioner.send_multimodal_prompt_b64(IMAGE_CAPTIONER_SYSTEM_PROMPT, [image_store.get(image_ref)]).text
+        print(image_caption)
+        return image_caption
+
+    @staticmethod
+    async def _caption_async(image_ref: str) -> str:
+        image_caption = (await image_captioner.send_multimodal_prompt_b64_async(IMAGE_CAPTIONER_SYSTEM_PROMPT, [image_store.get(image_ref)])).text
+        print(image_caption)
+        return image_caption
+
+    @classmethod
+    def from_record(cls, agent_id, results: str, profile, images: list) -> "Survey":
+        """
+        Rebuilds an already processed survey (see survey_store.py) without loading its images.
+        images is a list of {"ref", "thumbnail_ref", "original_ref", "automated_caption", "user_description"},
+        the image data stays in the store and is read through the image store's loader when needed.
+        """
+        survey = cls.__new__(cls)
+        survey.agent_id = agent_id
+        survey.results = results
+        survey.profile = profile
+        survey.images = [image["ref"] for image in images]
+        survey.thumbnails = [image.get("thumbnail_ref") or image["ref"] for image in images]
+        survey.originals = [image.get("original_ref") or "" for image in images]
+        survey.image_captions = [image["automated_caption"] for image in images]
+        survey.user_descriptions = [image["user_description"] for image in images]
+        survey.holds_image_refs = False
+        survey._build_avail_images()
+        return survey
+
+    def _prepare(self, agent_id, results: dict):
         self.agent_id = agent_id
         self.results = results
+        # normalized images (sent to the models), their thumbnails (sent to viewers) and the
+        # uploaded originals (only kept in the survey store's cold storage)
         self.images = []
+        self.thumbnails = []
+        self.originals = []
         self.image_captions = []
         self.user_descriptions = []
+        # the images are put in the image store and this survey holds a reference on each
+        self.holds_image_refs = True
         # remove b64 images
         if "Pictures (base64)" in self.results:
-            # get the images
-            self.images = self.results["Pictures (base64)"]
+            # get the images, they are kept in the shared image store and referenced by hash
+            for b64_image in self.results["Pictures (base64)"]:
+                self._add_image(b64_image)
             self.user_descriptions = self.results["Captions"]
             # remove them from the dict
             del results["Captions"]
             del results["Pictures (base64)"]
-        if len(self.images) > 0:
-            # there's images so caption all of them
-            for b64_image in self.images:
-                image_caption = image_captioner.send_multimodal_prompt_b64(IMAGE_CAPTIONER_SYSTEM_PROMPT, [b64_image]).text
-                print(image_caption)
-                self.image_captions.append(image_caption)
         self.results = str(results)
-        # build avail_images
+
+    def _add_image(self, b64_image: str):
+        try:
+            normalized = normalize_image(b64_image)
+        except ValueError as e:
+            print(f"Keeping an image of survey {self.agent_id} as uploaded: {e}")
+            image_ref = image_store.put(b64_image)
+            self.images.append(image_ref)
+            image_store.acquire(image_ref)
+            self.thumbnails.append(image_ref)
+            self.originals.append("")
+            return
+        self.images.append(image_store.put(normalized.b64))
+        self.thumbnails.append(image_store.put(normalized.thumbnail_b64))
+        self.originals.append(self._store_original(b64_image))
+
+    @staticmethod
+    def _store_original(b64_image: str) -> str:
+        # written straight to cold storage, only the normalized image and thumbnail go in the image store
+        if _original_store is None:
+            return ""
+        original_ref = image_store.ref_for(b64_image)
+        _original_store.put_original(original_ref, b64_image)
+        return original_ref
+
+    def discard_originals(self):
+        """
+        Deletes the originals written for this survey from cold storage, for a survey that won't be saved
+        (originals a saved survey also uses are kept).
+        """
+        original_refs = [original_ref for original_ref in getattr(self, "originals", []) if original_ref]
+        if _original_store is not None and original_refs:
+            _original_store.drop_originals(original_refs)
+
+    def _build_avail_images(self):
         self.avail_images = {}
         for i in range(len(self.images)):
             self.avail_images[f"image_{i}"] = {
                 "automated_caption": self.image_captions[i],
                 "user_description": self.user_descriptions[i],
-                "b64": self.images[i]
+                "ref": self.images[i],
+                "thumbnail_ref": self.thumbnails[i],
+                "original_ref": self.originals[i],
             }
-        # get the json results
-        self.profile = LLM.message(SYSTEM_PROMPT, self.results, ModelType.GPT_O1)
+
+    def get_image_b64(self, image_key: str) -> str:
+        """
+        Returns the base64 data of an available image (e.g. "image_0").
+        """
+        return image_store.get(self.avail_images[image_key]["ref"])
+
+    def release_images(self):
+        """
+        Drops this survey's references in the image store.
+        """
+        if getattr(self, "holds_image_refs", True):
+            for image_ref in getattr(self, "images", []) + getattr(self, "thumbnails", []):
+                image_store.release(image_ref)
+        self.images = []
+        self.thumbnails = []
+        self.originals = []
+
+    def __getstate__(self):
+        # the image store only lives in memory, so pickle the image data with the survey
+        state = self.__dict__.copy()
+        state.pop("thumbnails", None)
+        state.pop("originals", None)
+        state["image_data"] = [image_store.get(image_ref) for image_ref in self.images]
+        return state
+
+    def __setstate__(self, state):
+        image_data = state.pop("image_data", None)
+        if image_data is None:
+            # surveys pickled before the image store kept the b64 strings directly
+            image_data = state["images"]
+        self.__dict__.update(state)
+        self.images = [image_store.put(b64_image) for b64_image in image_data]
+        # only the model images are pickled, they double as thumbnails
+        self.thumbnails = []
+        self.originals = []
+        self.holds_image_refs = True
+        for key, image_ref in zip(self.avail_images, self.images):
+            self.avail_images[key].pop("b64", None)
+            self.avail_images[key]["ref"] = image_ref
+            self.avail_images[key]["thumbnail_ref"] = image_ref
+            self.avail_images[key]["original_ref"] = ""
 
     def get_profile_matrix(self)->dict:
         return self.profile
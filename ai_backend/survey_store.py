@@ -0,0 +1,679 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from survey import Survey
+from util.image_store import image_store
+
+# sqlite database holding every processed survey
+SURVEY_DB_PATH = os.getenv("SURVEY_DB_PATH", "./database/surveys.db")
+# surveys pickled by older versions, copy them into the store with migrate_forms.py
+FORMS_DIR = "./database/forms"
+# surveys kept in memory by the survey cache (the least recently used ones are evicted first)
+SURVEY_CACHE_SIZE = int(os.getenv("SURVEY_CACHE_SIZE", "1024"))
+SURVEY_CACHE_MB = int(os.getenv("SURVEY_CACHE_MB", "64"))
+
+# survey statuses, a survey is "processing" while its images are captioned and its profile generated
+PROCESSING = "processing"
+READY = "ready"
+FAILED = "failed"
+
+# schema migrations, MIGRATIONS[i] upgrades the database from version i to i + 1
+# (the version is kept in PRAGMA user_version), only ever append to this list
+MIGRATIONS = [
+    """
+    CREATE TABLE surveys (
+        id TEXT PRIMARY KEY,
+        agent_id TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        profile TEXT,
+        results TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE TABLE survey_images (
+        survey_id TEXT NOT NULL REFERENCES surveys(id) ON DELETE CASCADE,
+        position INTEGER NOT NULL,
+        image_ref TEXT NOT NULL,
+        automated_caption TEXT NOT NULL,
+        user_description TEXT NOT NULL,
+        PRIMARY KEY (survey_id, position)
+    );
+    CREATE INDEX survey_images_ref ON survey_images(image_ref);
+    CREATE TABLE images (
+        ref TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        size INTEGER NOT NULL
+    );
+    """,
+    """
+    ALTER TABLE surveys ADD COLUMN status TEXT NOT NULL DEFAULT 'ready';
+    ALTER TABLE surveys ADD COLUMN error TEXT;
+    CREATE INDEX surveys_status ON surveys(status);
+    """,
+    """
+    CREATE TABLE ingest_batches (
+        batch_id TEXT NOT NULL,
+        survey_id TEXT NOT NULL,
+        PRIMARY KEY (batch_id, survey_id)
+    );
+    """,
+    """
+    ALTER TABLE survey_images ADD COLUMN thumbnail_ref TEXT;
+    ALTER TABLE survey_images ADD COLUMN original_ref TEXT;
+    CREATE INDEX survey_images_thumbnail ON survey_images(thumbnail_ref);
+    CREATE INDEX survey_images_original ON survey_images(original_ref);
+    CREATE TABLE original_images (
+        ref TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        size INTEGER NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE convo_results (
+        convo_id TEXT PRIMARY KEY,
+        speaker_1_id TEXT NOT NULL,
+        speaker_2_id TEXT NOT NULL,
+        speaker_1_score INTEGER NOT NULL,
+        speaker_1_analysis TEXT NOT NULL,
+        speaker_2_score INTEGER NOT NULL,
+        speaker_2_analysis TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        evaluated_at REAL NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE tournaments (
+        tournament_id TEXT PRIMARY KEY,
+        top_k INTEGER NOT NULL,
+        users INTEGER NOT NULL,
+        total_pairs INTEGER NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE TABLE tournament_pairs (
+        tournament_id TEXT NOT NULL REFERENCES tournaments(tournament_id) ON DELETE CASCADE,
+        convo_id TEXT NOT NULL,
+        speaker_1_id TEXT NOT NULL,
+        speaker_2_id TEXT NOT NULL,
+        prescreen_score REAL NOT NULL,
+        PRIMARY KEY (tournament_id, convo_id)
+    );
+    """,
+]
+
+
+class SurveyStore:
+    """
+    Versioned survey storage on top of sqlite.
+    Profiles and metadata live in the surveys table, image blobs in their own table keyed by
+    content hash (the image store reference), so a survey is loaded without its images and an
+    image shared by several surveys is stored once. The uploaded originals are kept apart in cold
+    storage (original_images), only the normalized images and thumbnails are ever read back. Every write is a single transaction and
+    bumps the survey's version. A survey id is claimed (status "processing") before the survey is
+    processed, only "ready" surveys are loaded / listed.
+    Conversation evaluations are kept in convo_results, so they are computed once and not per read,
+    tournaments (pre-screened candidate pairs) in tournaments / tournament_pairs.
+    """
+    def __init__(self, path: str = SURVEY_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._migrate()
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads, keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _migrate(self):
+        with self._transaction() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for i in range(version, len(MIGRATIONS)):
+                for statement in MIGRATIONS[i].split(";"):
+                    if statement.strip():
+                        conn.execute(statement)
+            if version < len(MIGRATIONS):
+                conn.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+
+    @property
+    def schema_version(self) -> int:
+        return self._connect().execute("PRAGMA user_version").fetchone()[0]
+
+    @staticmethod
+    def _image_data(survey: Survey, ref: str) -> str:
+        b64_image = image_store.get(ref)
+        if b64_image is None:
+            raise ValueError(f"Image {ref} of survey {survey.agent_id} is not in the image store")
+        return b64_image
+
+    def _image_rows(self, survey: Survey) -> list:
+        rows = []
+        for position, details in enumerate(survey.avail_images.values()):
+            thumbnail_ref = details.get("thumbnail_ref") or details["ref"]
+            original_ref = details.get("original_ref") or None
+            # originals are already in cold storage (put_original), they are only referenced here
+            rows.append((
+                position, details["ref"], thumbnail_ref, original_ref, details["automated_caption"], details["user_description"],
+                self._image_data(survey, details["ref"]),
+                self._image_data(survey, thumbnail_ref),
+            ))
+        return rows
+
+    @staticmethod
+    def _image_refs(conn: sqlite3.Connection, survey_id: str) -> tuple[list, list]:
+        refs, original_refs = [], []
+        for image_ref, thumbnail_ref, original_ref in conn.execute(
+            "SELECT image_ref, thumbnail_ref, original_ref FROM survey_images WHERE survey_id = ?", (survey_id,)
+        ):
+            refs += [image_ref, thumbnail_ref]
+            original_refs.append(original_ref)
+        return refs, original_refs
+
+    def _write(self, conn: sqlite3.Connection, survey_id: str, survey: Survey, image_rows: list) -> int:
+        now = time.time()
+        old_refs, old_original_refs = self._image_refs(conn, survey_id)
+        row = conn.execute("SELECT version FROM surveys WHERE id = ?", (survey_id,)).fetchone()
+        version = 1 if row is None else row[0] + 1
+        conn.execute(
+            """
+            INSERT INTO surveys (id, agent_id, version, profile, results, created_at, updated_at, status, error)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL)
+            ON CONFLICT(id) DO UPDATE SET agent_id = excluded.agent_id, version = excluded.version,
+                profile = excluded.profile, results = excluded.results, updated_at = excluded.updated_at,
+                status = excluded.status, error = NULL
+            """,
+            (survey_id, str(survey.agent_id), version, survey.profile, survey.results, now, now, READY),
+        )
+        conn.execute("DELETE FROM survey_images WHERE survey_id = ?", (survey_id,))
+        for position, ref, thumbnail_ref, original_ref, automated_caption, user_description, b64_image, thumbnail_b64 in image_rows:
+            conn.execute("INSERT OR IGNORE INTO images (ref, data, size) VALUES (?, ?, ?)", (ref, b64_image, len(b64_image)))
+            conn.execute("INSERT OR IGNORE INTO images (ref, data, size) VALUES (?, ?, ?)", (thumbnail_ref, thumbnail_b64, len(thumbnail_b64)))
+            conn.execute(
+                """
+                INSERT INTO survey_images (survey_id, position, image_ref, thumbnail_ref, original_ref, automated_caption, user_description)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (survey_id, position, ref, thumbnail_ref, original_ref, automated_caption, user_description),
+            )
+        self._drop_orphan_images(conn, old_refs, old_original_refs)
+        return version
+
+    @staticmethod
+    def _drop_orphan_images(conn: sqlite3.Connection, refs: list, original_refs: list):
+        for ref in set(refs) - {None}:
+            conn.execute(
+                "DELETE FROM images WHERE ref = ? AND NOT EXISTS (SELECT 1 FROM survey_images WHERE image_ref = ? OR thumbnail_ref = ?)",
+                (ref, ref, ref),
+            )
+        for ref in set(original_refs) - {None}:
+            conn.execute(
+                "DELETE FROM original_images WHERE ref = ? AND NOT EXISTS (SELECT 1 FROM survey_images WHERE original_ref = ?)",
+                (ref, ref),
+            )
+
+    def put_original(self, ref: str, b64_image: str):
+        """
+        Writes an uploaded original to cold storage while its survey is being processed,
+        the survey references it once it is saved.
+        """
+        with self._transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO original_images (ref, data, size) VALUES (?, ?, ?)", (ref, b64_image, len(b64_image)))
+
+    def drop_originals(self, refs: list):
+        """
+        Deletes originals of a survey that was never saved, unless a saved survey uses them.
+        """
+        with self._transaction() as conn:
+            self._drop_orphan_images(conn, [], refs)
+
+    def save(self, survey_id: str, survey: Survey) -> int:
+        """
+        Writes (or overwrites) the survey and its images atomically, returns the survey's new version.
+        """
+        image_rows = self._image_rows(survey)
+        with self._transaction() as conn:
+            return self._write(conn, survey_id, survey, image_rows)
+
+    def save_many(self, items: list) -> int:
+        """
+        Writes a list of (survey_id, survey) in a single transaction, returns how many were written.
+        """
+        rows = [(survey_id, survey, self._image_rows(survey)) for survey_id, survey in items]
+        with self._transaction() as conn:
+            for survey_id, survey, image_rows in rows:
+                self._write(conn, survey_id, survey, image_rows)
+        return len(rows)
+
+    def claim(self, survey_id: str) -> bool:
+        """
+        Marks the survey as processing, unless it is already processing or ready.
+        Returns whether the caller got the claim and should process the survey.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT status FROM surveys WHERE id = ?", (survey_id,)).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT INTO surveys (id, agent_id, version, profile, results, created_at, updated_at, status) VALUES (?, ?, 0, NULL, '', ?, ?, ?)",
+                    (survey_id, survey_id, now, now, PROCESSING),
+                )
+                return True
+            if row[0] != FAILED:
+                return False
+            conn.execute("UPDATE surveys SET status = ?, error = NULL, updated_at = ? WHERE id = ?", (PROCESSING, now, survey_id))
+            return True
+
+    def mark_failed(self, survey_id: str, error: str):
+        """
+        Records why processing a claimed survey failed, the id can be claimed again.
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE surveys SET status = ?, error = ?, updated_at = ? WHERE id = ? AND status = ?",
+                (FAILED, error, time.time(), survey_id, PROCESSING),
+            )
+
+    def fail_interrupted(self) -> int:
+        """
+        Marks surveys left processing by a previous run as failed, call at startup. Returns how many.
+        """
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE surveys SET status = ?, error = 'interrupted by a restart', updated_at = ? WHERE status = ?",
+                (FAILED, time.time(), PROCESSING),
+            ).rowcount
+
+    @staticmethod
+    def _status(row: tuple) -> dict:
+        survey_id, status, version, error, updated_at = row
+        return {"id": survey_id, "status": status, "version": version, "error": error, "updated_at": updated_at}
+
+    def get_status(self, survey_id: str) -> Optional[dict]:
+        row = self._connect().execute(
+            "SELECT id, status, version, error, updated_at FROM surveys WHERE id = ?", (survey_id,)
+        ).fetchone()
+        return None if row is None else self._status(row)
+
+    def add_to_batch(self, batch_id: str, survey_ids: list):
+        """
+        Records which surveys were submitted in an ingestion batch (adding to an existing batch is allowed).
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO ingest_batches (batch_id, survey_id) VALUES (?, ?)",
+                [(batch_id, survey_id) for survey_id in survey_ids],
+            )
+
+    def get_batch(self, batch_id: str) -> list[dict]:
+        """
+        Status of every survey of an ingestion batch, empty if there is no such batch.
+        """
+        rows = self._connect().execute(
+            """
+            SELECT s.id, s.status, s.version, s.error, s.updated_at FROM ingest_batches b
+            JOIN surveys s ON s.id = b.survey_id WHERE b.batch_id = ? ORDER BY s.id
+            """,
+            (batch_id,),
+        )
+        return [self._status(row) for row in rows]
+
+    def delete(self, survey_id: str) -> bool:
+        with self._transaction() as conn:
+            refs, original_refs = self._image_refs(conn, survey_id)
+            deleted = conn.execute("DELETE FROM surveys WHERE id = ?", (survey_id,)).rowcount > 0
+            self._drop_orphan_images(conn, refs, original_refs)
+        return deleted
+
+    @staticmethod
+    def _to_survey(row: tuple, images: list) -> Survey:
+        _, agent_id, _, profile, results = row
+        return Survey.from_record(agent_id, results, profile, images)
+
+    @staticmethod
+    def _image_details(ref: str, thumbnail_ref: Optional[str], original_ref: Optional[str], automated_caption: str, user_description: str) -> dict:
+        return {
+            "ref": ref,
+            "thumbnail_ref": thumbnail_ref,
+            "original_ref": original_ref,
+            "automated_caption": automated_caption,
+            "user_description": user_description,
+        }
+
+    def load(self, survey_id: str) -> Optional[Survey]:
+        """
+        Loads a survey without its image data, returns None if there is no such survey.
+        """
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT id, agent_id, version, profile, results FROM surveys WHERE id = ? AND status = ?", (survey_id, READY)
+        ).fetchone()
+        if row is None:
+            return None
+        images = [
+            self._image_details(*image_row)
+            for image_row in conn.execute(
+                """
+                SELECT image_ref, thumbnail_ref, original_ref, automated_caption, user_description
+                FROM survey_images WHERE survey_id = ? ORDER BY position
+                """,
+                (survey_id,),
+            )
+        ]
+        return self._to_survey(row, images)
+
+    def iter_surveys(self) -> Iterator[tuple]:
+        """
+        Yields (survey_id, survey) for every stored survey (without image data), in id order.
+        """
+        conn = self._connect()
+        images: dict[str, list] = {}
+        for survey_id, *image_row in conn.execute(
+            """
+            SELECT survey_id, image_ref, thumbnail_ref, original_ref, automated_caption, user_description
+            FROM survey_images ORDER BY survey_id, position
+            """
+        ):
+            images.setdefault(survey_id, []).append(self._image_details(*image_row))
+        for row in conn.execute("SELECT id, agent_id, version, profile, results FROM surveys WHERE status = ? ORDER BY id", (READY,)):
+            yield row[0], self._to_survey(row, images.get(row[0], []))
+
+    def exists(self, survey_id: str) -> bool:
+        """
+        Whether the survey is stored and ready.
+        """
+        return self._connect().execute("SELECT 1 FROM surveys WHERE id = ? AND status = ?", (survey_id, READY)).fetchone() is not None
+
+    def get_version(self, survey_id: str) -> Optional[int]:
+        row = self._connect().execute("SELECT version FROM surveys WHERE id = ?", (survey_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def list_ids(self, after: Optional[str] = None, limit: Optional[int] = None) -> list[str]:
+        """
+        Ids of the ready surveys in order, page with after (the last id of the previous page) and limit.
+        """
+        query = "SELECT id FROM surveys WHERE status = ?"
+        params = [READY]
+        if after is not None:
+            query += " AND id > ?"
+            params.append(after)
+        query += " ORDER BY id"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return [row[0] for row in self._connect().execute(query, params)]
+
+    def count(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM surveys WHERE status = ?", (READY,)).fetchone()[0]
+
+    def count_by_status(self) -> dict:
+        return dict(self._connect().execute("SELECT status, COUNT(*) FROM surveys GROUP BY status").fetchall())
+
+    def get_image(self, ref: str) -> Optional[str]:
+        """
+        Returns the stored base64 image for ref, used as the image store's loader.
+        """
+        row = self._connect().execute("SELECT data FROM images WHERE ref = ?", (ref,)).fetchone()
+        return None if row is None else row[0]
+
+    def get_original_image(self, ref: str) -> Optional[str]:
+        """
+        Returns an uploaded original from cold storage.
+        """
+        row = self._connect().execute("SELECT data FROM original_images WHERE ref = ?", (ref,)).fetchone()
+        return None if row is None else row[0]
+
+    def save_results(self, convo_id: str, results: dict) -> int:
+        """
+        Writes (or overwrites, on a re-evaluation) a conversation's evaluation, returns its new version.
+        results has the ConvoResults fields.
+        """
+        with self._transaction() as conn:
+            row = conn.execute("SELECT version FROM convo_results WHERE convo_id = ?", (convo_id,)).fetchone()
+            version = 1 if row is None else row[0] + 1
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO convo_results (convo_id, speaker_1_id, speaker_2_id, speaker_1_score, speaker_1_analysis,
+                    speaker_2_score, speaker_2_analysis, version, evaluated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    convo_id, results["speaker_1_id"], results["speaker_2_id"],
+                    results["speaker_1_compatability_with_speaker_2"], results["speaker_1_analysis"],
+                    results["speaker_2_compatability_with_speaker_1"], results["speaker_2_analysis"],
+                    version, time.time(),
+                ),
+            )
+        return version
+
+    def load_results(self, convo_id: str) -> Optional[dict]:
+        """
+        Returns a conversation's stored evaluation (ConvoResults fields plus version / evaluated_at), or None.
+        """
+        row = self._connect().execute(
+            """
+            SELECT speaker_1_id, speaker_2_id, speaker_1_score, speaker_1_analysis, speaker_2_score, speaker_2_analysis,
+                version, evaluated_at
+            FROM convo_results WHERE convo_id = ?
+            """,
+            (convo_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        speaker_1_id, speaker_2_id, speaker_1_score, speaker_1_analysis, speaker_2_score, speaker_2_analysis, version, evaluated_at = row
+        return {
+            "speaker_1_id": speaker_1_id,
+            "speaker_2_id": speaker_2_id,
+            "speaker_1_compatability_with_speaker_2": speaker_1_score,
+            "speaker_1_analysis": speaker_1_analysis,
+            "speaker_2_compatability_with_speaker_1": speaker_2_score,
+            "speaker_2_analysis": speaker_2_analysis,
+            "version": version,
+            "evaluated_at": evaluated_at,
+        }
+
+    def create_tournament(self, tournament_id: str, top_k: int, users: int, total_pairs: int, pairs: list):
+        """
+        Records a tournament and its candidate pairs, a list of (convo_id, speaker_1_id, speaker_2_id, prescreen_score).
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO tournaments (tournament_id, top_k, users, total_pairs, created_at) VALUES (?, ?, ?, ?, ?)",
+                (tournament_id, top_k, users, total_pairs, time.time()),
+            )
+            conn.executemany(
+                """
+                INSERT INTO tournament_pairs (tournament_id, convo_id, speaker_1_id, speaker_2_id, prescreen_score)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                [(tournament_id, *pair) for pair in pairs],
+            )
+
+    def get_tournament(self, tournament_id: str) -> Optional[dict]:
+        """
+        The tournament and its candidate pairs with their stored results (None for pairs not evaluated yet).
+        """
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT top_k, users, total_pairs, created_at FROM tournaments WHERE tournament_id = ?", (tournament_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        top_k, users, total_pairs, created_at = row
+        pairs = [
+            {
+                "convo_id": convo_id,
+                "speaker_1_id": speaker_1_id,
+                "speaker_2_id": speaker_2_id,
+                "prescreen_score": prescreen_score,
+                "speaker_1_score": speaker_1_score,
+                "speaker_2_score": speaker_2_score,
+            }
+            for convo_id, speaker_1_id, speaker_2_id, prescreen_score, speaker_1_score, speaker_2_score in conn.execute(
+                """
+                SELECT p.convo_id, p.speaker_1_id, p.speaker_2_id, p.prescreen_score, r.speaker_1_score, r.speaker_2_score
+                FROM tournament_pairs p LEFT JOIN convo_results r ON r.convo_id = p.convo_id
+                WHERE p.tournament_id = ? ORDER BY p.prescreen_score DESC
+                """,
+                (tournament_id,),
+            )
+        ]
+        return {
+            "tournament_id": tournament_id,
+            "top_k": top_k,
+            "users": users,
+            "total_pairs": total_pairs,
+            "created_at": created_at,
+            "pairs": pairs,
+        }
+
+    def stats(self) -> dict:
+        conn = self._connect()
+        images, image_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images").fetchone()
+        originals, original_bytes = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM original_images").fetchone()
+        convo_results = conn.execute("SELECT COUNT(*) FROM convo_results").fetchone()[0]
+        return {
+            "path": self.path,
+            "schema_version": self.schema_version,
+            "surveys": self.count_by_status(),
+            "images": images,
+            "image_b64_chars": image_bytes,
+            "original_images": originals,
+            "original_b64_chars": original_bytes,
+            "convo_results": convo_results,
+        }
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class SurveyCache:
+    """
+    Loads surveys from the store on first use and keeps them in a bounded LRU cache
+    (by count and approximate size), cold surveys are evicted.
+    Every stored id is indexed in memory at startup so existence checks never hit the disk.
+    """
+    def __init__(self, store: SurveyStore, max_entries: int = SURVEY_CACHE_SIZE, max_bytes: int = SURVEY_CACHE_MB * 1024 * 1024):
+        self.store = store
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._ids: set[str] = set()
+        self._surveys: OrderedDict[str, tuple[Survey, int]] = OrderedDict()
+        self._bytes = 0
+        self._load_times: deque = deque(maxlen=1000)
+        self._lock = threading.Lock()
+
+    def build_index(self) -> int:
+        """
+        Indexes the ids of every stored survey, returns how many there are.
+        """
+        ids = set(self.store.list_ids())
+        with self._lock:
+            self._ids = ids
+        return len(ids)
+
+    def __contains__(self, survey_id: str) -> bool:
+        return survey_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, survey_id: str):
+        """
+        Indexes a survey that was just written to the store (and drops any stale cached copy).
+        """
+        with self._lock:
+            self._ids.add(survey_id)
+            self._pop(survey_id)
+
+    def _pop(self, survey_id: str):
+        cached = self._surveys.pop(survey_id, None)
+        if cached is not None:
+            self._bytes -= cached[1]
+
+    @staticmethod
+    def _size(survey: Survey) -> int:
+        size = len(survey.results) + len(survey.profile or "")
+        for details in survey.avail_images.values():
+            size += len(details["ref"]) + len(details["automated_caption"]) + len(details["user_description"])
+        return size
+
+    def get(self, survey_id: str) -> Optional[Survey]:
+        """
+        Returns the survey, loading it from the store on a miss. None if there is no such survey.
+        """
+        if survey_id not in self._ids:
+            return None
+        with self._lock:
+            cached = self._surveys.get(survey_id)
+            if cached is not None:
+                self._surveys.move_to_end(survey_id)
+                self.hits += 1
+                return cached[0]
+        start = time.perf_counter()
+        survey = self.store.load(survey_id)
+        with self._lock:
+            self.misses += 1
+            self._load_times.append(time.perf_counter() - start)
+            if survey is None:
+                self._ids.discard(survey_id)
+                return None
+            if survey_id not in self._surveys:
+                size = self._size(survey)
+                self._surveys[survey_id] = (survey, size)
+                self._bytes += size
+                self._evict()
+        return survey
+
+    def __getitem__(self, survey_id: str) -> Survey:
+        survey = self.get(survey_id)
+        if survey is None:
+            raise KeyError(survey_id)
+        return survey
+
+    def _evict(self):
+        while self._surveys and (len(self._surveys) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, size) = self._surveys.popitem(last=False)
+            self._bytes -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            load_times = sorted(self._load_times)
+            return {
+                "ids": len(self._ids),
+                "entries": len(self._surveys),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "load_avg": sum(load_times) / len(load_times) if load_times else 0.0,
+                "load_p95": load_times[min(len(load_times) - 1, int(len(load_times) * 0.95))] if load_times else 0.0,
+            }
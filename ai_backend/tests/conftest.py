@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# the backend modules import each other relative to ai_backend/, the sync script lives at the repo root
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [BACKEND_DIR, os.path.dirname(BACKEND_DIR)]
+
+# the model clients check for their keys at import, the tests never reach the providers
+os.environ.setdefault("API_KEY_GEMINI", "test")
+os.environ.setdefault("API_KEY_OPENAI", "test")
+os.environ.setdefault("GEMINI_CONTEXT_CACHE", "0")
+# main opens the survey store at import, keep it away from database/
+os.environ.setdefault("SURVEY_DB_PATH", os.path.join(tempfile.mkdtemp(), "surveys.db"))
@@ -0,0 +1,69 @@
+from util.gemini import InlineContextCache
+
+
+class CountingCache(InlineContextCache):
+    def __init__(self):
+        super().__init__()
+        self.created = []
+        self.deleted = []
+
+    def _create(self, model_name, key, prefix):
+        handle = super()._create(model_name, key, prefix)
+        self.created.append(handle)
+        return handle
+
+    def _delete(self, handle):
+        self.deleted.append(handle)
+
+
+def test_identical_prefixes_share_one_handle():
+    cache = CountingCache()
+    first = cache.register("model", "static prompt")
+    second = cache.register("model", "static prompt")
+    assert first is second
+    assert len(cache.created) == 1
+    assert cache._refs[first.key] == 2
+
+
+def test_prefix_is_keyed_by_model():
+    cache = CountingCache()
+    assert cache.register("model-a", "static prompt").key != cache.register("model-b", "static prompt").key
+
+
+def test_handle_is_deleted_with_its_last_reference():
+    cache = CountingCache()
+    handle = cache.register("model", "static prompt")
+    cache.register("model", "static prompt")
+    cache.release(handle)
+    assert cache.deleted == []
+    cache.release(handle)
+    assert cache.deleted == [handle]
+    assert handle.key not in cache._prefixes
+    # releasing again is a no-op
+    cache.release(handle)
+    assert cache.deleted == [handle]
+
+
+def test_register_after_release_creates_a_new_handle():
+    cache = CountingCache()
+    cache.release(cache.register("model", "static prompt"))
+    cache.register("model", "static prompt")
+    assert len(cache.created) == 2
+
+
+def test_concurrent_registration_keeps_the_first_stored_handle():
+    cache = CountingCache()
+    create = cache._create
+
+    def racing_create(model_name, key, prefix):
+        handle = create(model_name, key, prefix)
+        if len(cache.created) == 1:
+            # another caller registers the same prefix while this handle is being created
+            cache.register(model_name, prefix)
+        return handle
+
+    cache._create = racing_create
+    handle = cache.register("model", "static prompt")
+    assert handle is cache.created[1]
+    assert cache.deleted == [cache.created[0]]
+    assert cache._refs[handle.key] == 2
@@ -0,0 +1,38 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import main
+from test_evaluation import VALID, make_evaluator
+
+
+def test_results_are_evaluated_once_and_served_from_the_store():
+    evaluator = make_evaluator(VALID)
+
+    async def scenario():
+        # concurrent requests share one evaluation
+        return await asyncio.gather(*[main.evaluate_convo("evaluated-once", evaluator) for _ in range(3)])
+
+    results = asyncio.run(scenario())
+    assert evaluator.stats["calls"] == 1
+    assert [result["speaker_1_compatability_with_speaker_2"] for result in results] == [8, 8, 8]
+    stored = asyncio.run(main.evaluate_convo("evaluated-once", evaluator))
+    assert stored["version"] == 1
+    assert evaluator.stats["calls"] == 1
+
+
+def test_forced_evaluation_replaces_the_stored_results():
+    evaluator = make_evaluator(VALID, VALID.replace("8", "3"))
+    asyncio.run(main.evaluate_convo("reevaluated", evaluator))
+    results = asyncio.run(main.evaluate_convo("reevaluated", evaluator, force=True))
+    assert results["speaker_1_compatability_with_speaker_2"] == 3
+    assert main.survey_store.load_results("reevaluated")["version"] == 2
+
+
+def test_endpoint_serves_stored_results():
+    client = TestClient(main.app)
+    asyncio.run(main.evaluate_convo("served", make_evaluator(VALID)))
+    response = client.get("/get_compatability_for_convo", params={"convo_id": "served"})
+    assert response.status_code == 200
+    assert response.json()["speaker_2_analysis"] == "ok"
+    assert client.get("/get_compatability_for_convo", params={"convo_id": "unknown"}).status_code == 400
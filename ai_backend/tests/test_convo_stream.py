@@ -0,0 +1,48 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import main
+from jobs import CANCELLED, JobManager
+
+
+async def collect(convo_id: str) -> list:
+    return [event async for event in main.convo_events.subscribe(convo_id, keep_alive=None)]
+
+
+def test_unknown_convos_are_not_found():
+    assert TestClient(main.app).get("/stream/never-started").status_code == 404
+
+
+def test_reconnecting_resumes_after_the_last_event_id():
+    for turn in range(3):
+        main.convo_events.publish("reconnect", {"type": "message", "turn": turn})
+    main.convo_events.close("reconnect")
+    response = TestClient(main.app).get("/stream/reconnect", headers={"Last-Event-ID": "0"})
+    assert response.status_code == 200
+    assert [line for line in response.text.splitlines() if line.startswith("id: ")] == ["id: 1", "id: 2"]
+
+
+def test_cancelling_a_queued_convo_ends_its_stream():
+    async def scenario():
+        # one worker busy with another convo, so the watched one stays queued
+        convo_jobs = JobManager(num_workers=1, on_cancel=main._end_cancelled_convo)
+        release = asyncio.Event()
+
+        async def run(job):
+            await release.wait()
+
+        convo_jobs.submit("busy", run)
+        main.convo_events.open("queued")
+        job = convo_jobs.submit("queued", run)
+        subscriber = asyncio.create_task(asyncio.wait_for(collect("queued"), timeout=5))
+        await asyncio.sleep(0)
+        assert convo_jobs.cancel(job.job_id)
+        events = await subscriber
+        release.set()
+        await convo_jobs.stop()
+        return job, events
+
+    job, events = asyncio.run(scenario())
+    assert job.status == CANCELLED
+    assert [event["type"] for event in events] == ["cancelled"]
@@ -0,0 +1,125 @@
+import asyncio
+
+import httpx
+import pytest
+
+import delivery
+from delivery import FrontEndDelivery
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(delivery.random, "uniform", lambda a, b: 0)
+
+
+def front_end(*statuses, **settings):
+    """
+    A delivery posting to a fake front end that answers with the given statuses (200 once they run out).
+    Returns the delivery and the list of bodies it received.
+    """
+    statuses = list(statuses)
+    received = []
+
+    def handler(request):
+        received.append(request.read())
+        status = statuses.pop(0) if statuses else 200
+        if isinstance(status, Exception):
+            raise status
+        return httpx.Response(status)
+
+    front = FrontEndDelivery(url="http://front.end/chat", **settings)
+    front._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return front, received
+
+
+async def drain(front: FrontEndDelivery, convo_id: str):
+    worker = front._workers.get(convo_id)
+    front.close_convo(convo_id)
+    if worker is not None:
+        await worker
+
+
+def test_events_are_posted_in_order_and_the_worker_stops_when_drained():
+    async def scenario():
+        front, received = front_end()
+        for turn in range(3):
+            front.enqueue("c", {"turn": turn}, required=True)
+        await drain(front, "c")
+        return front, received
+
+    front, received = asyncio.run(scenario())
+    assert received == [b'{"turn":0}', b'{"turn":1}', b'{"turn":2}']
+    metrics = front.metrics()
+    assert (metrics["delivered"], metrics["posts"], metrics["active_convos"]) == (3, 3, 0)
+
+
+def test_batches_are_posted_as_one_events_body():
+    async def scenario():
+        front, received = front_end(batch_size=2)
+        for turn in range(3):
+            front.enqueue("c", {"turn": turn})
+        await drain(front, "c")
+        return front, received
+
+    front, received = asyncio.run(scenario())
+    assert received == [b'{"events":[{"turn":0},{"turn":1}]}', b'{"turn":2}']
+    assert front.posts == 2
+
+
+def test_full_queue_drops_droppable_events_first():
+    async def scenario():
+        front, received = front_end(queue_size=2)
+        # nothing is posted before the worker gets to run
+        front.enqueue("c", {"turn": 0}, required=True)
+        front.enqueue("c", {"partial": 1})
+        front.enqueue("c", {"turn": 1}, required=True)
+        front.enqueue("c", {"turn": 2}, required=True)
+        await drain(front, "c")
+        return front, received
+
+    front, received = asyncio.run(scenario())
+    # the partial went first, then the oldest required event as the hard cap
+    assert received == [b'{"turn":1}', b'{"turn":2}']
+    assert (front.dropped, front.dropped_required) == (2, 1)
+
+
+def test_newer_events_replace_pending_ones_with_the_same_key():
+    async def scenario():
+        front, received = front_end()
+        front.enqueue("c", {"text": "he"}, coalesce_key="partial")
+        front.enqueue("c", {"text": "hello"}, coalesce_key="partial")
+        await drain(front, "c")
+        return front, received
+
+    front, received = asyncio.run(scenario())
+    assert received == [b'{"text":"hello"}']
+    assert front.coalesced == 1
+
+
+@pytest.mark.parametrize("statuses, delivered, failed, attempts", [
+    ((503, 429), 1, 0, 3),
+    ((httpx.ConnectError("refused"),), 1, 0, 2),
+    ((503, 503, 503, 503), 0, 1, 4),
+    # rejected by the front end, not resent
+    ((400,), 0, 1, 1),
+])
+def test_failed_posts_are_retried(statuses, delivered, failed, attempts):
+    async def scenario():
+        front, received = front_end(*statuses, max_retries=3)
+        front.enqueue("c", {"turn": 0}, required=True)
+        await drain(front, "c")
+        return front, received
+
+    front, received = asyncio.run(scenario())
+    assert (front.delivered, front.failed, len(received)) == (delivered, failed, attempts)
+
+
+def test_nothing_is_queued_without_a_url():
+    async def scenario():
+        front = FrontEndDelivery(url=None)
+        front.enqueue("c", {"turn": 0})
+        return front
+
+    front = asyncio.run(scenario())
+    assert front.metrics()["enabled"] is False
+    assert front.metrics()["active_convos"] == 0
@@ -0,0 +1,112 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from agent import EVALUATION_RETRIES, PARALLEL, STRUCTURED, EvaluationError, EvaluatorAgent
+from util.gemini import GeminiResponse
+
+VALID = json.dumps({"first_speaker": {"score": 8, "analysis": "great"}, "second_speaker": {"score": 6, "analysis": "ok"}})
+UPDATE = json.dumps({"summary": "they talked about hiking", "first_speaker_score": 7, "second_speaker_score": 5})
+
+
+class ScriptedGemini:
+    """
+    Answers every call with the next scripted response (raising it if it is an exception).
+    """
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.requests = []
+
+    def _answer(self, request):
+        self.requests.append(request)
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return GeminiResponse(text=answer)
+
+    def send_text_prompt(self, request):
+        return self._answer(request)
+
+    async def send_text_prompt_async(self, request):
+        return self._answer(request)
+
+
+def make_evaluator(*answers, mode=STRUCTURED) -> EvaluatorAgent:
+    speaker1 = SimpleNamespace(id="1", profile="likes hiking")
+    speaker2 = SimpleNamespace(id="2", profile="likes films")
+    evaluator = EvaluatorAgent(speaker1, speaker2, ScriptedGemini(*answers), mode=mode)
+    evaluator.add_log(speaker1, "hi, I hike every weekend", "engaged")
+    evaluator.add_log(speaker2, "nice, I mostly watch films", "neutral")
+    return evaluator
+
+
+@pytest.mark.parametrize("response, expected", [
+    (VALID, (8, "great", 6, "ok")),
+    (f"```json\n{VALID}\n```", (8, "great", 6, "ok")),
+    ('{"first_speaker": {"score": 8.0, "analysis": " great "}, "second_speaker": {"score": 0, "analysis": "ok"}}', (8, "great", 0, "ok")),
+    ('{"first_speaker": {"score": 11, "analysis": "great"}, "second_speaker": {"score": 6, "analysis": "ok"}}', None),
+    ('{"first_speaker": {"score": 7.5, "analysis": "great"}, "second_speaker": {"score": 6, "analysis": "ok"}}', None),
+    ('{"first_speaker": {"score": true, "analysis": "great"}, "second_speaker": {"score": 6, "analysis": "ok"}}', None),
+    ('{"first_speaker": {"score": 8, "analysis": ""}, "second_speaker": {"score": 6, "analysis": "ok"}}', None),
+    ('{"first_speaker": {"score": 8, "analysis": "great"}}', None),
+    ("Score: 8\nAnalysis: great", None),
+    ("{not json}", None),
+])
+def test_parse_structured(response, expected):
+    assert make_evaluator()._parse_structured(response) == expected
+
+
+def test_structured_request_asks_for_json():
+    request = make_evaluator()._build_structured_request()
+    assert request.response_mime_type == "application/json"
+    assert request.response_schema == EvaluatorAgent.STRUCTURED_SCHEMA
+    assert "first_speaker is 1" in request.prompt
+
+
+def test_structured_evaluation_is_one_call():
+    evaluator = make_evaluator(VALID)
+    assert evaluator.get_evaluation() == (8, "great", 6, "ok")
+    assert evaluator.stats["calls"] == 1
+
+
+def test_malformed_answers_are_retried():
+    evaluator = make_evaluator('{"first_speaker": {"score": 11}}', VALID)
+    assert asyncio.run(evaluator.get_evaluation_async()) == (8, "great", 6, "ok")
+    assert evaluator.stats["calls"] == 2
+
+
+def test_evaluation_fails_after_the_retries():
+    evaluator = make_evaluator(*["nope"] * (1 + EVALUATION_RETRIES))
+    with pytest.raises(EvaluationError):
+        evaluator.get_evaluation()
+    assert evaluator.stats["calls"] == 1 + EVALUATION_RETRIES
+
+
+def test_parallel_mode_evaluates_each_speaker():
+    evaluator = make_evaluator("Score: 8\nAnalysis: great", "Score: none", "Score: 6\nAnalysis: ok", mode=PARALLEL)
+    assert evaluator.get_evaluation() == (8, "great", 6, "ok")
+    assert evaluator.stats["calls"] == 3
+
+
+def test_update_folds_the_log_into_the_summary():
+    evaluator = make_evaluator(UPDATE, VALID)
+    assert evaluator.update_summary() == {"turn": 2, "speaker_1_score": 7, "speaker_2_score": 5}
+    assert evaluator.summary == "they talked about hiking"
+    # nothing new since the update
+    assert evaluator.update_summary() is None
+    evaluator.get_evaluation()
+    final_prompt = evaluator.gemini_handler.requests[-1].prompt
+    assert "they talked about hiking" in final_prompt
+    assert "I hike every weekend" not in final_prompt
+
+
+def test_failed_update_leaves_the_summary_as_it_was():
+    evaluator = make_evaluator(*["{}"] * (1 + EVALUATION_RETRIES))
+    with pytest.raises(EvaluationError):
+        asyncio.run(evaluator.update_summary_async())
+    assert evaluator.summary == ""
+    assert evaluator.summarized == 0
+    assert evaluator.trajectory == []
+    assert evaluator.update_stats["calls"] == 1 + EVALUATION_RETRIES
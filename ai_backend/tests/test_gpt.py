@@ -0,0 +1,119 @@
+import json
+from email.utils import formatdate
+
+import pytest
+import requests
+
+from util import gpt
+from util.gpt import LLM, LLMError, LLMRateLimitError, LLMResponseError, ModelType
+
+
+class RecordingLimiter:
+    def __init__(self):
+        self.calls = []
+
+    def acquire(self, model_name, tokens):
+        self.calls.append(("acquire", tokens))
+
+    def refund(self, model_name, tokens, requests=0):
+        self.calls.append(("refund", tokens))
+
+    def pause(self, model_name, seconds):
+        self.calls.append(("pause", seconds))
+
+    def record_usage(self, model_name, reserved, used):
+        self.calls.append(("usage", used))
+
+    def held(self) -> int:
+        """
+        Reservations still held (acquired and not refunded).
+        """
+        return sum(1 if name == "acquire" else -1 for name, _ in self.calls if name in ("acquire", "refund"))
+
+
+def response(status: int, body: dict = None, headers: dict = None) -> requests.Response:
+    r = requests.Response()
+    r.status_code = status
+    r._content = json.dumps(body or {}).encode()
+    r.headers.update(headers or {})
+    return r
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """
+    Scripted API: answers the posts with the queued responses (raising exceptions), records the sleeps.
+    """
+    state = {"answers": [], "posts": 0, "sleeps": [], "limiter": RecordingLimiter()}
+
+    def post(**kwargs):
+        state["posts"] += 1
+        answer = state["answers"].pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    monkeypatch.setattr(LLM._session, "post", post)
+    monkeypatch.setattr(gpt.time, "sleep", state["sleeps"].append)
+    monkeypatch.setattr(gpt, "rate_limiter", state["limiter"])
+    monkeypatch.setattr(LLM, "_backoff", staticmethod(lambda attempt: 0.5))
+    monkeypatch.setattr(gpt, "DEBUG", False)
+    return state
+
+
+def test_server_errors_are_retried_with_one_reservation_held(api):
+    api["answers"] = [response(503), requests.ConnectionError("reset"), response(200)]
+    assert LLM._post_with_retries("gpt-4o", 10, "{}").status_code == 200
+    assert api["sleeps"] == [0.5, 0.5]
+    assert api["limiter"].held() == 1
+
+
+def test_rate_limited_calls_wait_for_retry_after_and_pause_the_model(api):
+    api["answers"] = [response(429, headers={"Retry-After": "7"}), response(200)]
+    LLM._post_with_retries("gpt-4o", 10, "{}")
+    assert api["sleeps"] == [7.0]
+    assert ("pause", 7.0) in api["limiter"].calls
+    # refunded before the pause
+    names = [name for name, _ in api["limiter"].calls]
+    assert names.index("refund") < names.index("pause")
+
+
+def test_retry_after_can_be_an_http_date(monkeypatch):
+    monkeypatch.setattr(gpt.time, "time", lambda: 1_000_000.0)
+    assert LLM._retry_after(response(429, headers={"Retry-After": formatdate(1_000_030.0, usegmt=True)})) == 30.0
+    assert LLM._retry_after(response(429, headers={"Retry-After": "soon"})) == 0
+    assert LLM._retry_after(response(429)) == 0
+
+
+def test_client_errors_are_not_retried(api):
+    api["answers"] = [response(400, {"error": "bad request"})]
+    with pytest.raises(LLMResponseError) as error:
+        LLM._post_with_retries("gpt-4o", 10, "{}")
+    assert error.value.status_code == 400
+    assert api["posts"] == 1
+    assert api["sleeps"] == []
+
+
+@pytest.mark.parametrize("failure, raised", [
+    (lambda: response(429), LLMRateLimitError),
+    (lambda: response(502), LLMResponseError),
+    (lambda: requests.Timeout("slow"), LLMError),
+])
+def test_calls_fail_after_the_retries(api, failure, raised):
+    api["answers"] = [failure() for _ in range(LLM.MAX_RETRIES + 1)]
+    with pytest.raises(raised):
+        LLM._post_with_retries("gpt-4o", 10, "{}")
+    assert api["posts"] == LLM.MAX_RETRIES + 1
+    assert api["limiter"].held() == 1
+
+
+def test_message_returns_the_reply_and_records_usage(api):
+    api["answers"] = [response(200, {
+        "choices": [{"message": {"content": "hello"}}],
+        "usage": {"prompt_tokens": 12, "completion_tokens": 3, "total_tokens": 15},
+    })]
+    model = LLM.models[ModelType.GPT_4O_MINI]
+    before = model.total_output_tokens
+    assert LLM.message("system", "hi", ModelType.GPT_4O_MINI) == "hello"
+    assert ("usage", 15) in api["limiter"].calls
+    assert model.total_output_tokens == before + 3
@@ -0,0 +1,66 @@
+import asyncio
+import threading
+
+import pytest
+
+from util.image_store import ImageStore
+
+
+def test_identical_images_are_stored_once():
+    store = ImageStore()
+    first = store.put("aGVsbG8=")
+    second = store.put("data:image/png;base64,aGVsbG8=")
+    assert first == second == ImageStore.ref_for("aGVsbG8=")
+    assert store.stats()["images"] == 1
+    assert store.stats()["references"] == 2
+
+
+def test_image_is_freed_with_its_last_reference():
+    store = ImageStore()
+    ref = store.put("aGVsbG8=")
+    store.acquire(ref)
+    store.release(ref)
+    assert store.get(ref) == "aGVsbG8="
+    store.release(ref)
+    assert store.get(ref) is None
+    assert store.stats() == {"images": 0, "references": 0, "b64_chars": 0, "loader_reads": 0}
+    # releasing an unknown (or empty) ref is a no-op
+    store.release(ref)
+    store.release("")
+
+
+def test_missing_images_are_read_through_the_loader():
+    stored = {"ref": "ZGlzaw=="}
+    store = ImageStore(loader=stored.get)
+    assert store.get("ref") == "ZGlzaw=="
+    # get doesn't keep it in memory, acquire does
+    assert store.stats()["images"] == 0
+    store.acquire("ref")
+    assert store.stats()["images"] == 1
+    assert store.stats()["loader_reads"] == 2
+    store.release("ref")
+    assert store.stats()["images"] == 0
+
+
+def test_acquiring_an_unknown_image_fails():
+    store = ImageStore(loader=lambda ref: None)
+    with pytest.raises(KeyError):
+        store.acquire("missing")
+    store.acquire("")
+    assert store.stats()["references"] == 0
+
+
+def test_async_get_reads_missing_images_in_a_thread():
+    loader_threads = []
+
+    def loader(ref):
+        loader_threads.append(threading.get_ident())
+        return "ZGlzaw=="
+
+    store = ImageStore(loader=loader)
+    ref = store.put("aGVsbG8=")
+    assert asyncio.run(store.get_async(ref)) == "aGVsbG8="
+    assert loader_threads == []
+    assert asyncio.run(store.get_async("on-disk")) == "ZGlzaw=="
+    assert loader_threads and loader_threads[0] != threading.get_ident()
+    assert asyncio.run(store.get_async("")) is None
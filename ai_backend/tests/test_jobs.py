@@ -0,0 +1,177 @@
+import asyncio
+
+import pytest
+
+import jobs
+from jobs import CANCELLED, FAILED, FINISHED, QUEUED, RUNNING, JobManager
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(jobs.time, "time", lambda: now[0])
+    return now
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_jobs_run_in_the_background_and_report_their_status():
+    async def scenario():
+        manager = JobManager(num_workers=1)
+        release = asyncio.Event()
+
+        async def run(job):
+            job.turn = 3
+            await release.wait()
+
+        async def fail(job):
+            raise RuntimeError("model down")
+
+        job = manager.submit("a", run)
+        failing = manager.submit("b", fail)
+        assert job.status == QUEUED
+        await settle()
+        assert job.status == RUNNING and job.turn == 3
+        assert manager.find_active("a") is job
+        release.set()
+        await settle()
+        assert job.status == FINISHED
+        assert failing.status == FAILED and failing.error == "model down"
+        assert manager.find_active("a") is None
+        assert manager.active_keys() == set()
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_job_cancelled_while_queued_never_runs():
+    async def scenario():
+        cancelled = []
+        manager = JobManager(num_workers=1, on_cancel=cancelled.append)
+        started = []
+        release = asyncio.Event()
+
+        async def run(job):
+            started.append(job.key)
+            await release.wait()
+
+        manager.submit("a", run)
+        queued = manager.submit("b", run)
+        await settle()
+        assert manager.cancel(queued.job_id)
+        assert cancelled == [queued]
+        # cancelling twice is refused
+        assert not manager.cancel(queued.job_id)
+        release.set()
+        await settle()
+        assert started == ["a"]
+        assert queued.status == CANCELLED
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_running_job_is_interrupted_on_cancel():
+    async def scenario():
+        cancelled = []
+        manager = JobManager(num_workers=1, on_cancel=cancelled.append)
+        interrupted = []
+
+        async def run(job):
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                interrupted.append(job.key)
+                raise
+
+        job = manager.submit("a", run)
+        await settle()
+        assert manager.cancel(job.job_id)
+        await settle()
+        assert interrupted == ["a"]
+        assert job.status == CANCELLED
+        # the run cleaned up itself, on_cancel is only for jobs that never started
+        assert cancelled == []
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_finished_jobs_are_evicted_after_the_retention(clock):
+    async def scenario():
+        evicted = []
+        manager = JobManager(num_workers=1, retention=60, on_evict=evicted.append)
+
+        async def run(job):
+            pass
+
+        first = manager.submit("a", run)
+        await settle()
+        # a newer job of the same key keeps the key alive
+        second = manager.submit("a", run)
+        await settle()
+        clock[0] += 61
+        manager.submit("b", run)
+        assert manager.get(first.job_id) is None
+        assert manager.get(second.job_id) is None
+        assert evicted == [second]
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_batches_are_evicted_together(clock):
+    async def scenario():
+        manager = JobManager(num_workers=2, retention=60)
+        release = asyncio.Event()
+
+        async def quick(job):
+            pass
+
+        async def slow(job):
+            await release.wait()
+
+        done = manager.submit("a", quick)
+        running = manager.submit("b", slow)
+        batch = manager.create_batch([done.job_id, running.job_id])
+        await settle()
+        progress = manager.get_batch_progress(batch.batch_id)
+        assert progress["done"] == 1 and progress["counts"][RUNNING] == 1
+        clock[0] += 61
+        manager.submit("c", quick)
+        # the finished job waits for the rest of its batch
+        assert manager.get(done.job_id) is done
+        release.set()
+        await settle()
+        clock[0] += 61
+        manager.submit("d", quick)
+        assert manager.get_batch_progress(batch.batch_id) is None
+        assert manager.get(done.job_id) is None and manager.get(running.job_id) is None
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_cancel_batch_cancels_the_jobs_still_active():
+    async def scenario():
+        cancelled = []
+        manager = JobManager(num_workers=1, on_cancel=cancelled.append)
+
+        async def run(job):
+            await asyncio.Event().wait()
+
+        batch_jobs = [manager.submit(key, run) for key in "abc"]
+        batch = manager.create_batch([job.job_id for job in batch_jobs])
+        await settle()
+        assert manager.cancel_batch(batch.batch_id) == 3
+        await settle()
+        assert [job.status for job in batch_jobs] == [CANCELLED] * 3
+        # the running one was interrupted, the queued ones never started
+        assert cancelled == batch_jobs[1:]
+        assert manager.cancel_batch("unknown") == 0
+        await manager.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,73 @@
+import pytest
+
+import agent
+from agent import SentimentAgent, SentimentCache
+from test_evaluation import ScriptedGemini
+from util.local_sentiment import LocalSentimentClassifier, TieredSentimentStats
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    stats = TieredSentimentStats(audit_rate=0.0)
+    monkeypatch.setattr(agent, "tiered_sentiment_stats", stats)
+    return stats
+
+
+@pytest.mark.parametrize("message, emotion", [
+    ("OMG I'm so excited, can't wait!!", "excited"),
+    ("What do you mean? I'm confused", "confused"),
+    ("meh", "bored"),
+    ("[STOP]", "bored"),
+    ("I went to the store yesterday.", "neutral"),
+])
+def test_local_classifier_picks_the_strongest_emotion(message, emotion):
+    assert LocalSentimentClassifier().classify(message)[0] == emotion
+
+
+def test_weak_cues_are_not_confident():
+    classifier = LocalSentimentClassifier()
+    _, strong = classifier.classify("OMG I'm so excited, can't wait!!")
+    _, weak = classifier.classify("I went to the store yesterday.")
+    assert 0 < weak < strong <= 1
+
+
+def test_confident_messages_skip_the_llm(stats):
+    sentiment_agent = SentimentAgent("profile", ScriptedGemini("engaged"), cache=SentimentCache(), local_threshold=0.6)
+    assert sentiment_agent.get_sentiment_for_message("OMG I'm so excited, can't wait!!") == "excited"
+    assert sentiment_agent.calls == 0
+    # not confident enough, the LLM answers and the local guess is compared with it
+    assert sentiment_agent.get_sentiment_for_message("I went to the store yesterday.") == "engaged"
+    assert sentiment_agent.calls == 1
+    assert (stats.local_answers, stats.llm_answers, stats.audits) == (1, 1, 0)
+
+
+def test_audited_confident_messages_are_checked_against_the_llm(monkeypatch, stats):
+    monkeypatch.setattr(stats, "audit_rate", 1.0)
+    sentiment_agent = SentimentAgent("profile", ScriptedGemini("excited"), cache=SentimentCache(), local_threshold=0.6)
+    assert sentiment_agent.get_sentiment_for_message("OMG I'm so excited, can't wait!!") == "excited"
+    assert sentiment_agent.calls == 1
+    assert stats.audits == 1
+    assert stats.stats()["agreement"] == 1.0
+
+
+def test_batches_only_send_the_uncertain_messages(stats):
+    gemini = ScriptedGemini('["engaged"]')
+    sentiment_agent = SentimentAgent("profile", gemini, cache=SentimentCache(), local_threshold=0.6)
+    sentiments = sentiment_agent.get_sentiments_for_messages(["OMG I'm so excited, can't wait!!", "I went to the store yesterday."])
+    assert sentiments == ["excited", "engaged"]
+    assert "store yesterday" in gemini.requests[0].prompt and "can't wait" not in gemini.requests[0].prompt
+
+
+def test_agreement_is_reported_per_confidence_band():
+    stats = TieredSentimentStats(audit_rate=0.0)
+    stats.record_local()
+    stats.record_llm("bored", 0.35, "bored")
+    stats.record_llm("bored", 0.38, "engaged")
+    stats.record_llm("excited", 0.95, "excited", audit=True)
+    report = stats.stats()
+    assert report["avoided_fraction"] == 0.25
+    assert report["audits"] == 1
+    assert report["agreement_by_confidence"] == {
+        "0.3": {"compared": 2, "agreement": 0.5},
+        "0.9": {"compared": 1, "agreement": 1.0},
+    }
@@ -0,0 +1,47 @@
+import asyncio
+
+import main
+from test_evaluation import UPDATE, make_evaluator
+
+
+def published(convo_id: str) -> list:
+    return [event["type"] for event in main.convo_events._streams[convo_id].events]
+
+
+def run_update(convo_id: str, evaluator, scoring=()):
+    main.convo_events.open(convo_id)
+
+    async def update():
+        tasks = [asyncio.create_task(coroutine) for coroutine in scoring]
+        await main.update_evaluation(convo_id, evaluator, None, tasks, len(evaluator.logs))
+
+    asyncio.run(update())
+
+
+def test_provisional_scores_are_published():
+    evaluator = make_evaluator(UPDATE)
+    run_update("update-ok", evaluator)
+    assert published("update-ok") == ["provisional_scores"]
+    assert evaluator.trajectory[-1]["speaker_1_score"] == 7
+
+
+def test_failed_update_is_skipped():
+    evaluator = make_evaluator(ConnectionError("provider down"))
+    run_update("update-error", evaluator)
+    assert published("update-error") == []
+    assert evaluator.summary == ""
+
+
+def test_malformed_update_is_skipped():
+    evaluator = make_evaluator(*["{}"] * 3)
+    run_update("update-malformed", evaluator)
+    assert published("update-malformed") == []
+
+
+def test_update_waits_for_scoring_even_if_it_failed():
+    async def failed_scoring():
+        raise RuntimeError("sentiment failed")
+
+    evaluator = make_evaluator(UPDATE)
+    run_update("update-after-failure", evaluator, [failed_scoring()])
+    assert published("update-after-failure") == ["provisional_scores"]
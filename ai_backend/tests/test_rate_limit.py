@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+import util.rate_limit as rate_limit
+from util.rate_limit import RateLimit, RateLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    return clock
+
+
+def make_limiter(requests_per_minute=60, tokens_per_minute=6000):
+    return RateLimiter(limits={"model": RateLimit(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)})
+
+
+def test_calls_within_the_budget_do_not_wait(clock):
+    limiter = make_limiter()
+    assert limiter.reserve("model", 100) == 0
+    budget = limiter.budget("model")["model"]
+    assert budget["requests_available"] == 59
+    assert budget["tokens_available"] == 5900
+
+
+def test_callers_queue_behind_earlier_debt(clock):
+    limiter = make_limiter(requests_per_minute=2)
+    assert limiter.reserve("model") == 0
+    assert limiter.reserve("model") == 0
+    # one request per 30 seconds, the third and fourth callers wait in arrival order
+    assert limiter.reserve("model") == pytest.approx(30)
+    assert limiter.reserve("model") == pytest.approx(60)
+
+
+def test_token_budget_refills_over_a_minute(clock):
+    limiter = make_limiter(tokens_per_minute=600)
+    assert limiter.reserve("model", 600) == 0
+    assert limiter.reserve("model", 60) == pytest.approx(6)
+    clock.now += 6
+    assert limiter.reserve("model", 0) == 0
+
+
+def test_a_call_bigger_than_the_bucket_is_capped(clock):
+    limiter = make_limiter(tokens_per_minute=600)
+    assert limiter.reserve("model", 10_000) == 0
+    assert limiter.budget("model")["model"]["tokens_available"] == 0
+
+
+def test_refund_and_usage_correction(clock):
+    limiter = make_limiter(tokens_per_minute=600)
+    limiter.reserve("model", 500)
+    limiter.refund("model", 200, requests=1)
+    assert limiter.budget("model")["model"]["tokens_available"] == 300
+    # estimated 300, the provider reported 100
+    limiter.record_usage("model", 300, 100)
+    assert limiter.budget("model")["model"]["tokens_available"] == 500
+    # refunds never go over capacity
+    limiter.refund("model", 10_000, requests=10)
+    budget = limiter.budget("model")["model"]
+    assert budget["tokens_available"] == 600
+    assert budget["requests_available"] == 60
+
+
+def test_pause_holds_back_every_caller(clock):
+    limiter = make_limiter()
+    limiter.pause("model", 10)
+    assert limiter.reserve("model") == pytest.approx(11)
+
+
+def test_unknown_models_get_the_default_limit(clock):
+    limiter = RateLimiter(limits={}, default=RateLimit(requests_per_minute=1, tokens_per_minute=100))
+    assert limiter.reserve("other") == 0
+    assert limiter.reserve("other") == pytest.approx(60)
+
+
+def test_cancelled_async_wait_gives_its_reservation_back(clock):
+    limiter = make_limiter(requests_per_minute=1)
+    limiter.reserve("model")
+
+    async def cancel_waiter():
+        task = asyncio.create_task(limiter.acquire_async("model", 10))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_waiter())
+    budget = limiter.budget("model")["model"]
+    assert budget["requests_available"] == 0
+    assert budget["tokens_available"] == 6000
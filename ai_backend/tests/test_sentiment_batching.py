@@ -0,0 +1,79 @@
+import asyncio
+import json
+
+import pytest
+
+import agent
+from agent import SentimentAgent, SentimentCache
+from test_evaluation import ScriptedGemini
+
+
+def make_agent(*answers, profile="likes hiking", cache=None) -> SentimentAgent:
+    # a threshold above 1 sends every message to the LLM
+    return SentimentAgent(profile, ScriptedGemini(*answers), cache=cache or SentimentCache(), local_threshold=2.0)
+
+
+def test_repeated_messages_are_classified_once_per_profile():
+    cache = SentimentCache()
+    sentiment_agent = make_agent("excited", "bored", cache=cache)
+    assert sentiment_agent.get_sentiment_for_message("Can't wait!") == "excited"
+    assert sentiment_agent.get_sentiment_for_message("  can't   WAIT! ") == "excited"
+    assert sentiment_agent.calls == 1
+    other_profile = make_agent("bored", profile="likes films", cache=cache)
+    assert other_profile.get_sentiment_for_message("Can't wait!") == "bored"
+    assert cache.stats()["llm_calls"] == 2
+
+
+def test_cached_sentiments_expire(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(agent.time, "monotonic", lambda: now[0])
+    cache = SentimentCache(ttl=60)
+    cache.put(("p", "hi"), "engaged")
+    assert cache.get(("p", "hi")) == "engaged"
+    now[0] = 61
+    assert cache.get(("p", "hi")) is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_sentiments_are_evicted():
+    cache = SentimentCache(max_entries=2)
+    cache.put(("p", "a"), "bored")
+    cache.put(("p", "b"), "bored")
+    cache.get(("p", "a"))
+    cache.put(("p", "c"), "bored")
+    assert cache.get(("p", "b")) is None
+    assert cache.get(("p", "a")) == "bored"
+
+
+def test_messages_are_classified_in_batches(monkeypatch):
+    monkeypatch.setattr(agent, "SENTIMENT_BATCH_SIZE", 2)
+    sentiment_agent = make_agent(json.dumps(["excited", "bored"]), '["Very engaged"]')
+    messages = ["wow!", "meh", "wow!", "tell me more"]
+    assert sentiment_agent.get_sentiments_for_messages(messages) == ["excited", "bored", "excited", "very engaged"]
+    # three distinct messages, two per call
+    assert sentiment_agent.calls == 2
+    assert "Return only a JSON array of 2 strings" in sentiment_agent.gemini_handler.requests[0].prompt
+
+
+def test_malformed_batch_falls_back_to_one_call_per_message():
+    sentiment_agent = make_agent('["excited"]', "confused", "angry")
+    assert sentiment_agent.get_sentiments_for_messages(["huh?", "ugh"]) == ["confused", "angry"]
+    assert sentiment_agent.calls == 3
+
+
+def test_async_batches_use_the_cache():
+    sentiment_agent = make_agent('["bored", "excited"]')
+    sentiment_agent.cache.put(sentiment_agent._cache_key("hello"), "neutral")
+    sentiments = asyncio.run(sentiment_agent.get_sentiments_for_messages_async(["ok", "hello", "yay", "OK"]))
+    assert sentiments == ["bored", "neutral", "excited", "bored"]
+    assert sentiment_agent.calls == 1
+
+
+@pytest.mark.parametrize("answer, emotion", [
+    ("Engaged.", "engaged"),
+    ('"very engaged"', "very engaged"),
+    ("They seem very engaged here", "very engaged"),
+    ("no idea", "neutral"),
+])
+def test_answers_are_mapped_onto_the_emotions(answer, emotion):
+    assert SentimentAgent.to_emotion(answer) == emotion
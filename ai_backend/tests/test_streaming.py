@@ -0,0 +1,92 @@
+import asyncio
+
+from streaming import ConvoEventBroker, format_sse
+
+
+async def collect(broker: ConvoEventBroker, convo_id: str, offset: int = 0) -> list:
+    return [event async for event in broker.subscribe(convo_id, offset, keep_alive=None)]
+
+
+def test_late_subscribers_replay_the_history_from_an_offset():
+    broker = ConvoEventBroker()
+    for turn in range(3):
+        broker.publish("c", {"type": "message", "turn": turn})
+    broker.close("c")
+    events = asyncio.run(collect(broker, "c", offset=1))
+    assert [event["offset"] for event in events] == [1, 2]
+    assert [event["turn"] for event in events] == [1, 2]
+
+
+def test_live_events_reach_every_subscriber_until_the_stream_closes():
+    async def scenario():
+        broker = ConvoEventBroker()
+        broker.open("c")
+        readers = [asyncio.create_task(collect(broker, "c")) for _ in range(2)]
+        await asyncio.sleep(0)
+        broker.publish("c", {"type": "message", "turn": 0})
+        broker.publish("c", {"type": "final_scores"})
+        broker.close("c")
+        return await asyncio.gather(*readers)
+
+    for events in asyncio.run(scenario()):
+        assert [event["type"] for event in events] == ["message", "final_scores"]
+
+
+def test_slow_subscriber_catches_up_from_the_history():
+    async def scenario():
+        broker = ConvoEventBroker(subscriber_buffer=2)
+        broker.open("c")
+        reader = asyncio.create_task(collect(broker, "c"))
+        await asyncio.sleep(0)
+        # more events than the subscriber's buffer before it gets to read any
+        for turn in range(10):
+            broker.publish("c", {"type": "message", "turn": turn})
+        broker.close("c")
+        return await reader
+
+    events = asyncio.run(scenario())
+    assert [event["offset"] for event in events] == list(range(10))
+
+
+def test_history_is_trimmed_and_replay_starts_at_the_oldest_kept_event():
+    broker = ConvoEventBroker(max_history=3)
+    for _ in range(5):
+        broker.publish("c", {"type": "message"})
+    broker.close("c")
+    assert [event["offset"] for event in asyncio.run(collect(broker, "c"))] == [2, 3, 4]
+
+
+def test_unknown_convos_have_no_stream():
+    broker = ConvoEventBroker()
+    assert not broker.has_stream("c")
+    assert asyncio.run(collect(broker, "c")) == []
+
+
+def test_finished_streams_are_dropped_beyond_the_limit():
+    broker = ConvoEventBroker(max_finished=2)
+    for convo_id in "abc":
+        broker.publish(convo_id, {"type": "message"})
+        broker.close(convo_id)
+    assert [broker.has_stream(convo_id) for convo_id in "abc"] == [False, True, True]
+
+
+def test_reusing_a_finished_convo_id_starts_a_new_stream():
+    broker = ConvoEventBroker()
+    broker.publish("c", {"type": "message"})
+    broker.close("c")
+    broker.open("c")
+    assert broker.publish("c", {"type": "message"}) == 0
+
+
+def test_keep_alive_while_idle():
+    async def scenario():
+        broker = ConvoEventBroker()
+        broker.open("c")
+        events = broker.subscribe("c", keep_alive=0.01)
+        first = await events.__anext__()
+        await events.aclose()
+        return first
+
+    assert asyncio.run(scenario()) is None
+    assert format_sse(None) == ": keep-alive\n\n"
+    assert format_sse({"offset": 4, "type": "message"}) == 'id: 4\nevent: message\ndata: {"offset": 4, "type": "message"}\n\n'
@@ -0,0 +1,71 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from agent import Agent, StreamingResponseParser
+
+CHUNKS = ["TEXT: Hi the", "re, I love hik", "ing! IMA", "GE: ima", "ge_2 What ab", "out you?"]
+
+
+class StreamingGemini:
+    """
+    Streams the scripted chunks for every prompt.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def register_prefix_async(self, prompt):
+        return SimpleNamespace(key="static")
+
+    def release_prefix(self, prefix):
+        pass
+
+    async def stream_multimodal_prompt_b64_async(self, prompt, images, cached_prefix=None):
+        for chunk in self.chunks:
+            await asyncio.sleep(0)
+            yield chunk
+
+
+def make_agent(chunks=CHUNKS) -> Agent:
+    survey = SimpleNamespace(get_profile_matrix=lambda: "likes hiking", get_images_as_str=lambda: "")
+    return Agent("1", survey, StreamingGemini(chunks))
+
+
+def stream(parser: StreamingResponseParser, chunks) -> list:
+    return [parser.feed(chunk) for chunk in chunks]
+
+
+def test_partial_text_never_shows_prefixes_or_image_references():
+    agent = make_agent()
+    parser = StreamingResponseParser(agent.parse_response)
+    deltas = stream(parser, CHUNKS)
+    for shown in (parser.text, *deltas):
+        assert "TEXT" not in shown and "IMAGE" not in shown.upper() and "ge_2" not in shown
+    parsed = parser.finish()
+    assert parsed == agent.parse_response("".join(CHUNKS))
+    assert parsed["image"] == "image_2"
+    # what was shown while streaming is a prefix of the final text
+    assert parsed["text"].startswith("".join(deltas))
+    assert parser.text == parsed["text"]
+
+
+def test_a_word_is_held_back_until_it_is_complete():
+    agent = make_agent()
+    parser = StreamingResponseParser(agent.parse_response)
+    assert parser.feed("TEXT:") == ""
+    assert parser.feed(" Hel") == ""
+    assert parser.feed("lo there") == "Hello"
+    assert parser.finish()["text"] == "Hello there"
+
+
+@pytest.mark.parametrize("chunks", [CHUNKS, ["".join(CHUNKS)], list("".join(CHUNKS))])
+def test_streamed_reply_matches_the_parsed_reply(chunks):
+    agent = make_agent(chunks)
+    partials = []
+    parsed = asyncio.run(agent.generate_response_stream_async(lambda text, delta: partials.append((text, delta))))
+    assert parsed == agent.parse_response("".join(CHUNKS))
+    assert all(text.endswith(delta) for text, delta in partials)
+    assert "".join(delta for _, delta in partials) == partials[-1][0]
+    metrics = agent.turn_metrics[-1]
+    assert 0 <= metrics["ttft"] <= metrics["total"]
@@ -0,0 +1,67 @@
+import pytest
+
+from survey_store import SurveyCache, SurveyStore
+from test_survey_store import make_survey
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SurveyStore(str(tmp_path / "surveys.db"))
+    for survey_id in ("1", "2", "3"):
+        store.save(survey_id, make_survey(survey_id))
+    yield store
+    store.close()
+
+
+def test_surveys_are_indexed_and_loaded_on_first_use(store):
+    cache = SurveyCache(store)
+    assert cache.build_index() == 3
+    assert "1" in cache and "4" not in cache
+    assert cache.stats()["entries"] == 0
+    first = cache["1"]
+    assert cache["1"] is first
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 1)
+    assert cache.get("4") is None
+    with pytest.raises(KeyError):
+        cache["4"]
+
+
+def test_least_recently_used_surveys_are_evicted(store):
+    cache = SurveyCache(store, max_entries=2)
+    cache.build_index()
+    cache.get("1")
+    cache.get("2")
+    cache.get("1")
+    cache.get("3")
+    assert list(cache._surveys) == ["1", "3"]
+    assert cache.stats()["bytes"] == sum(size for _, size in cache._surveys.values())
+
+
+def test_added_surveys_replace_the_cached_copy(store):
+    cache = SurveyCache(store)
+    cache.build_index()
+    stale = cache["1"]
+    store.save("1", make_survey("1"))
+    cache.add("1")
+    assert cache["1"] is not stale
+    store.save("4", make_survey("4"))
+    cache.add("4")
+    assert "4" in cache
+
+
+def test_convo_requests_load_their_speakers_in_one_go(monkeypatch, store):
+    import main
+
+    cache = SurveyCache(store)
+    cache.build_index()
+    monkeypatch.setattr(main, "surveys", cache)
+    pairs = [
+        main.StartConvoRequest(convo_id="a", speaker_1_id="1", speaker_2_id="2"),
+        main.StartConvoRequest(convo_id="b", speaker_1_id="2", speaker_2_id="4"),
+    ]
+    loaded = main._load_surveys(pairs)
+    assert sorted(loaded) == ["1", "2"]
+    assert cache.stats()["misses"] == 2
+    main._validate_convo_request(pairs[0], loaded)
+    with pytest.raises(main.HTTPException):
+        main._validate_convo_request(pairs[1], loaded)
@@ -0,0 +1,111 @@
+import sqlite3
+
+import pytest
+
+from survey import Survey
+from survey_store import FAILED, MIGRATIONS, PROCESSING, READY, SurveyStore
+from util.image_store import image_store
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SurveyStore(str(tmp_path / "surveys.db"))
+    yield store
+    store.close()
+
+
+def make_survey(survey_id: str, image_b64: str = "aW1hZ2U=", original_ref: str = "") -> Survey:
+    ref = image_store.put(image_b64)
+    return Survey.from_record(survey_id, "{'Name': 'x'}", "profile", [
+        {"ref": ref, "thumbnail_ref": ref, "original_ref": original_ref, "automated_caption": "a photo", "user_description": "me"},
+    ])
+
+
+def test_new_store_is_at_the_latest_schema(store):
+    assert store.schema_version == len(MIGRATIONS)
+
+
+def test_old_databases_are_migrated_in_place(tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(MIGRATIONS[0])
+    conn.execute("INSERT INTO surveys (id, agent_id, version, profile, results, created_at, updated_at) VALUES ('1', '1', 1, 'p', 'r', 0, 0)")
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    conn.close()
+
+    store = SurveyStore(path)
+    assert store.schema_version == len(MIGRATIONS)
+    # rows written before the status column existed are ready
+    assert store.get_status("1")["status"] == READY
+    assert store.load("1").profile == "p"
+    store.close()
+    # reopening doesn't run the migrations again
+    assert SurveyStore(path).schema_version == len(MIGRATIONS)
+
+
+def test_save_bumps_the_version_and_loads_without_images(store):
+    survey = make_survey("1")
+    assert store.save("1", survey) == 1
+    assert store.save("1", survey) == 2
+    loaded = store.load("1")
+    assert loaded.images == survey.images
+    assert store.get_image(survey.images[0]) == "aW1hZ2U="
+
+
+def test_claim_is_exclusive_until_the_survey_fails(store):
+    assert store.claim("1")
+    assert store.get_status("1")["status"] == PROCESSING
+    assert not store.claim("1")
+    # processing surveys aren't listed or loaded
+    assert not store.exists("1")
+    assert store.load("1") is None
+
+    store.mark_failed("1", "captioning failed")
+    status = store.get_status("1")
+    assert status["status"] == FAILED
+    assert status["error"] == "captioning failed"
+
+    assert store.claim("1")
+    assert store.get_status("1")["error"] is None
+
+
+def test_ready_surveys_are_not_claimed_again(store):
+    assert store.claim("1")
+    assert store.save("1", make_survey("1")) == 1
+    assert store.get_status("1")["status"] == READY
+    assert not store.claim("1")
+    # mark_failed only applies to a claimed survey
+    store.mark_failed("1", "late failure")
+    assert store.get_status("1")["status"] == READY
+
+
+def test_restart_fails_surveys_left_processing(store):
+    store.claim("1")
+    store.claim("2")
+    store.mark_failed("2", "error")
+    assert store.fail_interrupted() == 1
+    assert store.get_status("1")["status"] == FAILED
+
+
+def test_batches_report_the_status_of_their_surveys(store):
+    store.claim("1")
+    store.claim("2")
+    store.mark_failed("2", "error")
+    store.add_to_batch("batch", ["1", "2"])
+    store.add_to_batch("batch", ["2"])
+    assert [(form["id"], form["status"]) for form in store.get_batch("batch")] == [("1", PROCESSING), ("2", FAILED)]
+    assert store.get_batch("unknown") == []
+
+
+def test_originals_are_kept_while_a_saved_survey_uses_them(store):
+    original_ref = image_store.ref_for("b3JpZ2luYWw=")
+    store.put_original(original_ref, "b3JpZ2luYWw=")
+    store.save("1", make_survey("1", original_ref=original_ref))
+    store.drop_originals([original_ref])
+    assert store.get_original_image(original_ref) == "b3JpZ2luYWw="
+
+    unused_ref = image_store.ref_for("dW51c2Vk")
+    store.put_original(unused_ref, "dW51c2Vk")
+    store.drop_originals([unused_ref])
+    assert store.get_original_image(unused_ref) is None
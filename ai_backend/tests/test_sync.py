@@ -0,0 +1,156 @@
+import base64
+import json
+
+import pytest
+
+import fetch_form_responses as sync_script
+from fetch_form_responses import LocalDriveSource, LocalSheetSource, load_checkpoint, sync
+
+HEADERS = ["Timestamp", "Name"] + [f"Question {i}" for i in range(2, 13)] + ["Upload Pictures", "Caption for pictures"]
+
+
+def make_row(timestamp: str, name: str, file_id: str = "") -> list:
+    link = f"https://drive.google.com/file/d/{file_id}/view?usp=sharing" if file_id else ""
+    return [timestamp, name] + [""] * 11 + [link, "me"]
+
+
+class FakeBackend:
+    """
+    /save_forms and /form_batches: forms are queued, the test decides when they are ready or failed.
+    """
+    def __init__(self):
+        self.statuses = {}
+        self.received = []
+
+    def save_forms(self, forms, batch_id=None):
+        results = []
+        for form in forms:
+            self.received.append(form)
+            status = self.statuses.get(form["id"])
+            if status in ("ready", "processing", "queued"):
+                results.append({"id": form["id"], "status": "skipped" if status == "ready" else status})
+            else:
+                self.statuses[form["id"]] = "queued"
+                results.append({"id": form["id"], "status": "queued"})
+        return {"batch_id": batch_id or "batch-1", "forms": results}
+
+    def batch_statuses(self, batch_id):
+        return dict(self.statuses)
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = FakeBackend()
+    monkeypatch.setattr(sync_script, "send_forms_to_endpoint", backend.save_forms)
+    monkeypatch.setattr(sync_script, "fetch_batch_statuses", backend.batch_statuses)
+    return backend
+
+
+@pytest.fixture
+def sheet(tmp_path):
+    path = tmp_path / "sheet.json"
+    rows = [HEADERS, make_row("t1", "ann", "file-a"), make_row("t2", "bob")]
+
+    def write(new_rows=None):
+        path.write_text(json.dumps(new_rows or rows))
+        return LocalSheetSource(str(path))
+
+    write.rows = rows
+    return write
+
+
+@pytest.fixture
+def drive(tmp_path):
+    directory = tmp_path / "drive"
+    directory.mkdir()
+    (directory / "file-a").write_bytes(b"picture")
+    return LocalDriveSource(str(directory))
+
+
+def run(sheet_source, drive, tmp_path):
+    return sync(sheet_source, drive, checkpoint_path=str(tmp_path / "checkpoint.json"))
+
+
+def test_rows_are_only_checkpointed_once_ready(backend, sheet, drive, tmp_path):
+    checkpoint = run(sheet(), drive, tmp_path)
+    assert checkpoint["rows"] == {}
+    assert set(checkpoint["pending"]) == {"2", "3"}
+    form = backend.received[0]["form"]
+    assert form["Pictures (base64)"] == [base64.b64encode(b"picture").decode()]
+
+    backend.statuses["2"] = "ready"
+    checkpoint = run(sheet(), drive, tmp_path)
+    assert set(checkpoint["rows"]) == {"2"}
+    assert set(checkpoint["pending"]) == {"3"}
+    # still processing, not sent again
+    assert len(backend.received) == 2
+    assert load_checkpoint(str(tmp_path / "checkpoint.json")) == checkpoint
+
+
+def test_failed_rows_are_sent_again(backend, sheet, drive, tmp_path):
+    run(sheet(), drive, tmp_path)
+    backend.statuses.update({"2": "ready", "3": "failed"})
+    checkpoint = run(sheet(), drive, tmp_path)
+    assert [form["id"] for form in backend.received] == ["2", "3", "3"]
+    assert checkpoint["pending"]["3"]["batch_id"] == "batch-1"
+
+    backend.statuses["3"] = "ready"
+    checkpoint = run(sheet(), drive, tmp_path)
+    assert set(checkpoint["rows"]) == {"2", "3"}
+    assert checkpoint["pending"] == {}
+
+
+def test_rows_with_missing_files_are_retried_next_run(backend, sheet, drive, tmp_path):
+    (tmp_path / "drive" / "file-a").unlink()
+    checkpoint = run(sheet(), drive, tmp_path)
+    assert set(checkpoint["pending"]) == {"3"}
+    (tmp_path / "drive" / "file-a").write_bytes(b"picture")
+    checkpoint = run(sheet(), drive, tmp_path)
+    assert set(checkpoint["pending"]) == {"2", "3"}
+
+
+def test_rows_changed_after_ingestion_are_reported_not_checkpointed(backend, sheet, drive, tmp_path):
+    run(sheet(), drive, tmp_path)
+    backend.statuses.update({"2": "ready", "3": "ready"})
+    checkpoint = run(sheet(), drive, tmp_path)
+    ingested_hash = checkpoint["rows"]["3"]["hash"]
+
+    changed = [row[:] for row in sheet.rows]
+    changed[2][1] = "robert"
+    checkpoint = run(sheet(changed), drive, tmp_path)
+    assert checkpoint["rows"]["3"]["hash"] == ingested_hash
+    assert "3" in checkpoint["conflicts"]
+    # the backend keeps the first version, nothing is resent
+    assert len(backend.received) == 2
+
+    # back to the ingested version, no more conflict
+    checkpoint = run(sheet(), drive, tmp_path)
+    assert checkpoint["conflicts"] == {}
+
+
+def test_rows_the_backend_already_has_are_conflicts(backend, sheet, drive, tmp_path):
+    backend.statuses["2"] = "ready"
+    checkpoint = run(sheet(), drive, tmp_path)
+    assert "2" not in checkpoint["rows"]
+    assert "2" in checkpoint["conflicts"]
+    run(sheet(), drive, tmp_path)
+    assert [form["id"] for form in backend.received] == ["2", "3"]
+
+
+def test_wait_resends_failed_rows_in_the_same_run(backend, sheet, drive, tmp_path, monkeypatch):
+    monkeypatch.setattr(sync_script, "POLL_INTERVAL", 0)
+    failures = {"3"}
+
+    def process(batch_id):
+        # the backend works through the queued rows while sync waits, row 3 fails once
+        for form_id, status in backend.statuses.items():
+            if status == "queued":
+                backend.statuses[form_id] = "failed" if form_id in failures else "ready"
+                failures.discard(form_id)
+        return dict(backend.statuses)
+
+    monkeypatch.setattr(sync_script, "fetch_batch_statuses", process)
+    checkpoint = sync(sheet(), drive, checkpoint_path=str(tmp_path / "checkpoint.json"), wait=True)
+    assert set(checkpoint["rows"]) == {"2", "3"}
+    assert checkpoint["pending"] == {}
+    assert [form["id"] for form in backend.received] == ["2", "3", "3"]
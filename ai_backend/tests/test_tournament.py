@@ -0,0 +1,48 @@
+import numpy as np
+
+import tournament
+from tournament import prescreen, profile_vectors, total_pairs
+
+PROFILES = {
+    "a": "loves hiking and mountain trails, camps every weekend",
+    "b": "hiking mountain trails and camping on weekends",
+    "c": "watches old films and reads novels at home",
+    "d": "old films, novels and quiet evenings at home",
+}
+
+
+def test_profile_vectors_are_normalized_and_stable():
+    vectors = profile_vectors(list(PROFILES.values()) + [""])
+    assert np.allclose(np.linalg.norm(vectors[:-1], axis=1), 1.0)
+    # an empty profile doesn't divide by zero
+    assert not vectors[-1].any()
+    assert np.array_equal(vectors[:1], profile_vectors([PROFILES["a"]]))
+
+
+def test_each_user_gets_their_closest_partners():
+    pairs = prescreen(list(PROFILES), list(PROFILES.values()), top_k=1)
+    assert {(a, b) for a, b, _ in pairs} == {("a", "b"), ("c", "d")}
+
+
+def test_candidates_are_distinct_and_best_first():
+    pairs = prescreen(list(PROFILES), list(PROFILES.values()), top_k=2)
+    keys = [(a, b) for a, b, _ in pairs]
+    assert len(keys) == len(set(keys))
+    assert all(a < b for a, b in keys)
+    scores = [score for _, _, score in pairs]
+    assert scores == sorted(scores, reverse=True)
+    # every user appears in at least top_k candidate pairs
+    for user in PROFILES:
+        assert sum(user in pair for pair in keys) >= 2
+
+
+def test_top_k_is_capped_by_the_cohort():
+    pairs = prescreen(list(PROFILES), list(PROFILES.values()), top_k=10)
+    assert len(pairs) == total_pairs(len(PROFILES))
+    assert prescreen(["a"], [PROFILES["a"]], top_k=3) == []
+
+
+def test_chunked_similarity_matches_a_single_pass(monkeypatch):
+    expected = prescreen(list(PROFILES), list(PROFILES.values()), top_k=2)
+    monkeypatch.setattr(tournament, "SIMILARITY_CHUNK", 1)
+    assert prescreen(list(PROFILES), list(PROFILES.values()), top_k=2) == expected
@@ -0,0 +1,64 @@
+import re
+import zlib
+
+import numpy as np
+
+# dimensions of the hashed profile vectors
+FEATURE_DIM = 2 ** 11
+# rows of the similarity matrix computed at once, bounds memory for large cohorts
+SIMILARITY_CHUNK = 1024
+
+_TOKEN = re.compile(r"[a-z0-9']+")
+
+
+def _features(text: str) -> list[str]:
+    words = _TOKEN.findall(text.lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def profile_vectors(texts: list[str], dim: int = FEATURE_DIM) -> np.ndarray:
+    """
+    Hashing vectorizer: unigrams and bigrams are hashed into dim buckets (crc32, so vectors are the
+    same across processes and a resumed tournament gets the same candidates), weighted by log term
+    frequency and L2 normalized.
+    """
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for feature in _features(text):
+            h = zlib.crc32(feature.encode())
+            # the sign bit spreads collisions around zero
+            vectors[row, h % dim] += 1.0 if h & 0x80000000 else -1.0
+    vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def prescreen(user_ids: list[str], texts: list[str], top_k: int) -> list[tuple[str, str, float]]:
+    """
+    Pre-screening for compatibility tournaments: simulating every pair of a cohort is O(n^2) full
+    conversations, so every pair is scored by cosine similarity of the profile vectors and only each
+    user's top_k partners get a conversation.
+    Returns the distinct candidate pairs as (user_a, user_b, score) with user_a < user_b, best first.
+    """
+    n = len(user_ids)
+    top_k = min(top_k, n - 1)
+    if top_k <= 0:
+        return []
+    vectors = profile_vectors(texts)
+    candidates: dict[tuple[str, str], float] = {}
+    for start in range(0, n, SIMILARITY_CHUNK):
+        similarity = vectors[start:start + SIMILARITY_CHUNK] @ vectors.T
+        rows = np.arange(similarity.shape[0])
+        # nobody is their own candidate
+        similarity[rows, rows + start] = -np.inf
+        best = np.argpartition(-similarity, top_k - 1, axis=1)[:, :top_k]
+        for row, partners in enumerate(best):
+            user = user_ids[start + row]
+            for partner in partners:
+                pair = tuple(sorted((user, user_ids[partner])))
+                candidates[pair] = float(similarity[row, partner])
+    return sorted(((a, b, score) for (a, b), score in candidates.items()), key=lambda pair: -pair[2])
+
+
+def total_pairs(n: int) -> int:
+    return n * (n - 1) // 2
@@ -1,45 +1,15 @@
 import os
-import time
-from typing import List, Union, Optional
+import asyncio
+import hashlib
+import threading
+import datetime
+from collections import OrderedDict, deque
+from typing import AsyncIterator, List, Union, Optional
 from dataclasses import dataclass
 from dotenv import load_dotenv
 import google.generativeai as genai
 import base64
-
-# ------------------------
-# Global Rate Limiting
-# ------------------------
-RATE_LIMIT = 1000
-requests_made_this_minute = 0
-minute_start_time = time.time()
-
-def check_rate_limit():
-    """
-    Naive bucket-based rate limiter. It uses a 60-second window:
-      - If the limit is reached before the 60s are up, we sleep until the window resets.
-      - Then we reset the counter and the start time.
-    """
-    global requests_made_this_minute, minute_start_time
-    
-    now = time.time()
-    elapsed = now - minute_start_time
-    
-    # If more than 60 seconds have passed since last reset, start a new window
-    if elapsed >= 60:
-        requests_made_this_minute = 0
-        minute_start_time = now
-    
-    # If we're at or above limit and still in the current window, sleep
-    if requests_made_this_minute >= RATE_LIMIT:
-        sleep_time = 60 - elapsed
-        print(f"Rate limit reached. Sleeping for {sleep_time:.2f} seconds...")
-        time.sleep(sleep_time)
-        # Reset counters
-        requests_made_this_minute = 0
-        minute_start_time = time.time()
-    
-    # Count the new request
-    requests_made_this_minute += 1
+from util.rate_limit import rate_limiter
 
 # Load .env file
 load_dotenv()
@@ -54,14 +24,124 @@ class GeminiImage:
     data: bytes
 
 
+# magic bytes -> mime type for the formats Gemini accepts
+_MIME_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF", "application/pdf"),
+]
+
+def detect_mime_type(data: bytes, default: str = "image/png") -> str:
+    """
+    Detects the mime type of image bytes from their header, returns default if unknown.
+    """
+    for signature, mime_type in _MIME_SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:8] == b"ftyp" and data[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "image/heic"
+    return default
+
+
+class GeminiImageCache:
+    """
+    Bounded LRU cache of decoded images keyed by a hash of their base64 string,
+    so images resent every turn are only decoded once.
+    """
+    def __init__(self, max_entries: int = 256, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._images: OrderedDict[str, GeminiImage] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get_image(self, b64_image_str: str, mime_type: Optional[str] = None) -> GeminiImage:
+        """
+        Returns the decoded image for a base64 string (data URI prefix allowed).
+        mime_type overrides the type from the data URI / detected from the bytes.
+        """
+        uri_mime_type = None
+        if b64_image_str.startswith("data:"):
+            header, b64_image_str = b64_image_str.split(",", 1)
+            uri_mime_type = header[len("data:"):].split(";", 1)[0] or None
+        key = hashlib.sha1(b64_image_str.encode()).hexdigest()
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+        if image is None:
+            try:
+                image_bytes = base64.b64decode(b64_image_str)
+            except Exception as e:
+                raise ValueError("Failed to decode base64 image string") from e
+            image = GeminiImage(mime_type=uri_mime_type or detect_mime_type(image_bytes), data=image_bytes)
+            with self._lock:
+                self.misses += 1
+                if key not in self._images:
+                    self._images[key] = image
+                    self._bytes += len(image_bytes)
+                    self._evict()
+        if mime_type is not None and mime_type != image.mime_type:
+            return GeminiImage(mime_type=mime_type, data=image.data)
+        return image
+
+    def _evict(self):
+        while self._images and (len(self._images) > self.max_entries or self._bytes > self.max_bytes):
+            _, evicted = self._images.popitem(last=False)
+            self._bytes -= len(evicted.data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._images),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+image_cache = GeminiImageCache()
+
+
 @dataclass
 class GeminiTextRequest:
     prompt: str
+    # structured output, e.g. "application/json" with an OpenAPI style schema dict
+    response_mime_type: Optional[str] = None
+    response_schema: Optional[dict] = None
+
+    def generation_config(self) -> Optional[genai.GenerationConfig]:
+        if self.response_mime_type is None:
+            return None
+        return genai.GenerationConfig(response_mime_type=self.response_mime_type, response_schema=self.response_schema)
+
+
+@dataclass
+class CachedPrefix:
+    """
+    Handle for a static prompt prefix registered with a ContextCache.
+    If the provider cached it, model is bound to the cached content and only the
+    rest of the prompt is sent, otherwise text is sent inline in front of the prompt.
+    """
+    key: str
+    text: str
+    cache_name: Optional[str] = None
+    model: Optional[object] = None
 
 
 @dataclass
 class GeminiMultimodalRequest:
     parts: List[Union[str, GeminiImage]]
+    cached_prefix: Optional[CachedPrefix] = None
 
 
 @dataclass
@@ -70,63 +150,365 @@ class GeminiResponse:
     raw: Optional[dict] = None
 
 
+# --- Concurrency Limits ---
+# Max number of async calls in flight per model, shared by every handler of that model.
+# Keeps many simultaneous conversations under the provider quota.
+DEFAULT_MAX_CONCURRENT_CALLS = 16
+MAX_CONCURRENT_CALLS = {
+    "gemini-2.0-flash": 32,
+    "gemini-1.5-pro": 8,
+    "gemini-1.5-flash-8b": 32,
+}
+
+class CallLimiter:
+    """
+    Caps the async calls in flight for a model, use with async with. Holders are counted explicitly
+    and waiters are served in arrival order. The limit can be changed at any time: current holders
+    keep their slot (a lower limit holds back new calls until enough of them finish).
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self._waiters: deque = deque()
+
+    async def __aenter__(self):
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return self
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over right as we got cancelled, pass it on
+                self._release()
+            else:
+                self._waiters.remove(waiter)
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._release()
+
+    def _release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        # slots are handed over directly, so a new caller can't jump ahead of the queue
+        while self._waiters and self.in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def set_limit(self, limit: int):
+        self.limit = limit
+        self._wake()
+
+
+_model_limiters: dict[str, CallLimiter] = {}
+
+def get_model_limiter(model_name: str) -> CallLimiter:
+    if model_name not in _model_limiters:
+        _model_limiters[model_name] = CallLimiter(MAX_CONCURRENT_CALLS.get(model_name, DEFAULT_MAX_CONCURRENT_CALLS))
+    return _model_limiters[model_name]
+
+def set_max_concurrent_calls(model_name: str, limit: int):
+    """
+    Changes the in-flight cap for a model, calls already in flight keep running.
+    """
+    MAX_CONCURRENT_CALLS[model_name] = limit
+    get_model_limiter(model_name).set_limit(limit)
+
+def get_in_flight_calls() -> dict[str, int]:
+    return {model_name: limiter.in_flight for model_name, limiter in _model_limiters.items()}
+
+
+# --- Context Caching ---
+class InlineContextCache:
+    """
+    Stand-in context cache that never talks to the provider, prefixes are kept locally
+    and sent inline with every request. Used offline / in tests and as the fallback.
+    """
+    def __init__(self):
+        self._prefixes: dict[str, CachedPrefix] = {}
+        self._refs: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(model_name: str, prefix: str) -> str:
+        return f"{model_name}:{hashlib.sha256(prefix.encode()).hexdigest()}"
+
+    def register(self, model_name: str, prefix: str) -> CachedPrefix:
+        """
+        Returns the handle for prefix, identical prefixes on the same model share one handle.
+        """
+        key = self._key(model_name, prefix)
+        with self._lock:
+            if key in self._prefixes:
+                self._refs[key] += 1
+                return self._prefixes[key]
+        handle = self._create(model_name, key, prefix)
+        with self._lock:
+            existing = self._prefixes.get(key)
+            if existing is None:
+                self._prefixes[key] = handle
+                self._refs[key] = 1
+                return handle
+            # registered by someone else meanwhile, keep theirs
+            self._refs[key] += 1
+        self._delete(handle)
+        return existing
+
+    def release(self, handle: CachedPrefix):
+        with self._lock:
+            if handle.key not in self._refs:
+                return
+            self._refs[handle.key] -= 1
+            if self._refs[handle.key] > 0:
+                return
+            del self._refs[handle.key]
+            del self._prefixes[handle.key]
+        self._delete(handle)
+
+    def _create(self, model_name: str, key: str, prefix: str) -> CachedPrefix:
+        return CachedPrefix(key=key, text=prefix)
+
+    def _delete(self, handle: CachedPrefix):
+        pass
+
+
+class GeminiContextCache(InlineContextCache):
+    """
+    Registers prefixes with Gemini's context caching so the provider doesn't re-read them every turn.
+    Falls back to sending the prefix inline when it is too short to be cached or the model doesn't support it.
+    """
+    # gemini rejects caches under a minimum token count
+    MIN_CACHE_TOKENS = 4096
+
+    def __init__(self, ttl: datetime.timedelta = datetime.timedelta(hours=1)):
+        super().__init__()
+        self.ttl = ttl
+        self._unsupported_models: set[str] = set()
+
+    def _create(self, model_name: str, key: str, prefix: str) -> CachedPrefix:
+        # rough estimate, ~4 characters per token
+        if len(prefix) // 4 < self.MIN_CACHE_TOKENS or model_name in self._unsupported_models:
+            return CachedPrefix(key=key, text=prefix)
+        try:
+            cache = genai.caching.CachedContent.create(model=model_name, contents=[prefix], ttl=self.ttl)
+        except Exception as e:
+            print(f"Context caching unavailable for {model_name}, sending prefix inline: {e}")
+            self._unsupported_models.add(model_name)
+            return CachedPrefix(key=key, text=prefix)
+        return CachedPrefix(
+            key=key,
+            text=prefix,
+            cache_name=cache.name,
+            model=genai.GenerativeModel.from_cached_content(cached_content=cache),
+        )
+
+    def _delete(self, handle: CachedPrefix):
+        if handle.cache_name is None:
+            return
+        try:
+            genai.caching.CachedContent.get(handle.cache_name).delete()
+        except Exception as e:
+            # expires with its ttl anyway
+            print(f"Could not delete cached content {handle.cache_name}: {e}")
+
+
+# shared by every handler unless one is passed in, set GEMINI_CONTEXT_CACHE=0 to always send prefixes inline
+default_context_cache = GeminiContextCache() if os.getenv("GEMINI_CONTEXT_CACHE", "1") != "0" else InlineContextCache()
+
+
+# --- Rate Limiting ---
+# gemini bills a flat amount per image
+IMAGE_TOKENS = 258
+
+def estimate_tokens(parts) -> int:
+    """
+    Rough input token count for a prompt (~4 characters per token), used to reserve rate limit budget.
+    """
+    if isinstance(parts, str):
+        parts = [parts]
+    tokens = 0
+    for part in parts:
+        if isinstance(part, str):
+            tokens += len(part) // 4
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+def _record_usage(model_name: str, estimated_tokens: int, response):
+    usage = getattr(response, "usage_metadata", None)
+    total_tokens = getattr(usage, "total_token_count", None)
+    if total_tokens:
+        rate_limiter.record_usage(model_name, estimated_tokens, total_tokens)
+
+
 # --- Gemini Handler ---
 class GeminiHandler:
-    def __init__(self, model_name: str="gemini-2.0-flash"):
+    def __init__(self, model_name: str="gemini-2.0-flash", context_cache: Optional[InlineContextCache] = None):
         genai.configure(api_key=API_KEY)
+        self.model_name = model_name
         self.model = genai.GenerativeModel(model_name)
+        self.context_cache = context_cache if context_cache is not None else default_context_cache
+
+    def register_prefix(self, prefix: str) -> CachedPrefix:
+        """
+        Registers a static prompt prefix once, pass the handle to the multimodal calls on every turn.
+        """
+        return self.context_cache.register(self.model_name, prefix)
+
+    async def register_prefix_async(self, prefix: str) -> CachedPrefix:
+        return await asyncio.to_thread(self.context_cache.register, self.model_name, prefix)
+
+    def release_prefix(self, prefix: CachedPrefix):
+        self.context_cache.release(prefix)
 
     def send_text_prompt(self, request: GeminiTextRequest) -> GeminiResponse:
-        # Check rate limit before sending
-        check_rate_limit()
-        
-        response = self.model.generate_content(request.prompt)
+        # Wait for rate limit budget before sending
+        tokens = estimate_tokens(request.prompt)
+        rate_limiter.acquire(self.model_name, tokens)
+
+        response = self.model.generate_content(request.prompt, generation_config=request.generation_config())
+        _record_usage(self.model_name, tokens, response)
         return GeminiResponse(text=response.text, raw=response)
 
     def send_multimodal_prompt(self, request: GeminiMultimodalRequest) -> GeminiResponse:
-        # Check rate limit before sending
-        check_rate_limit()
-        
-        parts = []
-        for item in request.parts:
-            if isinstance(item, str):
-                parts.append(item)
-            elif isinstance(item, GeminiImage):
-                parts.append({
-                    "mime_type": item.mime_type,
-                    "data": item.data
-                })
-            else:
-                raise ValueError("Unsupported input part: must be str or GeminiImage")
+        model, parts = self._resolve_model_and_parts(request)
+        # Wait for rate limit budget before sending
+        tokens = estimate_tokens(parts) + self._cached_prefix_tokens(request)
+        rate_limiter.acquire(self.model_name, tokens)
 
-        response = self.model.generate_content(parts)
+        response = model.generate_content(parts)
+        _record_usage(self.model_name, tokens, response)
         return GeminiResponse(text=response.text, raw=response)
 
     def send_multimodal_prompt_b64(
         self,
         prompt: str,
         b64_image_strs: list[str],
-        mime_type: str = "image/png"
+        mime_type: Optional[str] = None,
+        cached_prefix: Optional[CachedPrefix] = None
     ) -> GeminiResponse:
         """
         Accepts a list of base64-encoded image strings and sends a multimodal prompt.
         Strips data URI prefix if present in any image.
+        Images are decoded once through image_cache, the mime type is detected unless mime_type is given.
+        cached_prefix (from register_prefix) is put in front of the prompt.
         """
-        images = []
-        for b64_image_str in b64_image_strs:
-            # Strip data URI prefix if it's there
-            if b64_image_str.startswith("data:"):
-                b64_image_str = b64_image_str.split(",", 1)[1]
-            try:
-                image_bytes = base64.b64decode(b64_image_str)
-            except Exception as e:
-                raise ValueError("Failed to decode base64 image string") from e
+        return self.send_multimodal_prompt(self._build_b64_request(prompt, b64_image_strs, mime_type, cached_prefix))
+
+    # --- Async API ---
+    # Same requests as above, but awaitable so they can run inside FastAPI handlers
+    # without blocking the event loop for the whole round-trip.
+
+    async def send_text_prompt_async(self, request: GeminiTextRequest) -> GeminiResponse:
+        tokens = estimate_tokens(request.prompt)
+        await rate_limiter.acquire_async(self.model_name, tokens)
+        async with get_model_limiter(self.model_name):
+            response = await self.model.generate_content_async(request.prompt, generation_config=request.generation_config())
+        _record_usage(self.model_name, tokens, response)
+        return GeminiResponse(text=response.text, raw=response)
+
+    async def send_multimodal_prompt_async(self, request: GeminiMultimodalRequest) -> GeminiResponse:
+        model, parts = self._resolve_model_and_parts(request)
+        tokens = estimate_tokens(parts) + self._cached_prefix_tokens(request)
+        await rate_limiter.acquire_async(self.model_name, tokens)
+        async with get_model_limiter(self.model_name):
+            response = await model.generate_content_async(parts)
+        _record_usage(self.model_name, tokens, response)
+        return GeminiResponse(text=response.text, raw=response)
+
+    async def send_multimodal_prompt_b64_async(
+        self,
+        prompt: str,
+        b64_image_strs: list[str],
+        mime_type: Optional[str] = None,
+        cached_prefix: Optional[CachedPrefix] = None
+    ) -> GeminiResponse:
+        """
+        Async version of send_multimodal_prompt_b64.
+        """
+        return await self.send_multimodal_prompt_async(self._build_b64_request(prompt, b64_image_strs, mime_type, cached_prefix))
+
+    async def stream_multimodal_prompt_async(self, request: GeminiMultimodalRequest) -> AsyncIterator[str]:
+        """
+        Streams the response text chunk by chunk as Gemini generates it.
+        """
+        model, parts = self._resolve_model_and_parts(request)
+        tokens = estimate_tokens(parts) + self._cached_prefix_tokens(request)
+        await rate_limiter.acquire_async(self.model_name, tokens)
+        async with get_model_limiter(self.model_name):
+            response = await model.generate_content_async(parts, stream=True)
+            async for chunk in response:
+                text = chunk.text if chunk.parts else ""
+                if text:
+                    yield text
+        _record_usage(self.model_name, tokens, response)
+
+    def stream_multimodal_prompt_b64_async(
+        self,
+        prompt: str,
+        b64_image_strs: list[str],
+        mime_type: Optional[str] = None,
+        cached_prefix: Optional[CachedPrefix] = None
+    ) -> AsyncIterator[str]:
+        """
+        Streaming version of send_multimodal_prompt_b64_async, use with async for.
+        """
+        return self.stream_multimodal_prompt_async(self._build_b64_request(prompt, b64_image_strs, mime_type, cached_prefix))
+
+    # --- Helpers ---
+
+    def _resolve_model_and_parts(self, request: GeminiMultimodalRequest):
+        """
+        Picks the model bound to the request's cached prefix if the provider cached it,
+        otherwise the handler's model with the prefix prepended inline.
+        """
+        parts = self._build_parts(request)
+        prefix = request.cached_prefix
+        if prefix is None:
+            return self.model, parts
+        if prefix.model is not None:
+            return prefix.model, parts
+        if parts and isinstance(parts[0], str):
+            parts[0] = prefix.text + parts[0]
+        else:
+            parts.insert(0, prefix.text)
+        return self.model, parts
+
+    @staticmethod
+    def _cached_prefix_tokens(request: GeminiMultimodalRequest) -> int:
+        # a provider cached prefix isn't in the parts but still counts as input
+        prefix = request.cached_prefix
+        if prefix is not None and prefix.model is not None:
+            return estimate_tokens(prefix.text)
+        return 0
+
+    @staticmethod
+    def _build_parts(request: GeminiMultimodalRequest) -> list:
+        parts = []
+        for item in request.parts:
+            if isinstance(item, str):
+                parts.append(item)
+            elif isinstance(item, GeminiImage):
+                parts.append({
+                    "mime_type": item.mime_type,
+                    "data": item.data
+                })
+            else:
+                raise ValueError("Unsupported input part: must be str or GeminiImage")
+        return parts
 
-            images.append(GeminiImage(mime_type=mime_type, data=image_bytes))
+    @staticmethod
+    def _build_b64_request(prompt: str, b64_image_strs: list[str], mime_type: Optional[str] = None, cached_prefix: Optional[CachedPrefix] = None) -> GeminiMultimodalRequest:
+        images = [image_cache.get_image(b64_image_str, mime_type) for b64_image_str in b64_image_strs]
 
         # Include the prompt and all images in the parts list
         parts = [prompt] + images
-        # print('images len:')
-        # print(len(images))
-        request = GeminiMultimodalRequest(parts=parts)
-        return self.send_multimodal_prompt(request)
\ No newline at end of file
+        return GeminiMultimodalRequest(parts=parts, cached_prefix=cached_prefix)
@@ -3,9 +3,13 @@ import json
 from enum import Enum
 from dataclasses import dataclass
 import requests
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
 import time
+import random
 import tiktoken
+from util.rate_limit import rate_limiter
 
 HPC = False
 
@@ -18,6 +22,23 @@ if not API_KEY:
 
 # API
 OPEN_AI_ENDPOINT = 'https://api.openai.com/v1/chat/completions'
+# (connect, read) timeouts in seconds, o1 can take minutes to answer
+REQUEST_TIMEOUT = (10, 300)
+# size of the keep-alive connection pool
+POOL_SIZE = 32
+
+# ERRORS
+class LLMError(Exception):
+    """Raised when a call to the LLM API fails"""
+
+class LLMResponseError(LLMError):
+    """The API answered with an error status or an unusable body"""
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class LLMRateLimitError(LLMResponseError):
+    """Still rate limited (429) after all retries"""
 
 # ENUMS
 class ModelType(Enum):
@@ -115,17 +136,26 @@ class LLMModel:
         self.output_tokens_since_epoch = 0
 
 
+def _build_session() -> requests.Session:
+    """
+    Session shared by every call so connections (TCP/TLS) are kept alive and reused.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount("https://", adapter)
+    session.headers.update({"Content-Type": "application/json"})
+    return session
+
+
 class LLM:
-    _minute_start: float = 0
-    _tokens_since_minute_start: int = 0
-    _rate_limit_yield: int = 1
-    _default_yield: int = 0.70
     _API_KEY = API_KEY
-    # RATE LIMIT CONSTANTS
-    TPM: int = 100000
-    # yield lengths for error codes (in seconds)
-    _NONE_200_YIELD: int = 20
-    _429_YIELD: int = 120
+    _session = _build_session()
+    # rate limits are per model, see util/rate_limit.py
+    # retries for 429s, 5xx and connection errors, exponential backoff with full jitter (in seconds)
+    MAX_RETRIES: int = 5
+    _BACKOFF_BASE: float = 1.0
+    _BACKOFF_MAX: float = 60.0
+    _RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
     models = {
         ModelType.GPT_3_TURBO: LLMModel(ModelType.GPT_3_TURBO),
         ModelType.GPT_4O: LLMModel(ModelType.GPT_4O),
@@ -143,20 +173,11 @@ class LLM:
 
     @staticmethod
     def can_message(system_prompt: str, user_message: str, model_type: ModelType) -> bool:
-        """Returns true if an API call can be made under the rate limit"""
-        num_tokens = len(LLM.models[model_type].model_cost_info.encoding.encode(system_prompt + user_message))
-        if LLM._minute_start == 0:
-            LLM._minute_start = time.perf_counter()
-            return True
-        if time.perf_counter() - LLM._minute_start > 60:
-            # past a minute, so start a new period
-            LLM._minute_start = time.perf_counter()
-            LLM._tokens_since_minute_start = 0
-        if LLM._tokens_since_minute_start + num_tokens > LLM.TPM * 0.9:
-            # will get rate limited
-            print('Rate Limited')
-            return False
-        return True
+        """Returns true if an API call can be made under the rate limit right now"""
+        num_tokens = LLM.get_number_of_tokens(system_prompt + user_message, model_type)
+        model_name = LLM.models[model_type].model_cost_info.model_name
+        budget = rate_limiter.budget(model_name)[model_name]
+        return budget["requests_available"] >= 1 and budget["tokens_available"] >= num_tokens
 
     @staticmethod
     def message(system_prompt: str, user_message: str, model_type: ModelType, temperature=0.5) -> str:
@@ -166,12 +187,10 @@ class LLM:
         :param user_message: the user prompt
         :param model_type: the model type to be called
         :returns response message from GPT
+        :raises LLMError: if the call still fails after MAX_RETRIES retries (or can't be retried)
         """
-        time.sleep(LLM._default_yield)
-        # yield until we can message again
-        while not LLM.can_message(system_prompt, user_message, model_type):
-            time.sleep(LLM._rate_limit_yield)
-        # can call now
+        model_name = LLM.models[model_type].model_cost_info.model_name
+        num_tokens = LLM.get_number_of_tokens(system_prompt + user_message, model_type)
         messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_message}]
         if DEBUG:
             print('== SENDING TO: %s ==\n[System Prompt]\n%s\n[Message]\n%s\n===========' %
@@ -191,34 +210,18 @@ class LLM:
                 "temperature": temperature,
                 'max_completion_tokens': 100000
             }
-        response = requests.post(
-            url=OPEN_AI_ENDPOINT,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": "Bearer " + LLM._API_KEY
-            },
-            data=json.dumps(request_dump)
-        )
-        if response.status_code == 429:
-            # being rate limited
-            LLM._minute_start = time.perf_counter() + LLM._429_YIELD
-            LLM._tokens_since_minute_start = LLM.TPM * LLM._429_YIELD / 60
-            print('GPT CODE 429 | Retrying...')
-            return LLM.message(system_prompt, user_message, model_type)
-        if response.status_code != 200:
-            LLM._minute_start = time.perf_counter() + LLM._NONE_200_YIELD
-            LLM._tokens_since_minute_start = LLM.TPM * LLM._NONE_200_YIELD / 60
-            print('GPT CODE %d | Retrying...' % response.status_code)
-            print(response)
-            return LLM.message(system_prompt, user_message, model_type)
+        response = LLM._post_with_retries(model_name, num_tokens, json.dumps(request_dump))
         # successful call
-        response_content = response.json()
+        try:
+            response_content = response.json()
+        except ValueError as e:
+            raise LLMResponseError('GPT | Response is not JSON', response.status_code) from e
         # calculate usage
         if 'usage' in response_content:
             completion_tokens = response_content['usage']
             input_tokens = completion_tokens['prompt_tokens']
             output_tokens = completion_tokens['completion_tokens']
-            LLM._tokens_since_minute_start += completion_tokens['total_tokens']
+            rate_limiter.record_usage(model_name, num_tokens, completion_tokens['total_tokens'])
             LLM.models[model_type].add_usage(input_tokens, output_tokens)
         # get response
         if 'choices' in response_content:
@@ -230,8 +233,71 @@ class LLM:
                                (LLM.models[model_type].model_cost_info.model_name, response_text))
                 return response_text
         # something went wrong
-        print('GPT | No response')
-        exit(1)
+        raise LLMResponseError('GPT | No response', response.status_code)
+
+    @staticmethod
+    def _post_with_retries(model_name: str, num_tokens: int, body: str) -> requests.Response:
+        """
+        Posts body to the API through the pooled session. 429s, 5xx and connection errors are retried
+        up to MAX_RETRIES times with exponential backoff and jitter (honoring Retry-After),
+        other error statuses are raised right away.
+        Every attempt reserves the call's budget, a retried attempt gives its reservation back first
+        so a logical call only ever holds one.
+        """
+        attempt = 0
+        while True:
+            # wait (in this thread only) until the model's budget allows the call
+            rate_limiter.acquire(model_name, num_tokens)
+            try:
+                response = LLM._session.post(
+                    url=OPEN_AI_ENDPOINT,
+                    headers={"Authorization": "Bearer " + LLM._API_KEY},
+                    data=body,
+                    timeout=REQUEST_TIMEOUT
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= LLM.MAX_RETRIES:
+                    raise LLMError(f'GPT | Request failed after {attempt + 1} attempts: {e}') from e
+                delay = LLM._backoff(attempt)
+                rate_limiter.refund(model_name, num_tokens, requests=1)
+                print(f'GPT | {type(e).__name__} | Retrying in {delay:.1f}s...')
+            else:
+                if response.status_code == 200:
+                    return response
+                if response.status_code not in LLM._RETRY_STATUS_CODES:
+                    raise LLMResponseError(f'GPT CODE {response.status_code} | {response.text}', response.status_code)
+                if attempt >= LLM.MAX_RETRIES:
+                    error = LLMRateLimitError if response.status_code == 429 else LLMResponseError
+                    raise error(f'GPT CODE {response.status_code} after {attempt + 1} attempts | {response.text}', response.status_code)
+                delay = max(LLM._backoff(attempt), LLM._retry_after(response))
+                # refunded before pausing, the pause must still hold every caller back
+                rate_limiter.refund(model_name, num_tokens, requests=1)
+                if response.status_code == 429:
+                    # being rate limited, hold back every caller of this model, not just this one
+                    rate_limiter.pause(model_name, delay)
+                print(f'GPT CODE {response.status_code} | Retrying in {delay:.1f}s...')
+            time.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, min(LLM._BACKOFF_MAX, LLM._BACKOFF_BASE * 2 ** attempt))
+
+    @staticmethod
+    def _retry_after(response: requests.Response) -> float:
+        """Seconds asked for by the Retry-After header (seconds or HTTP date), 0 if absent"""
+        value = response.headers.get('Retry-After')
+        if not value:
+            return 0
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return 0
 
     @staticmethod
     def new_epoch():
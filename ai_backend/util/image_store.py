@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import threading
+from typing import Callable, Optional
+
+
+class ImageStore:
+    """
+    Process wide store of base64 images keyed by content hash.
+    Each image is held once no matter how many surveys / message logs use it, users hold
+    references (the hash) and the image is freed when the last reference is released.
+    Images that aren't in memory are read through the loader (e.g. the survey store) if one is set.
+    """
+    def __init__(self, loader: Optional[Callable[[str], Optional[str]]] = None):
+        self._images: dict[str, str] = {}
+        self._refs: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.loader = loader
+        self.loader_reads = 0
+
+    def set_loader(self, loader: Optional[Callable[[str], Optional[str]]]):
+        self.loader = loader
+
+    def _load(self, ref: str) -> Optional[str]:
+        if self.loader is None:
+            return None
+        self.loader_reads += 1
+        return self.loader(ref)
+
+    @staticmethod
+    def _strip_data_uri(b64_image: str) -> str:
+        if b64_image.startswith("data:"):
+            return b64_image.split(",", 1)[1]
+        return b64_image
+
+    @staticmethod
+    def ref_for(b64_image: str) -> str:
+        return hashlib.sha256(ImageStore._strip_data_uri(b64_image).encode()).hexdigest()
+
+    def put(self, b64_image: str) -> str:
+        """
+        Adds the image (if not already stored), takes a reference on it and returns the reference.
+        """
+        b64_image = self._strip_data_uri(b64_image)
+        ref = self.ref_for(b64_image)
+        with self._lock:
+            if ref not in self._images:
+                self._images[ref] = b64_image
+                self._refs[ref] = 0
+            self._refs[ref] += 1
+        return ref
+
+    def acquire(self, ref: str):
+        """
+        Takes another reference on an image that is already stored (in memory or through the loader).
+        """
+        if not ref:
+            return
+        with self._lock:
+            if ref in self._images:
+                self._refs[ref] += 1
+                return
+        # read it outside the lock, the loader may hit the disk
+        b64_image = self._load(ref)
+        if b64_image is None:
+            raise KeyError(f"Image {ref} is not in the store")
+        with self._lock:
+            if ref not in self._images:
+                self._images[ref] = b64_image
+                self._refs[ref] = 0
+            self._refs[ref] += 1
+
+    def release(self, ref: str):
+        if not ref:
+            return
+        with self._lock:
+            if ref not in self._refs:
+                return
+            self._refs[ref] -= 1
+            if self._refs[ref] <= 0:
+                del self._refs[ref]
+                del self._images[ref]
+
+    def get(self, ref: str) -> Optional[str]:
+        """
+        Returns the base64 image for ref, or None if it isn't stored (anymore).
+        """
+        if not ref:
+            return None
+        b64_image = self._images.get(ref)
+        if b64_image is None:
+            return self._load(ref)
+        return b64_image
+
+    async def get_async(self, ref: str) -> Optional[str]:
+        """
+        Same as get, but an image that isn't in memory is read through the loader in a thread.
+        """
+        if not ref:
+            return None
+        b64_image = self._images.get(ref)
+        if b64_image is not None:
+            return b64_image
+        return await asyncio.to_thread(self.get, ref)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "images": len(self._images),
+                "references": sum(self._refs.values()),
+                "b64_chars": sum(len(b64) for b64 in self._images.values()),
+                "loader_reads": self.loader_reads,
+            }
+
+
+image_store = ImageStore()
@@ -0,0 +1,107 @@
+import base64
+import io
+import os
+import threading
+from dataclasses import dataclass
+
+from PIL import Image, ImageOps
+
+# longest side of the images sent to the models (captioning and agent prompts)
+MAX_IMAGE_SIDE = int(os.getenv("MAX_IMAGE_SIDE", "1024"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+# longest side of the thumbnails sent to viewers
+THUMBNAIL_SIDE = int(os.getenv("THUMBNAIL_SIDE", "256"))
+THUMBNAIL_QUALITY = 70
+
+
+@dataclass
+class NormalizedImage:
+    # downscaled, recompressed JPEG without metadata (what the models see)
+    b64: str
+    # small JPEG for viewers
+    thumbnail_b64: str
+    original_bytes: int
+    normalized_bytes: int
+    thumbnail_bytes: int
+
+
+class _Stats:
+    def __init__(self):
+        self.images = 0
+        self.failed = 0
+        self.original_bytes = 0
+        self.normalized_bytes = 0
+        self.thumbnail_bytes = 0
+        self._lock = threading.Lock()
+
+    def record(self, image: NormalizedImage):
+        with self._lock:
+            self.images += 1
+            self.original_bytes += image.original_bytes
+            self.normalized_bytes += image.normalized_bytes
+            self.thumbnail_bytes += image.thumbnail_bytes
+
+    def record_failure(self):
+        with self._lock:
+            self.failed += 1
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "images": self.images,
+                "failed": self.failed,
+                "original_bytes": self.original_bytes,
+                "normalized_bytes": self.normalized_bytes,
+                "thumbnail_bytes": self.thumbnail_bytes,
+                "normalized_ratio": self.normalized_bytes / self.original_bytes if self.original_bytes else 0.0,
+            }
+
+
+normalization_stats = _Stats()
+
+
+def _to_rgb(image: Image.Image) -> Image.Image:
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        # JPEG has no alpha, flatten on white
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image.convert("RGB")
+
+
+def _encode(image: Image.Image, max_side: int, quality: int) -> bytes:
+    image = image.copy()
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    buffer = io.BytesIO()
+    # no exif / icc is passed on, so the metadata is dropped
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def normalize_image(b64_image: str, max_side: int = MAX_IMAGE_SIDE, quality: int = IMAGE_QUALITY,
+                    thumbnail_side: int = THUMBNAIL_SIDE) -> NormalizedImage:
+    """
+    Caps the image's size, recompresses it as JPEG without metadata (the EXIF orientation is
+    applied first) and makes a thumbnail. Raises ValueError if the data isn't a readable image.
+    """
+    if b64_image.startswith("data:"):
+        b64_image = b64_image.split(",", 1)[1]
+    try:
+        data = base64.b64decode(b64_image)
+        with Image.open(io.BytesIO(data)) as image:
+            image = _to_rgb(ImageOps.exif_transpose(image))
+    except Exception as e:
+        normalization_stats.record_failure()
+        raise ValueError(f"Could not read image: {e}") from e
+    normalized = _encode(image, max_side, quality)
+    thumbnail = _encode(image, thumbnail_side, THUMBNAIL_QUALITY)
+    result = NormalizedImage(
+        b64=base64.b64encode(normalized).decode(),
+        thumbnail_b64=base64.b64encode(thumbnail).decode(),
+        original_bytes=len(data),
+        normalized_bytes=len(normalized),
+        thumbnail_bytes=len(thumbnail),
+    )
+    normalization_stats.record(result)
+    return result
@@ -0,0 +1,161 @@
+import os
+import random
+import re
+import threading
+
+# local answers at or above this confidence are used without asking the LLM
+LOCAL_SENTIMENT_THRESHOLD = float(os.getenv("LOCAL_SENTIMENT_THRESHOLD", "0.6"))
+# fraction of confident local answers still sent to the LLM to measure agreement
+LOCAL_SENTIMENT_AUDIT_RATE = float(os.getenv("LOCAL_SENTIMENT_AUDIT_RATE", "0.05"))
+# a summary of the agreement is printed every this many LLM comparisons
+SUMMARY_EVERY = 100
+
+# phrase -> weight per emotion, matched on word boundaries of the lowercased message
+LEXICON = {
+    'excited': {
+        "omg": 2, "can't wait": 2, "cant wait": 2, "so excited": 3, "excited": 2, "amazing": 1.5, "awesome": 1.5,
+        "yay": 2, "wow": 1.5, "incredible": 1.5, "love": 1, "no way": 1, "let's go": 2, "lets go": 2,
+    },
+    'very engaged': {
+        "tell me more": 2, "that's so interesting": 2, "i'd love to": 1.5, "what got you into": 2, "what made you": 1.5,
+        "same here": 1, "me too": 1, "i totally": 1, "how did you": 1.5,
+    },
+    'engaged': {
+        "interesting": 1, "what about": 1, "how about": 1, "do you": 1, "have you": 1, "what's": 0.5, "how's": 0.5,
+        "what kind": 1, "really": 0.5, "i also": 1, "i like": 1,
+    },
+    'mildly positive': {
+        "nice": 1.5, "cool": 1.5, "good": 1, "glad": 1, "haha": 1.5, "lol": 1.5, "fun": 1, "thanks": 1, "sounds good": 2,
+        "not bad": 1.5, "fair": 0.5,
+    },
+    'confused': {
+        "what do you mean": 3, "huh": 2, "not sure what": 2, "confused": 3, "don't understand": 3, "dont understand": 3,
+        "wdym": 3, "i don't get": 2, "wait what": 2,
+    },
+    'frustrated': {
+        "ugh": 2.5, "annoying": 2, "seriously": 1, "again": 0.5, "i already said": 2.5, "not what i": 1.5, "whatever": 1.5,
+        "frustrating": 3, "come on": 1.5,
+    },
+    'angry': {
+        "hate": 2, "stupid": 2.5, "shut up": 3, "wtf": 2.5, "angry": 3, "ridiculous": 2, "how dare": 3, "screw": 2,
+    },
+    'bored': {
+        "ok": 1, "k": 1.5, "sure": 0.5, "meh": 2.5, "idk": 1, "i guess": 1.5, "anyway": 1, "[stop]": 3, "bye": 1.5,
+        "gotta go": 2, "boring": 3, "cool cool": 1.5, "mhm": 2,
+    },
+}
+# a message with no signal at all gets this much weight on neutral, every other emotion
+# starts at SMOOTHING so that no signal (or a single weak cue) doesn't look confident
+NEUTRAL_PRIOR = 1.0
+SMOOTHING = 0.1
+
+
+def _compile(lexicon: dict) -> dict:
+    patterns = {}
+    for emotion, phrases in lexicon.items():
+        patterns[emotion] = [
+            (re.compile(r"(?<![\w\[])" + re.escape(phrase) + r"(?![\w\]])"), weight)
+            for phrase, weight in phrases.items()
+        ]
+    return patterns
+
+
+class LocalSentimentClassifier:
+    """
+    In-process, CPU only sentiment classifier over the SentimentAgent EMOTIONS.
+    Scores every emotion from a weighted phrase lexicon plus a few surface features
+    (exclamation / question marks, message length) and returns the top emotion with
+    its share of the total score as the confidence.
+    """
+    def __init__(self, lexicon: dict = LEXICON, neutral_prior: float = NEUTRAL_PRIOR, smoothing: float = SMOOTHING):
+        self._patterns = _compile(lexicon)
+        self.neutral_prior = neutral_prior
+        self.smoothing = smoothing
+
+    def scores(self, message: str) -> dict:
+        text = " ".join(message.lower().split())
+        scores = {emotion: self.smoothing for emotion in ['neutral', *self._patterns]}
+        scores['neutral'] = self.neutral_prior
+        for emotion, patterns in self._patterns.items():
+            for pattern, weight in patterns:
+                if pattern.search(text):
+                    scores[emotion] += weight
+        exclamations = text.count("!")
+        questions = text.count("?")
+        words = len(text.split())
+        if exclamations:
+            scores['excited'] += min(exclamations, 3) * 0.75
+        if questions and words > 25:
+            # long replies that ask something back
+            scores['very engaged'] += 1.5 + 0.5 * min(questions, 3)
+        elif questions:
+            scores['engaged'] += 1 + 0.5 * min(questions - 1, 2)
+        elif words > 25:
+            scores['engaged'] += 1.5
+        if words <= 2 and not exclamations and not questions:
+            scores['bored'] += 1
+        return scores
+
+    def classify(self, message: str) -> tuple[str, float]:
+        """
+        Returns (emotion, confidence in [0, 1]).
+        """
+        scores = self.scores(message)
+        emotion = max(scores, key=scores.get)
+        return emotion, scores[emotion] / sum(scores.values())
+
+
+class TieredSentimentStats:
+    """
+    Counts how often the local tier answered on its own and how often its guess agreed with
+    the LLM (per confidence band), so LOCAL_SENTIMENT_THRESHOLD can be tuned.
+    """
+    def __init__(self, audit_rate: float = LOCAL_SENTIMENT_AUDIT_RATE, summary_every: int = SUMMARY_EVERY):
+        self.audit_rate = audit_rate
+        self.summary_every = summary_every
+        self.local_answers = 0
+        self.llm_answers = 0
+        self.audits = 0
+        # confidence band (0.0, 0.1, ... 0.9) -> [compared, agreed]
+        self._bands: dict[float, list] = {}
+        self._lock = threading.Lock()
+
+    def should_audit(self) -> bool:
+        return random.random() < self.audit_rate
+
+    def record_local(self):
+        with self._lock:
+            self.local_answers += 1
+
+    def record_llm(self, local_emotion: str, confidence: float, llm_emotion: str, audit: bool = False):
+        with self._lock:
+            self.llm_answers += 1
+            if audit:
+                self.audits += 1
+            band = self._bands.setdefault(min(int(confidence * 10), 9) / 10, [0, 0])
+            band[0] += 1
+            band[1] += local_emotion == llm_emotion
+            compared = sum(band[0] for band in self._bands.values())
+        if compared % self.summary_every == 0:
+            print(f"Local sentiment tier: {self.stats()}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.local_answers + self.llm_answers
+            compared = sum(band[0] for band in self._bands.values())
+            agreed = sum(band[1] for band in self._bands.values())
+            return {
+                "local_answers": self.local_answers,
+                "llm_answers": self.llm_answers,
+                "audits": self.audits,
+                "avoided_fraction": self.local_answers / total if total else 0.0,
+                "agreement": agreed / compared if compared else 0.0,
+                "agreement_by_confidence": {
+                    f"{band:.1f}": {"compared": counts[0], "agreement": counts[1] / counts[0]}
+                    for band, counts in sorted(self._bands.items())
+                },
+            }
+
+
+local_sentiment = LocalSentimentClassifier()
+tiered_sentiment_stats = TieredSentimentStats()
@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class RateLimit:
+    requests_per_minute: int
+    tokens_per_minute: int
+
+
+# per model quotas (requests and tokens per minute)
+RATE_LIMITS = {
+    # gemini
+    "gemini-2.0-flash": RateLimit(requests_per_minute=2000, tokens_per_minute=4_000_000),
+    "gemini-1.5-pro": RateLimit(requests_per_minute=1000, tokens_per_minute=4_000_000),
+    "gemini-1.5-flash-8b": RateLimit(requests_per_minute=4000, tokens_per_minute=4_000_000),
+    # openai, kept under 90% of the account's 100k TPM
+    "o1": RateLimit(requests_per_minute=500, tokens_per_minute=90_000),
+    "gpt-4o": RateLimit(requests_per_minute=500, tokens_per_minute=90_000),
+    "gpt-4o-mini": RateLimit(requests_per_minute=500, tokens_per_minute=90_000),
+    "gpt-3.5-turbo": RateLimit(requests_per_minute=500, tokens_per_minute=90_000),
+}
+DEFAULT_RATE_LIMIT = RateLimit(requests_per_minute=1000, tokens_per_minute=1_000_000)
+
+
+class _Bucket:
+    """
+    Token bucket that refills continuously up to capacity over a minute.
+    The level may go negative: that is capacity already promised to queued callers.
+    """
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount: float) -> float:
+        """
+        Debits amount and returns the seconds until the debit is covered.
+        """
+        # a single call bigger than the whole bucket would never fit, cap it to a full bucket
+        self.level -= min(amount, self.capacity)
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+
+class RateLimiter:
+    """
+    Thread-safe, per model rate limiter with separate request and token budgets.
+
+    A caller reserves its request and tokens up front. The reservation debits both buckets
+    (possibly into debt) and tells the caller how long to wait for the budget. Later callers
+    queue behind the earlier debt, so callers are served in arrival order. Waiting only
+    suspends the caller (time.sleep in its own thread, asyncio.sleep in a coroutine),
+    never the whole process.
+    """
+    def __init__(self, limits: Optional[dict] = None, default: RateLimit = DEFAULT_RATE_LIMIT):
+        self.limits = dict(RATE_LIMITS if limits is None else limits)
+        self.default = default
+        self._buckets: dict[str, tuple[_Bucket, _Bucket]] = {}
+        self._lock = threading.Lock()
+
+    def _get_buckets(self, model_name: str) -> tuple:
+        if model_name not in self._buckets:
+            limit = self.limits.get(model_name, self.default)
+            self._buckets[model_name] = (_Bucket(limit.requests_per_minute), _Bucket(limit.tokens_per_minute))
+        return self._buckets[model_name]
+
+    def reserve(self, model_name: str, tokens: int = 0) -> float:
+        """
+        Reserves one request and tokens for model_name, returns the seconds to wait before sending.
+        """
+        with self._lock:
+            now = time.monotonic()
+            requests_bucket, tokens_bucket = self._get_buckets(model_name)
+            requests_bucket.refill(now)
+            tokens_bucket.refill(now)
+            return max(requests_bucket.take(1), tokens_bucket.take(tokens))
+
+    def acquire(self, model_name: str, tokens: int = 0):
+        """
+        Blocks the calling thread until the request fits in the budget.
+        """
+        wait = self.reserve(model_name, tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, model_name: str, tokens: int = 0):
+        """
+        Suspends the calling coroutine until the request fits in the budget.
+        """
+        wait = self.reserve(model_name, tokens)
+        if wait <= 0:
+            return
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            # give the reservation back so the callers queued behind us don't wait for it
+            self.refund(model_name, tokens, requests=1)
+            raise
+
+    def refund(self, model_name: str, tokens: int = 0, requests: int = 0):
+        with self._lock:
+            requests_bucket, tokens_bucket = self._get_buckets(model_name)
+            requests_bucket.level = min(requests_bucket.capacity, requests_bucket.level + requests)
+            tokens_bucket.level = min(tokens_bucket.capacity, tokens_bucket.level + tokens)
+
+    def record_usage(self, model_name: str, estimated_tokens: int, actual_tokens: int):
+        """
+        Corrects a reservation made with an estimate once the provider reports the real usage.
+        """
+        with self._lock:
+            _, tokens_bucket = self._get_buckets(model_name)
+            tokens_bucket.level = min(tokens_bucket.capacity, tokens_bucket.level + estimated_tokens - actual_tokens)
+
+    def pause(self, model_name: str, seconds: float):
+        """
+        Empties the model's buckets so no new request goes out for the next seconds
+        (e.g. after the provider answered 429).
+        """
+        with self._lock:
+            now = time.monotonic()
+            for bucket in self._get_buckets(model_name):
+                bucket.refill(now)
+                bucket.level = min(bucket.level, -bucket.rate * seconds)
+
+    def budget(self, model_name: Optional[str] = None) -> dict:
+        """
+        Returns the budget currently available per model (negative = callers are queued).
+        """
+        with self._lock:
+            now = time.monotonic()
+            names = [model_name] if model_name is not None else list(self._buckets)
+            budgets = {}
+            for name in names:
+                requests_bucket, tokens_bucket = self._get_buckets(name)
+                requests_bucket.refill(now)
+                tokens_bucket.refill(now)
+                budgets[name] = {
+                    "requests_available": requests_bucket.level,
+                    "requests_per_minute": requests_bucket.capacity,
+                    "tokens_available": tokens_bucket.level,
+                    "tokens_per_minute": tokens_bucket.capacity,
+                }
+            return budgets
+
+
+# shared by every gemini handler and the openai LLM client
+rate_limiter = RateLimiter()
@@ -1,6 +1,13 @@
 import io
+import os
+import json
 import base64
+import time
+import hashlib
+import argparse
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
@@ -13,9 +20,42 @@ SERVICE_ACCOUNT_FILE = './service_account.json'
 SPREADSHEET_ID = '1z8uPq8oGMhmmYjQEny-vOVh-AqJpEwSrF8rkadzpR38'
 RANGE_NAME = 'Form Responses 1!A1:AM'  # Adjust range if needed
 FORM_ENDPOINT = "http://34.27.216.29:8000/save_form"  # Replace with your actual endpoint
+FORMS_ENDPOINT = "http://34.27.216.29:8000/save_forms"  # bulk version used by sync
 # Optionally, you could load an endpoint from environment variables, e.g.:
 # FORM_ENDPOINT = os.getenv("YOUR_ENDPOINT_VAR")
 
+# rows ingested by the backend (by row id) with their timestamp and a hash of their content,
+# rows still being processed and rows that changed after they were ingested
+CHECKPOINT_FILE = './sync_checkpoint.json'
+# sync --wait: seconds between batch status polls, give up waiting after WAIT_TIMEOUT,
+# failed rows are resent up to SYNC_ROUNDS - 1 times in the same run
+POLL_INTERVAL = 5
+WAIT_TIMEOUT = 600
+SYNC_ROUNDS = 3
+# Drive files downloaded at the same time
+DOWNLOAD_WORKERS = 8
+# forms per /save_forms request
+SEND_BATCH_SIZE = 20
+
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets.readonly',
+    'https://www.googleapis.com/auth/drive.readonly',
+]
+
+IMG_IDX = 13
+
+_credentials = None
+
+
+def get_credentials():
+    """
+    Load the service account credentials once, every client shares them.
+    """
+    global _credentials
+    if _credentials is None:
+        _credentials = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+    return _credentials
+
 ########################
 # SHEETS READING
 ########################
@@ -24,23 +64,46 @@ def get_sheets_service():
     """
     Build and return a Sheets API service client.
     """
-    scopes = ['https://www.googleapis.com/auth/spreadsheets.readonly']
-    creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=scopes)
-    return build('sheets', 'v4', credentials=creds)
+    return build('sheets', 'v4', credentials=get_credentials())
+
 
-def fetch_form_responses():
+class GoogleSheetSource:
+    """
+    Reads the form responses from the Google Sheet.
+    """
+    def __init__(self, spreadsheet_id=SPREADSHEET_ID, range_name=RANGE_NAME):
+        self.spreadsheet_id = spreadsheet_id
+        self.range_name = range_name
+        self._service = None
+
+    def fetch_rows(self):
+        if self._service is None:
+            self._service = get_sheets_service()
+        result = self._service.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id,
+            range=self.range_name
+        ).execute()
+        return result.get('values', [])
+
+
+class LocalSheetSource:
+    """
+    Offline stand-in for the sheet: a JSON file holding the list of rows (headers first).
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def fetch_rows(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+
+def fetch_form_responses(sheet_source=None):
     """
     Fetch rows from the Google Sheet. Each row is a list of cell values.
     Returns: a list of rows.
     """
-    service = get_sheets_service()
-    sheet = service.spreadsheets()
-    result = sheet.values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range=RANGE_NAME
-    ).execute()
-    rows = result.get('values', [])
-    return rows
+    return (sheet_source or GoogleSheetSource()).fetch_rows()
 
 ########################
 # DRIVE / FILE HANDLING
@@ -50,9 +113,53 @@ def get_drive_service():
     """
     Build and return a Drive API service client.
     """
-    scopes = ['https://www.googleapis.com/auth/drive.readonly']
-    creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=scopes)
-    return build('drive', 'v3', credentials=creds)
+    return build('drive', 'v3', credentials=get_credentials())
+
+
+class GoogleDriveSource:
+    """
+    Downloads files from Drive. The API client isn't thread safe, so each download thread
+    builds one client (sharing the credentials) and reuses it for all of its files.
+    """
+    def __init__(self):
+        self._local = threading.local()
+
+    def _service(self):
+        if getattr(self._local, 'service', None) is None:
+            self._local.service = get_drive_service()
+        return self._local.service
+
+    def fetch_file(self, file_id):
+        request = self._service().files().get_media(fileId=file_id)
+        fh = io.BytesIO()
+        downloader = MediaIoBaseDownload(fh, request)
+
+        done = False
+        while not done:
+            status, done = downloader.next_chunk()
+        return fh.getvalue()
+
+
+class LocalDriveSource:
+    """
+    Offline stand-in for Drive: files are read from directory/<file_id>.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def fetch_file(self, file_id):
+        with open(os.path.join(self.directory, file_id), 'rb') as f:
+            return f.read()
+
+
+_default_drive_source = None
+
+def get_default_drive_source():
+    global _default_drive_source
+    if _default_drive_source is None:
+        _default_drive_source = GoogleDriveSource()
+    return _default_drive_source
+
 
 def extract_file_id(drive_link):
     """
@@ -84,38 +191,126 @@ def extract_file_id(drive_link):
         print(f"Could not parse file ID from link: {drive_link}")
         return None
 
-def fetch_and_encode_file(file_id):
+def fetch_and_encode_file(file_id, drive_source=None):
     """
     Fetch file (image or PDF) from Drive using file_id via the Drive API,
     return base64-encoded bytes as a string.
     """
-    drive_service = get_drive_service()
-    request = drive_service.files().get_media(fileId=file_id)
-    
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-
-    done = False
-    while not done:
-        status, done = downloader.next_chunk()
-
-    file_bytes = fh.getvalue()
+    file_bytes = (drive_source or get_default_drive_source()).fetch_file(file_id)
     encoded_str = base64.b64encode(file_bytes).decode('utf-8')
     return encoded_str
 
+def fetch_files_parallel(file_ids, drive_source=None, max_workers=DOWNLOAD_WORKERS):
+    """
+    Download and encode many Drive files at once with a bounded pool of threads.
+    Returns {file_id: base64 string, or None if the download failed}.
+    """
+    def fetch(file_id):
+        try:
+            return fetch_and_encode_file(file_id, source)
+        except Exception as e:
+            print(f"Could not download file {file_id}: {e}")
+            return None
+
+    source = drive_source or get_default_drive_source()
+    file_ids = list(dict.fromkeys(file_ids))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(file_ids, executor.map(fetch, file_ids)))
+
+########################
+# ROWS -> FORMS
+########################
+
+def get_drive_links(row):
+    if len(row) <= IMG_IDX or not row[IMG_IDX]:
+        return []
+    return row[IMG_IDX].split(', ')
+
+def build_form(headers, row, encoded_files):
+    """
+    Turn a sheet row into the form sent to the backend, encoded_files maps Drive file ids to base64.
+    """
+    base64_files = []
+    for drive_link in get_drive_links(row):
+        file_id = extract_file_id(drive_link)
+        base64_files.append(encoded_files.get(file_id) if file_id else None)
+
+    captions = row[IMG_IDX + 1].split('\n') if len(row) > IMG_IDX + 1 else []
+
+    data = {
+        headers[j] : row[j] for j in range(len(row)) if headers[j] not in ['Upload Pictures', 'Caption for pictures']
+    }
+
+    data['Pictures (base64)'] = base64_files
+    data['Captions'] = captions
+    return data
+
+def row_hash(row):
+    return hashlib.sha256(json.dumps(row).encode()).hexdigest()
+
+########################
+# CHECKPOINT
+########################
+
+def new_checkpoint():
+    # rows: ready on the backend, pending: sent and still processing (with their batch),
+    # conflicts: changed after the backend ingested them (by current hash), not resent
+    return {"rows": {}, "pending": {}, "conflicts": {}}
+
+def load_checkpoint(path=CHECKPOINT_FILE):
+    checkpoint = new_checkpoint()
+    try:
+        with open(path) as f:
+            checkpoint.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    return checkpoint
+
+def save_checkpoint(checkpoint, path=CHECKPOINT_FILE):
+    # write then rename so a crash never leaves a half written checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
 ########################
 # SEND TO ENDPOINT
 ########################
 
+_session = requests.Session()
+
 def send_form_data_to_endpoint(row_data):
 
-    response = requests.post(FORM_ENDPOINT, json=row_data)
-    
+    response = _session.post(FORM_ENDPOINT, json=row_data)
+
     if response.status_code == 200:
         print("Data sent successfully:", response.text)
     else:
         print("Error sending data:", response.status_code, response.text)
 
+def send_forms_to_endpoint(forms, batch_id=None):
+    """
+    Send many forms in one /save_forms request.
+    Returns the per form statuses, or None if the request failed.
+    """
+    response = _session.post(FORMS_ENDPOINT, json={'forms': forms, 'batch_id': batch_id})
+    if response.status_code != 200:
+        print("Error sending forms:", response.status_code, response.text)
+        return None
+    return response.json()
+
+def fetch_batch_statuses(batch_id):
+    """
+    {form id: status} of an ingestion batch ({} if the backend doesn't know the batch), None if the request failed.
+    """
+    response = _session.get(f"{FORMS_ENDPOINT.rsplit('/', 1)[0]}/form_batches/{batch_id}")
+    if response.status_code == 404:
+        return {}
+    if response.status_code != 200:
+        print("Error reading batch:", response.status_code, response.text)
+        return None
+    return {form["id"]: form["status"] for form in response.json()["forms"]}
+
 ########################
 # MAIN
 ########################
@@ -133,55 +328,166 @@ def fetch_and_send():
     # Print them just to see what we have
     print("Headers:", headers)
 
-    img_idx = 13
     for i, row in enumerate(data_rows, start=2):  # start=2 meaning row #2 in the sheet
-        # Safety check: row could have fewer columns if not all questions were answered
-        # if len(row) < 4:
-        #     print(f"Skipping row {i} (not enough columns).")
-        #     continue
-        drive_links = row[img_idx].split(', ')
-        base64_files = []
-        for drive_link in drive_links:
-            file_id = extract_file_id(drive_link)
-            if file_id:
-                base64_file = fetch_and_encode_file(file_id)
-            else:
-                base64_file = None
-            base64_files.append(base64_file)
-
-        captions = row[img_idx + 1].split('\n')
-        
-        
-        # data = {
-        #     "timestamp": row[0],           
-        #     "name": row[1],
-        #     "age": row[2],
-        #     "brief background": row[3],       
-        #     "mcquestion": row[2],
-        #     "images (base64)": base64_files, 
-        #     "captions": captions,
-        # }
-        data = {
-            headers[j] : row[j] for j in range(len(row)) if headers[j] not in ['Upload Pictures', 'Caption for pictures']
-        }
-
-        data['Pictures (base64)'] = base64_files 
-        data['Captions'] = captions
-        print(row[img_idx + 1], len(row), len(headers))
+        file_ids = [extract_file_id(drive_link) for drive_link in get_drive_links(row)]
+        data = build_form(headers, row, fetch_files_parallel([file_id for file_id in file_ids if file_id]))
 
         to_send = {
-            'id': str(i), 
+            'id': str(i),
             'form': data
         }
 
         print(f"===== Sending row {i} data to endpoint ====")
         print(data['Captions'])
-        print(data['Additional Notes'])
+        print(data.get('Additional Notes'))
         send_form_data_to_endpoint(to_send)
 
-if __name__ == "__main__":
-    # fetch_and_send()
+def _pending_statuses(checkpoint):
+    """
+    Backend status of every pending row (None if unknown), rows whose batch couldn't be read are left out.
+    """
+    batches = {}
+    for row_id, entry in checkpoint["pending"].items():
+        batches.setdefault(entry["batch_id"], []).append(row_id)
+    statuses = {}
+    for batch_id, row_ids in batches.items():
+        batch_statuses = fetch_batch_statuses(batch_id)
+        if batch_statuses is None:
+            continue
+        for row_id in row_ids:
+            statuses[row_id] = batch_statuses.get(row_id)
+    return statuses
+
+def reconcile_pending(checkpoint):
+    """
+    Checkpoints the pending rows the backend finished, failed (or unknown) ones are dropped from
+    pending so they are sent again. Returns (ready, failed) row ids.
+    """
+    ready, failed = [], []
+    for row_id, status in _pending_statuses(checkpoint).items():
+        entry = checkpoint["pending"][row_id]
+        if status == 'ready':
+            checkpoint["rows"][row_id] = {"timestamp": entry["timestamp"], "hash": entry["hash"]}
+            del checkpoint["pending"][row_id]
+            ready.append(row_id)
+        elif status not in ('queued', 'processing'):
+            del checkpoint["pending"][row_id]
+            failed.append(row_id)
+    return ready, failed
+
+def wait_for_pending(checkpoint, timeout=WAIT_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        statuses = _pending_statuses(checkpoint)
+        if not any(status in ('queued', 'processing') for status in statuses.values()) and len(statuses) == len(checkpoint["pending"]):
+            return True
+        time.sleep(POLL_INTERVAL)
+    print(f"Gave up waiting for {len(checkpoint['pending'])} rows, they are checked again next run.")
+    return False
+
+def rows_to_send(rows, checkpoint):
+    """
+    New rows and rows whose earlier attempt failed. Rows that changed after the backend ingested them
+    are recorded as conflicts instead: the backend keeps the first version of a form.
+    """
+    to_send = []
+    for i, row in enumerate(rows[1:], start=2):  # start=2 meaning row #2 in the sheet
+        row_id = str(i)
+        h = row_hash(row)
+        ingested = checkpoint["rows"].get(row_id)
+        pending = checkpoint["pending"].get(row_id)
+        if ingested is not None and ingested["hash"] == h:
+            checkpoint["conflicts"].pop(row_id, None)
+            continue
+        if ingested is not None or (pending is not None and pending["hash"] != h):
+            checkpoint["conflicts"][row_id] = h
+            continue
+        if pending is not None or checkpoint["conflicts"].get(row_id) == h:
+            continue
+        to_send.append((row_id, row))
+    return to_send
+
+def send_rows(headers, pending_rows, checkpoint, drive_source=None, checkpoint_path=CHECKPOINT_FILE):
+    """
+    Downloads the files of the rows and sends them in batches through /save_forms.
+    Accepted rows become pending until the backend reports them ready (reconcile_pending).
+    Returns how many rows were accepted.
+    """
+    sent = 0
+    for start in range(0, len(pending_rows), SEND_BATCH_SIZE):
+        chunk = pending_rows[start:start + SEND_BATCH_SIZE]
+        file_ids = [extract_file_id(link) for _, row in chunk for link in get_drive_links(row)]
+        encoded_files = fetch_files_parallel([file_id for file_id in file_ids if file_id], drive_source)
+        ready = []
+        for row_id, row in chunk:
+            if any(file_id and encoded_files.get(file_id) is None for file_id in map(extract_file_id, get_drive_links(row))):
+                # not checkpointed, retried next run
+                print(f"Row {row_id}: skipped this run, some of its files could not be downloaded")
+                continue
+            ready.append((row_id, row))
+        if not ready:
+            continue
+        forms = [{'id': row_id, 'form': build_form(headers, row, encoded_files)} for row_id, row in ready]
+
+        result = send_forms_to_endpoint(forms, checkpoint.get("batch_id"))
+        if result is None:
+            continue
+        checkpoint["batch_id"] = result["batch_id"]
+        statuses = {form["id"]: form["status"] for form in result["forms"]}
+        for row_id, row in ready:
+            status = statuses.get(row_id)
+            print(f"Row {row_id}: {status}")
+            if status in ('queued', 'processing'):
+                timestamp = row[0] if row else None
+                checkpoint["pending"][row_id] = {"timestamp": timestamp, "hash": row_hash(row), "batch_id": result["batch_id"]}
+                sent += 1
+            elif status == 'skipped':
+                # already ingested, possibly from another version of the row
+                checkpoint["conflicts"][row_id] = row_hash(row)
+        save_checkpoint(checkpoint, checkpoint_path)
+    return sent
 
+def sync(sheet_source=None, drive_source=None, checkpoint_path=CHECKPOINT_FILE, full=False, wait=False):
+    """
+    Incremental sync: only rows that are new (or whose ingestion failed) since the last run are
+    downloaded and sent, in batches through /save_forms. A row is only checkpointed once the backend
+    reports its form ready; rows that failed are sent again. With wait, the run polls the batch until
+    the rows are processed and resends failed ones (up to SYNC_ROUNDS rounds).
+    Rows that changed after they were ingested can't be updated (the backend keeps the first version
+    of a form), they are reported every run until the sheet goes back to the ingested version.
+    Returns the checkpoint.
+    """
+    rows = fetch_form_responses(sheet_source)
+    if not rows:
+        print("No data found.")
+        return None
+    headers = rows[0]
+    checkpoint = new_checkpoint() if full else load_checkpoint(checkpoint_path)
+
+    for round_number in range(SYNC_ROUNDS if wait else 1):
+        ready, failed = reconcile_pending(checkpoint)
+        if ready or failed:
+            print(f"{len(ready)} rows ingested, {len(failed)} failed and are sent again.")
+        pending_rows = rows_to_send(rows, checkpoint)
+        print(f"{len(pending_rows)} rows to send out of {len(rows) - 1}.")
+        sent = send_rows(headers, pending_rows, checkpoint, drive_source, checkpoint_path)
+        print(f"Sent {sent} rows, batch {checkpoint.get('batch_id')}.")
+        save_checkpoint(checkpoint, checkpoint_path)
+        if not wait or not checkpoint["pending"] or not wait_for_pending(checkpoint):
+            break
+    if wait:
+        reconcile_pending(checkpoint)
+        save_checkpoint(checkpoint, checkpoint_path)
+
+    print(f"{len(checkpoint['rows'])} rows ingested, {len(checkpoint['pending'])} still processing.")
+    if checkpoint["conflicts"]:
+        print(
+            f"{len(checkpoint['conflicts'])} rows changed after they were ingested and were not updated "
+            f"(the backend keeps the first version of a form): {', '.join(sorted(checkpoint['conflicts'], key=int))}"
+        )
+    return checkpoint
+
+def start_test_convo():
     convo_endpoint = 'http://34.27.216.29:8000/start_convo'
     to_send = {
         'convo_id': '1',
@@ -193,3 +499,25 @@ if __name__ == "__main__":
 
     print(response)
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send new form responses to the backend")
+    parser.add_argument('--full', action='store_true', help="ignore the checkpoint and resend every row")
+    parser.add_argument('--wait', action='store_true', help="wait for the backend to process the rows and resend failed ones")
+    parser.add_argument('--checkpoint', default=CHECKPOINT_FILE)
+    parser.add_argument('--local-sheet', help="read rows from this JSON file instead of the Google Sheet")
+    parser.add_argument('--local-drive', help="read files from this directory instead of Drive")
+    parser.add_argument('--endpoint', default=FORMS_ENDPOINT)
+    parser.add_argument('--start-test-convo', action='store_true')
+    args = parser.parse_args()
+
+    if args.start_test_convo:
+        start_test_convo()
+    else:
+        FORMS_ENDPOINT = args.endpoint
+        sync(
+            sheet_source=LocalSheetSource(args.local_sheet) if args.local_sheet else None,
+            drive_source=LocalDriveSource(args.local_drive) if args.local_drive else None,
+            checkpoint_path=args.checkpoint,
+            full=args.full,
+            wait=args.wait,
+        )